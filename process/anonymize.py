@@ -3,8 +3,8 @@
 #
 # Script to compute tf-idf for a set of documents
 #
-import sys, locale, codecs, getopt, os, hashlib, getpass, atexit
-import rule_manager, ldap_lookup
+import sys, locale, codecs, getopt, os, hashlib, getpass, atexit, re
+import rule_manager, ldap_lookup, metrics, anonymize_store
 
 # Fix the output encoding when redirecting stdout
 if sys.stdout.encoding is None:
@@ -33,13 +33,32 @@ module_prefix = 'anonymize'
 config_params = {
     'file': '', # File to read/update the anonymized strings
     'min_length': '9',
-    'passwd': '' # Password used to anonymize
+    'passwd': '', # Password used to anonymize
+    'scrub_min_length': '3' # Shorter ids are not replaced by scrub
     }
 
 anonymize_map = None
 
 debug = 0
 
+# Minimum length of the ids replaced by scrub
+scrub_min_length = 3
+
+# Data used by scrub (see update_scrub): set with the ids (unicode) in the
+# regular expressions, the map they were taken from, its version and the
+# number of ids added to it (see anonymize_store) when last updated, trie
+# with the ids in the main regular expression (nested dictionaries with None
+# marking the end of an id), the main regular expression, and the ids added
+# later and their regular expression.
+_scrub_ids = set()
+_scrub_source = None
+_scrub_version = None
+_scrub_added = 0
+_scrub_trie = {}
+_scrub_re = None
+_scrub_pending = []
+_scrub_pending_re = None
+
 def to_unicode(obj, encoding = 'utf-8'):
     if isinstance(obj, basestring):
         if not isinstance(obj, unicode):
@@ -55,6 +74,7 @@ def initialize(module_name = None):
     global anonymize_map
     global module_prefix
     global debug
+    global scrub_min_length
 
     if module_name == None:
         module_name = module_prefix
@@ -62,6 +82,9 @@ def initialize(module_name = None):
     # Get the level of debug
     debug = int(rule_manager.get_property(None, module_name, 'debug'))
 
+    scrub_min_length = int(rule_manager.get_property(None, module_name,
+                                                     'scrub_min_length'))
+
     # Get values from config
     map_file = rule_manager.get_property(None, module_name, 'file')
     passwd = rule_manager.get_property(None, module_name, 'passwd')
@@ -73,7 +96,8 @@ def initialize(module_name = None):
 
 def load_data(map_file):
     """
-    Given a map file, loads its data in the global dictionary anonymize_map
+    Given a map file, opens it as the global dictionary anonymize_map (see
+    anonymize_store, the entries are read when used)
     """
     global anonymize_map
 
@@ -81,24 +105,9 @@ def load_data(map_file):
     if map_file == '' or not(os.path.isfile(map_file)):
         return
 
-    anonymize_map = {}
-    dataIn = codecs.open(map_file, 'r', 'utf-8')
-    for line in dataIn:
-        # Drop the newline at the end
-        line = line[:-1]
-
-        # Skip empty lines and those starting with #
-        if len(line) == 0 or line[0] == '#':
-            continue
-
-        fields = line.split(',')
-
-        # If the line does not have at least two values, exception
-        if len(fields) < 2:
-            raise ValueError('Incorrect line ' + line)
-
-        anonymize_map[fields[0]] = fields[1]
-    dataIn.close()
+    if anonymize_map != None:
+        anonymize_map.close()
+    anonymize_map = anonymize_store.AnonymizeStore(map_file)
 
     # Program the update_map_file when the application terminates
     atexit.register(update_map_file, map_file = map_file)
@@ -113,7 +122,8 @@ def execute(module_name):
 def update_map_file(map_file):
     """
     Write the given anonymize map to a file. Lines are comma separated pairs of
-    key, name.
+    key, name. The new entries are already in the journal of the map, thus
+    if the map was loaded from the same file, it is just compacted.
     """
 
     global anonymize_map
@@ -122,6 +132,10 @@ def update_map_file(map_file):
     if map_file == '' or anonymize_map == None:
         return
 
+    if os.path.abspath(map_file) == os.path.abspath(anonymize_map.file_name):
+        anonymize_map.compact()
+        return
+
     # Open data, loop over elements in the dictionary and write the file
     dataOut = codecs.open(map_file, 'wU', 'utf-8')
     for key, value in sorted(anonymize_map.items()):
@@ -137,6 +151,19 @@ def find_string(value):
 
     return anonymize_map.get(value)
 
+def prefetch(values):
+    """
+    Look up in the directory at once (see ldap_lookup.prefetch) the given
+    strings not in anonymize_map, so that find_or_encode_string finds them
+    already looked up
+    """
+
+    if anonymize_map == None or ldap_lookup.backend == None:
+        return
+
+    ldap_lookup.prefetch([x for x in set([y.strip() for y in values])
+                          if find_string(x) == None])
+
 def find_or_encode_string(value, synonyms = None):
     """
     Given a string, obtains its sha256 digest with the password stored in the
@@ -158,20 +185,10 @@ def find_or_encode_string(value, synonyms = None):
     digest = find_string(value)
     if digest != None:
         # Hit, return
+        metrics.count('anonymize_hits')
         return digest
 
-    passwd = rule_manager.get_property(None, module_prefix, 'passwd')
-    min_length = int(rule_manager.get_property(None, module_prefix,
-                                               'min_length'))
-
-    # String not present. Encode, store and return
-    digest = hashlib.sha256((value + passwd).encode('utf-8')).hexdigest()
-
-    while anonymize_map.get(digest[0:min_length]):
-        min_length += 1
-
-    # Decide the final key
-    digest = digest[0:min_length]
+    metrics.count('anonymize_misses')
 
     # Look up the given values in LDAP and add to the collection of synonyms
     other_ids = set([value])
@@ -183,21 +200,170 @@ def find_or_encode_string(value, synonyms = None):
     if synonyms != None:
         other_ids = other_ids.union(set(synonyms))
 
-    # Other_ids has now all possible synonyms for the given value. See if any of
-    # them is in the table.
-    old_digest = next((anonymize_map.get(x) for x in other_ids \
-                           if anonymize_map.get(x) != None), None)
+    # The map is shared with other processes (see anonymize_store), which may
+    # have added any of the ids
+    anonymize_map.lock()
+    try:
+        anonymize_map.refresh()
 
-    # If one synonym was found, take that as the digest.
-    if old_digest != None:
-        digest = old_digest
+        # Other_ids has now all possible synonyms for the given value. See if
+        # any of them is in the table.
+        digest = next((anonymize_map.get(x) for x in other_ids \
+                           if anonymize_map.get(x) != None), None)
 
-    # Propagate the digest to the rest of synonyms
-    for other_id in other_ids:
-        anonymize_map[other_id] = digest
+        # If no synonym was found, encode, taking the shortest prefix not
+        # assigned to any other id
+        if digest == None:
+            passwd = rule_manager.get_property(None, module_prefix, 'passwd')
+            min_length = int(rule_manager.get_property(None, module_prefix,
+                                                       'min_length'))
+            digest = hashlib.sha256((value + passwd).encode('utf-8'))
+            digest = digest.hexdigest()
+            while anonymize_map.has_digest(digest[0:min_length]):
+                min_length += 1
+            digest = digest[0:min_length]
+
+        # Propagate the digest to the rest of synonyms
+        for other_id in other_ids:
+            anonymize_map[other_id] = digest
+    finally:
+        anonymize_map.unlock()
 
     return digest
 
+def scrub(line):
+    """
+    Replace in the line all the occurrences of the ids in anonymize_map by
+    their anonymized version, in a single pass. If several ids match at the
+    same position, the longest one is replaced. Only complete tokens are
+    replaced (see scrub_pattern).
+    """
+
+    if anonymize_map == None:
+        return line
+
+    if _scrub_source is not anonymize_map or \
+            _scrub_version != anonymize_map.map_version or \
+            _scrub_added != len(anonymize_map.added):
+        update_scrub()
+
+    if _scrub_pending_re == None or _scrub_pending_re.search(line) == None:
+        if _scrub_re == None:
+            return line
+        return _scrub_re.sub(_scrub_replacement, line)
+
+    # Combine the matches of both expressions
+    matches = list(_scrub_pending_re.finditer(line))
+    if _scrub_re != None:
+        matches.extend(_scrub_re.finditer(line))
+    matches.sort(key = lambda x: (x.start(), -x.end()))
+
+    result = []
+    position = 0
+    for match in matches:
+        if match.start() < position:
+            continue
+        result.append(line[position:match.start()])
+        result.append(_scrub_replacement(match))
+        position = match.end()
+    result.append(line[position:])
+    return u''.join(result)
+
+def _scrub_replacement(match):
+    return anonymize_map[match.group(0)]
+
+def update_scrub():
+    """
+    Take the ids added to anonymize_map since the last invocation. Compiling
+    a regular expression with many ids is expensive, so the new ids are kept
+    in a separate (small) expression, and moved to the main one only when
+    there are enough of them.
+    """
+
+    global _scrub_ids
+    global _scrub_source
+    global _scrub_version
+    global _scrub_added
+    global _scrub_trie
+    global _scrub_re
+    global _scrub_pending
+    global _scrub_pending_re
+
+    # Take all the ids for a new map (or one replaced by another process),
+    # otherwise only those added since the last invocation
+    if _scrub_source is not anonymize_map or \
+            _scrub_version != anonymize_map.map_version:
+        _scrub_ids = set()
+        _scrub_source = anonymize_map
+        _scrub_version = anonymize_map.map_version
+        _scrub_trie = {}
+        _scrub_re = None
+        _scrub_pending = []
+        new_ids = iter(anonymize_map)
+    else:
+        new_ids = anonymize_map.added[_scrub_added:]
+    _scrub_added = len(anonymize_map.added)
+
+    for key in new_ids:
+        value = to_unicode(key)
+        if len(value) < scrub_min_length or value in _scrub_ids:
+            continue
+        _scrub_ids.add(value)
+        _scrub_pending.append(value)
+
+    # Recompile the main expression when the pending ids are more than the
+    # square root of the total (or at the beginning)
+    if len(_scrub_pending) ** 2 > 2 * len(_scrub_ids) or _scrub_re == None:
+        add_to_trie(_scrub_trie, _scrub_pending)
+        _scrub_pending = []
+        if _scrub_trie != {}:
+            _scrub_re = re.compile(scrub_pattern(_scrub_trie), re.UNICODE)
+
+    _scrub_pending_re = None
+    if _scrub_pending != []:
+        pattern = scrub_pattern(add_to_trie({}, _scrub_pending))
+        _scrub_pending_re = re.compile(pattern, re.UNICODE)
+
+def add_to_trie(trie, values):
+    """
+    Add the strings to the trie (nested dictionaries with None marking the end
+    of a string) and return it
+    """
+
+    for value in values:
+        node = trie
+        for char in value:
+            node = node.setdefault(char, {})
+        node[None] = True
+    return trie
+
+def scrub_pattern(trie):
+    """
+    Regular expression matching the strings in the trie only as complete
+    tokens, that is, not preceded or followed by a letter, digit, '_', '.',
+    '@' or '-' (so that an id is not replaced inside a longer id, a host name
+    or an email address)
+    """
+    return r'(?<![\w.@-])(?:' + trie_pattern(trie) + r')(?![\w.@-])'
+
+def trie_pattern(node):
+    """
+    Regular expression matching the strings in the trie, preferring the
+    longest
+    """
+
+    branches = [re.escape(char) + trie_pattern(child)
+                for (char, child) in sorted(node.items()) if char != None]
+    if branches == []:
+        return ''
+    if len(branches) == 1 and not None in node:
+        return branches[0]
+
+    result = '(?:' + '|'.join(branches) + ')'
+    if None in node:
+        result += '?'
+    return result
+
 def main():
     """
     Get a list of NIAs and create an encrypted mapping. The idea is to create a
@@ -287,10 +453,12 @@ def main():
 
     initialize(module_prefix)
 
+    # Read all the lines to look up the NIAs in LDAP at once
+    lines = [to_unicode(x)[:-1] for x in sys.stdin]
+    ldap_lookup.prefetch([x.split(',')[0].strip() for x in lines if x != ''])
+
     # Loop for every line in stdin
-    for line in sys.stdin:
-        line = to_unicode(line)
-        line = line[:-1]
+    for line in lines:
         # Skip empty lines
         if len(line) == 0:
             continue
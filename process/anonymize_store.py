@@ -0,0 +1,426 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Storage of the anonymize map (anonymize.anonymize_map) in three files:
+#
+# - FILE: the map, with lines "id,digest" sorted by id (compared as utf-8
+#   strings). It is memory-mapped and the ids are searched with a binary
+#   search over the lines, so opening it takes the same time regardless of its
+#   size, and only the entries used are kept in memory.
+#
+# - FILE.digests: lines "digest,id" sorted by digest, searched in the same
+#   way to check if a digest is already assigned.
+#
+# - FILE.journal: lines "id,digest" appended (and synced to disk) as soon as
+#   each new id is added to the map. It is read entirely when the map is open.
+#
+# The journal is merged into the map (compaction) when the map is closed. The
+# new files are written to a temporary file and renamed, and the journal is
+# truncated afterwards, so a failure at any point loses no entries.
+#
+# Several processes (for example, the workers in parallel) may use the same map
+# at the same time. New ids are added holding a lock on the journal (see lock),
+# after reading the entries appended by the other processes (see refresh),
+# thus each id gets a single digest and no digest is assigned twice. The
+# entries already known are obtained without the lock.
+#
+# The absence of the digests file denotes a map not written by this module (for
+# example, edited by hand). The map is then checked to be sorted, and rewritten
+# if it is not.
+#
+import sys, locale, codecs, os, mmap, fcntl
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+def to_unicode(value):
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    return value
+
+def parse_line(line):
+    """
+    Return the pair (id, digest) in a line (utf-8), or None if the line is
+    empty or a comment. Lines with less than two fields raise ValueError.
+    """
+
+    line = line.rstrip('\r\n')
+    if line == '' or line[0] == '#':
+        return None
+
+    fields = line.split(',')
+    if len(fields) < 2:
+        raise ValueError('Incorrect line ' + line)
+    return (fields[0], fields[1])
+
+def search_lines(data, key):
+    """
+    Binary search in the data (memory-mapped file with lines "key,value" sorted
+    by key) of the given key (utf-8). Returns the value (utf-8) of one of the
+    lines with that key, or None.
+    """
+
+    if data == None:
+        return None
+
+    low = 0
+    high = len(data)
+    while low < high:
+        # Line containing the middle position
+        middle = (low + high) // 2
+        start = data.rfind('\n', low, middle) + 1
+        if start == 0:
+            start = low
+        end = data.find('\n', middle, high)
+        if end == -1:
+            end = high
+        separator = data.find(',', start, end)
+
+        line_key = data[start:separator]
+        if line_key == key:
+            return data[separator + 1:end]
+        if line_key < key:
+            low = end + 1
+        else:
+            high = start
+    return None
+
+def map_file(file_name):
+    """
+    Open and memory-map the file. Returns the pair (file, data) where data is
+    None if the file is empty.
+    """
+
+    result = open(file_name, 'rb')
+    if os.path.getsize(file_name) == 0:
+        return (result, None)
+    return (result, mmap.mmap(result.fileno(), 0, access = mmap.ACCESS_READ))
+
+def write_lines(file_name, pairs):
+    """
+    Replace the file with lines "key,value" (utf-8) with the given pairs,
+    skipping repeated keys
+    """
+
+    data_out = open(file_name + '.tmp', 'wb')
+    previous = None
+    for (key, value) in pairs:
+        if key == previous:
+            continue
+        data_out.write(key + ',' + value + '\n')
+        previous = key
+    data_out.flush()
+    os.fsync(data_out.fileno())
+    data_out.close()
+    os.rename(file_name + '.tmp', file_name)
+
+class AnonymizeStore(object):
+    """
+    Dictionary id: digest stored in a file (see the top of the module). The
+    ids and digests are unicode.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.digests_name = file_name + '.digests'
+        self.journal_name = file_name + '.journal'
+        self.journal = open(self.journal_name, 'a+b')
+
+        # Entries known in memory (those in the journal, and those taken from
+        # the map), ids in the journal not present in the map, digests in the
+        # journal, and position of the journal read
+        self.entries = {}
+        self.journal_ids = set()
+        self.journal_digests = set()
+        self.journal_position = 0
+
+        # Ids added to the map (by this or other processes) since it was
+        # open, in order, so that the users of the map (anonymize.scrub)
+        # can take only the new ones. The version changes when the map is
+        # replaced by another process, as it may contain ids never seen here.
+        self.added = []
+        self.map_version = 0
+
+        self.lock()
+        try:
+            if not os.path.exists(self.digests_name):
+                if not self.is_sorted():
+                    write_lines(self.file_name,
+                                sorted(dict(self.read_lines()).items()))
+                write_lines(self.digests_name,
+                            sorted([(y, x) for (x, y) in self.read_lines()]))
+
+            self.open_map()
+            self.refresh()
+        finally:
+            self.unlock()
+
+    def lock(self):
+        """
+        Wait until no other process holds the lock and take it. The lock is
+        per process (the workers in parallel do not inherit it).
+        """
+        fcntl.lockf(self.journal.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self):
+        fcntl.lockf(self.journal.fileno(), fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Read the entries appended to the journal (by any process) since the
+        last invocation. If another process compacted the map, the new map is
+        used.
+        """
+
+        if os.stat(self.file_name).st_ino != self.map_inode:
+            self.close_map()
+            self.open_map()
+            self.journal_ids = set()
+            self.journal_digests = set()
+            self.journal_position = 0
+            self.map_version += 1
+
+        self.journal.seek(self.journal_position)
+        for line in self.journal:
+            # A last line without end of line was not completely written
+            if line[-1:] != '\n':
+                break
+            self.journal_position += len(line)
+
+            pair = parse_line(line)
+            if pair == None:
+                continue
+            (key, value) = pair
+            unicode_key = key.decode('utf-8')
+            if not unicode_key in self.journal_ids and \
+                    self.search(key) == None:
+                self.journal_ids.add(unicode_key)
+                self.added.append(unicode_key)
+            self.journal_digests.add(value)
+            self.entries[unicode_key] = value.decode('utf-8')
+
+    def read_lines(self):
+        """
+        Generator with the pairs (id, digest) in the map file (utf-8)
+        """
+
+        data_in = open(self.file_name, 'rb')
+        for line in data_in:
+            pair = parse_line(line)
+            if pair != None:
+                yield pair
+        data_in.close()
+
+    def is_sorted(self):
+        """
+        Check if the map file only has lines "id,digest" sorted by id
+        """
+
+        previous = None
+        data_in = open(self.file_name, 'rb')
+        try:
+            for line in data_in:
+                fields = line.rstrip('\n').split(',')
+                if len(fields) != 2 or '\r' in line or \
+                        fields[0][:1] == '#' or \
+                        (previous != None and fields[0] <= previous):
+                    return False
+                previous = fields[0]
+        finally:
+            data_in.close()
+        return True
+
+    def open_map(self):
+        """
+        Memory-map the map and digest files
+        """
+
+        (self.map_file, self.data) = map_file(self.file_name)
+        self.map_inode = os.fstat(self.map_file.fileno()).st_ino
+        (self.digests_file, self.digests_data) = map_file(self.digests_name)
+
+        # Number of entries in the map, counted when first needed
+        self.map_size = None
+
+    def search(self, key):
+        """
+        Search the id (utf-8) in the map. Returns the digest (utf-8) or None.
+        """
+        return search_lines(self.data, key)
+
+    def has_digest(self, digest):
+        """
+        Check if the digest is assigned to some id (in this process or in the
+        files)
+        """
+
+        if isinstance(digest, unicode):
+            digest = digest.encode('utf-8')
+        return digest in self.journal_digests or \
+            search_lines(self.digests_data, digest) != None
+
+    def get(self, key, default = None):
+        key = to_unicode(key)
+        result = self.entries.get(key)
+        if result != None:
+            return result
+
+        result = self.search(key.encode('utf-8'))
+        if result == None:
+            return default
+        result = result.decode('utf-8')
+        self.entries[key] = result
+        return result
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result == None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        return self.get(key) != None
+
+    def __setitem__(self, key, value):
+        """
+        Add or change the entry. If other processes use the map, the lock must
+        be held.
+        """
+
+        key = to_unicode(key)
+        value = to_unicode(value)
+        old_value = self.get(key)
+        if old_value == value:
+            return
+
+        if old_value == None:
+            self.journal_ids.add(key)
+            self.added.append(key)
+        self.journal_digests.add(value.encode('utf-8'))
+        self.entries[key] = value
+
+        # Make the entry durable
+        self.journal.seek(0, os.SEEK_END)
+        self.journal.write((key + u',' + value + u'\n').encode('utf-8'))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def update(self, other):
+        for (key, value) in other.items():
+            self[key] = value
+
+    def __len__(self):
+        if self.map_size == None:
+            self.map_size = 0
+            data = self.data
+            if data != None:
+                for position in xrange(0, len(data), 1048576):
+                    self.map_size += data[position:position +
+                                          1048576].count('\n')
+                if data[-1] != '\n':
+                    self.map_size += 1
+        return self.map_size + len(self.journal_ids)
+
+    def map_pairs(self):
+        """
+        Generator with the pairs (id, digest) in the map file (utf-8)
+        """
+
+        data = self.data
+        if data == None:
+            return
+
+        position = 0
+        while position < len(data):
+            end = data.find('\n', position)
+            if end == -1:
+                end = len(data)
+            separator = data.find(',', position, end)
+            yield (data[position:separator], data[separator + 1:end])
+            position = end + 1
+
+    def __iter__(self):
+        for (key, value) in self.map_pairs():
+            yield key.decode('utf-8')
+        for key in self.journal_ids:
+            yield key
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(x, self[x]) for x in self]
+
+    def merged_pairs(self):
+        """
+        Generator with the pairs (id, digest) in utf-8 of the map file and the
+        journal, sorted by id
+        """
+
+        # Entries updated in the journal, and entries only in the journal
+        new_entries = dict([(x.encode('utf-8'), y.encode('utf-8'))
+                            for (x, y) in self.entries.items()])
+        added = sorted([x.encode('utf-8') for x in self.journal_ids])
+
+        index = 0
+        for (key, value) in self.map_pairs():
+            while index < len(added) and added[index] < key:
+                yield (added[index], new_entries[added[index]])
+                index += 1
+            yield (key, new_entries.get(key, value))
+        for key in added[index:]:
+            yield (key, new_entries[key])
+
+    def compact(self):
+        """
+        Merge the journal into the map and digest files
+        """
+
+        self.lock()
+        try:
+            self.refresh()
+            if self.journal_position == 0:
+                return
+
+            digests = []
+            def pairs():
+                for (key, value) in self.merged_pairs():
+                    digests.append((value, key))
+                    yield (key, value)
+            write_lines(self.file_name, pairs())
+            digests.sort()
+            write_lines(self.digests_name, digests)
+
+            self.close_map()
+            self.open_map()
+            self.journal_ids = set()
+            self.journal_digests = set()
+            self.journal_position = 0
+            self.journal.truncate(0)
+        finally:
+            self.unlock()
+
+    def close_map(self):
+        for data in (self.data, self.digests_data):
+            if data != None:
+                data.close()
+        self.data = None
+        self.digests_data = None
+        self.map_file.close()
+        self.digests_file.close()
+
+    def close(self):
+        """
+        Compact the map and release the files
+        """
+
+        self.compact()
+        self.close_map()
+        self.journal.close()
@@ -5,8 +5,7 @@
 # 
 import sys, locale, codecs, getopt, os, glob, re, datetime
 
-import detect_new_files, rules_common, rule_manager, event_output, anonymize
-import process_filters
+import rule_manager, process_filters, pipeline, event_record, timestamps
 
 #
 # See update_events and event_output for the structure of the events
@@ -31,7 +30,8 @@ module_prefix = 'apache_log'
 config_params = {
     'files': '',          # Files to process
     'filter_file': '',    # File containing a function to filter events
-    'filter_function': '' # Function to use to filter
+    'filter_function': '', # Function to use to filter
+    'filter': ''           # Declarative filter (see filter_expr)
     }
 
 # clf_re = re.compile(r'\s+'.join([
@@ -78,83 +78,43 @@ def execute(module_name):
             
     """
 
-    global clf_re
     global filter_function
 
-    # Get the window date to process events
-    (from_date, until_date) = rules_common.window_dates(module_name)
-
-    # Get the files to process, lines and mark lines
-    (files, total_lines, mark_lines) = \
-        rules_common.files_to_process(module_name)
-
-    # Loop over all the given args
-    total_counter = 0
-    for file_annotation in files:
-        # Get the file name and (if it exists, the date of the last event)
-        filename = file_annotation[0]
-        last_event = datetime.datetime.min
-        if len(file_annotation[1]) != 0:
-            last_event = datetime.datetime.strptime(file_annotation[1][0], 
-                                                        '%Y-%m-%d %H:%M:%S')
-        new_last_event = last_event
-
-        data_in = codecs.open(filename, 'r', encoding = 'utf8', 
-                              errors = 'replace')
-        old = ''
-        counter = 0
-        for line in data_in:
-
-            counter += 1
-            total_counter += 1
-            
-            if total_counter % mark_lines == 0:
-                print >> sys.stderr, '+',
-                sys.stderr.flush()
-
-            line = line[:-1]
-            
-            fields = clf_re.match(line).groups()
-
-            if fields[2] == '':
-                raise ValueError('Empty string' + line)
+    pipeline.run(module_name, parse_file, filter_function, prefilter = True)
 
-            # Translate date time of the event
-            dtime = datetime.datetime.strptime(fields[3].strip()[:-6], 
-                                               '%d/%b/%Y:%H:%M:%S')
+def parse_file(context, lines):
+    """
+    Generator parsing the lines of an Apache log (see pipeline)
+    """
 
-            if dtime <= last_event:
-                # Event is older than what has been recorded in the
-                # detect_new_files. skip
-                continue
+    global clf_re
 
-            if dtime < from_date or dtime > until_date:
-                # Ignore event because it is outside the given window
-                continue
+    for line in lines:
+        line = line[:-1]
             
-            # If there is a filter function and returns None, skip this event
-            if filter_function != None and filter_function(fields) == None:
-                continue
+        fields = clf_re.match(line).groups()
 
-            # Record the event with the highest datetime.
-            if dtime > new_last_event:
-                new_last_event = dtime
+        if fields[2] == '':
+            raise ValueError('Empty string' + line)
 
-            (method, url, protocol) = fields[4].split()
+        if not context.accept(fields):
+            continue
 
-            event = ('visit_url', dtime,
-                     anonymize.find_or_encode_string(fields[2]),
-                     [('application', 'unknown'), 
-                      ('url', url),
-                      ('ip', fields[0])])
-            
-            event_output.out(event)
+        # Translate date time of the event
+        dtime = timestamps.parse_clf(fields[3].strip()[:-6])
+
+        # Malformed requests (e.g. "-") are kept as they are
+        request = fields[4].split()
+        url = fields[4]
+        if len(request) == 3:
+            url = request[1]
 
-        data_in.close()
-        detect_new_files.update(None, module_name + '//' + filename, 
-                                [new_last_event])
+        event = event_record.Event('visit_url', dtime, fields[2],
+                                   [('application', 'unknown'), 
+                                    ('url', url),
+                                    ('ip', fields[0])])
 
-    print >> sys.stderr
+        yield (dtime, fields, event)
 
 def main():
     """
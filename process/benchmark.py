@@ -0,0 +1,455 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Throughput benchmark of the parsers. For each module, synthetic input files
+# are generated in the format accepted by the parser, a configuration file with
+# a single rule is created, and update_events is executed over it in a
+# separate process. For each module the script reports:
+#
+# - Number of lines in the input files and lines processed per second
+# - Number of events produced and events per second
+# - Peak resident memory of the process (and its worker processes)
+#
+# The inputs are generated with a fixed seed, thus two executions with the same
+# parameters process exactly the same data and their results can be compared
+# to detect regressions.
+#
+import sys, locale, codecs, getopt, os, random, datetime, time, shutil
+import tempfile, subprocess, json
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Date of the first event generated
+start_date = datetime.datetime(2012, 2, 6, 8, 0, 0)
+
+programs = ['ls', 'cd', 'vi', 'make', 'cat', 'grep', 'svn', 'cp', 'rm']
+
+urls = ['/index.html', '/css/style.css', '/js/jquery.js', '/img/logo.png',
+        '/course/view.php?id=2', '/mod/forum/view.php?id=%d',
+        '/INT/chapter_%d_en.html', '/doc/notes_%d.pdf']
+
+moodle_actions = ['course view', 'resource view', 'forum view forum',
+                  'forum add post', 'quiz attempt', 'quiz view', 'user view']
+
+svn_operations = ['update /Teams/Team_%02d r%d send-copyfrom-args',
+                  'get-file-revs /Teams/Team_%02d/x.c r12:%d include',
+                  'lock /Teams/Team_%02d/y.c steal',
+                  'commit harry r%d',
+                  'diff /Teams/Team_%02d r15:%d depth=infinity',
+                  'get-dir /Teams/Team_%02d r%d text',
+                  'log /Teams/Team_%02d r20:%d discover-changed-paths',
+                  'checkout-or-export /Teams/Team_%02d r%d depth=infinity']
+
+class Generator(object):
+    """
+    Source of random values shared by the functions generating the files
+    """
+
+    def __init__(self, users, seed):
+        self.random = random.Random(seed)
+        self.users = ['user%04d' % x for x in range(users)]
+        self.date = start_date
+
+    def user(self):
+        return self.random.choice(self.users)
+
+    def ip(self):
+        return '10.0.%d.%d' % (self.random.randint(0, 3),
+                               self.random.randint(1, 254))
+
+    def next_date(self, max_gap = 5):
+        """
+        Dates increase by a random number of seconds (zero included, the
+        logs have many events in the same second)
+        """
+        self.date += datetime.timedelta(seconds = self.random.randint(0,
+                                                                      max_gap))
+        return self.date
+
+    def url(self):
+        url = self.random.choice(urls)
+        if '%d' in url:
+            url = url % self.random.randint(1, 50)
+        return url
+
+################################################################################
+#
+# Functions writing n lines (approximately) in a given file. They return the
+# number of lines written.
+#
+################################################################################
+def apache_lines(data_out, n, gen):
+    for i in range(n):
+        print >> data_out, '%s - %s [%s +0100] "GET %s HTTP/1.1" %d %d' % \
+            (gen.ip(), gen.user(),
+             gen.next_date().strftime('%d/%b/%Y:%H:%M:%S'),
+             gen.url(), gen.random.choice([200, 200, 200, 304, 404]),
+             gen.random.randint(100, 50000))
+    return n
+
+def embeddedq_lines(data_out, n, gen):
+    for i in range(n):
+        kind = gen.random.randint(0, 3)
+        form = 'form=q%d' % gen.random.randint(1, 20)
+        page = '/INT/inclass_%d_en.html_bogus.html' % gen.random.randint(1, 9)
+        if kind == 0:
+            url = gen.url()
+            status = 200
+        elif kind == 1:
+            url = page + '?' + form + '&showIt=1'
+            status = 404
+        else:
+            url = page + '?' + form + '&answers=' + \
+                ''.join(['%d%d%s' % (x + 1, gen.random.randint(0, 4),
+                                      gen.random.choice('CI0'))
+                         for x in range(gen.random.randint(1, 4))])
+            status = 404
+        print >> data_out, '%s - %s [%s +0100] "GET %s HTTP/1.1" %d %d' % \
+            (gen.ip(), gen.user(),
+             gen.next_date().strftime('%d/%b/%Y:%H:%M:%S'), url, status,
+             gen.random.randint(100, 5000))
+    return n
+
+def svn_apache_lines(data_out, n, gen):
+    for i in range(n):
+        operation = gen.random.choice(svn_operations)
+        operation = operation.replace('%02d', '%02d' % gen.random.randint(1,
+                                                                          40))
+        operation = operation.replace('%d', str(gen.random.randint(16, 4000)))
+        print >> data_out, '[%s +0100] %s asteams-en %s' % \
+            (gen.next_date().strftime('%d/%b/%Y:%H:%M:%S'), gen.user(),
+             operation)
+    return n
+
+def moodle_date(dtime):
+    """
+    Date in the format used in the Moodle logs (datetime_format)
+    """
+    return dtime.strftime('%d %B %Y, %H:%M ') + \
+        ['AM', 'PM'][dtime.hour >= 12]
+
+def moodle_csv_lines(data_out, n, gen):
+    for i in range(n):
+        print >> data_out, '\t'.join(['Course%d' % gen.random.randint(1, 3),
+                                      moodle_date(gen.next_date(30)),
+                                      gen.ip(), gen.user(),
+                                      gen.random.choice(moodle_actions),
+                                      'resource%d' % gen.random.randint(1,
+                                                                        200)])
+    return n
+
+def moodle_html_lines(data_out, n, gen):
+    print >> data_out, '<html><body>'
+    print >> data_out, '<div class="breadcrumb"><ul><li>' + \
+        '<a href="http://moodle/course/view.php?id=2">Course2</a>' + \
+        '</li></ul></div>'
+    print >> data_out, '<table class="logtable generaltable">'
+    print >> data_out, '<tr><th>Time</th><th>IP</th><th>Name</th>' + \
+        '<th>Action</th><th>Information</th></tr>'
+    for i in range(n):
+        user = gen.user()
+        print >> data_out, ('<tr><td>Mon %s</td><td><a href="ip">%s</a></td>'
+                            '<td><a href="user/view.php?id=%s&amp;course=2">'
+                            '%s</a></td><td>%s</td><td>resource%d</td></tr>') \
+                            % (moodle_date(gen.next_date(30)), gen.ip(), user,
+                               user.capitalize(),
+                               gen.random.choice(moodle_actions),
+                               gen.random.randint(1, 200))
+    print >> data_out, '</table></body></html>'
+    return n + 6
+
+def bash_lines(data_out, n, gen):
+    for i in range(n / 2):
+        program = gen.random.choice(programs)
+        print >> data_out, '#%d' % time.mktime(gen.next_date(60).timetuple())
+        print >> data_out, program, '-l /home/%s/file%d' % \
+            (gen.user(), gen.random.randint(1, 100))
+    return 2 * (n / 2)
+
+def firefox_lines(data_out, n, gen):
+    for i in range(n):
+        print >> data_out, gen.next_date(20).strftime('%Y-%m-%d %H:%M:%S'), \
+            'http://www.example.com' + gen.url()
+    return n
+
+def editor_lines(program):
+    """
+    Function generating the lines of kate or kdevelop
+    """
+
+    def lines(data_out, n, gen):
+        for i in range(n):
+            begin = gen.next_date(120)
+            end = begin + datetime.timedelta(seconds = gen.random.randint(1,
+                                                                          900))
+            print >> data_out, '0 %s %s \'/usr/bin/%s\' \'file%d.c\'' % \
+                (begin.strftime('%Y-%m-%d %H:%M:%S'),
+                 end.strftime('%Y-%m-%d %H:%M:%S'), program,
+                 gen.random.randint(1, 30))
+        return n
+    return lines
+
+def block_lines(program, message_lines, begin_status, end_status):
+    """
+    Function generating the -BEGIN/-END blocks of gcc, gdb and valgrind. If
+    begin_status, a status precedes the dates in the -BEGIN line. If
+    end_status, a status follows the -END mark.
+    """
+
+    def lines(data_out, n, gen):
+        written = 0
+        while written < n:
+            begin = gen.next_date(120)
+            end = begin + datetime.timedelta(seconds = gen.random.randint(1,
+                                                                          60))
+            status = ''
+            if begin_status:
+                status = '0 '
+            print >> data_out, '-BEGIN %s%s %s /usr/bin/%s file%d.c' % \
+                (status, begin.strftime('%Y-%m-%d %H:%M:%S'),
+                 end.strftime('%Y-%m-%d %H:%M:%S'), program,
+                 gen.random.randint(1, 30))
+            messages = gen.random.randint(0, message_lines)
+            for i in range(messages):
+                print >> data_out, 'file.c:%d: message number %d' % \
+                    (gen.random.randint(1, 300), i)
+            if end_status:
+                print >> data_out, '-END 0'
+            else:
+                print >> data_out, '-END'
+            written += messages + 2
+        return written
+    return lines
+
+# Formats: name: (rule, function, files in user directories, options)
+formats = {
+    'apache_log': ('apache_log', apache_lines, False, {}),
+    'embeddedq_log': ('embeddedq_log', embeddedq_lines, False, {}),
+    'svn_apache': ('svn_apache', svn_apache_lines, False, {}),
+    'moodle_csv': ('moodle_log', moodle_csv_lines, False, {}),
+    'moodle_html': ('moodle_log', moodle_html_lines, False,
+                    {'event_file_type': 'html'}),
+    'bash_log': ('bash_log', bash_lines, True, {}),
+    'firefox_log': ('firefox_log', firefox_lines, True, {}),
+    'kate_log': ('kate_log', editor_lines('kate'), True, {}),
+    'kdevelop_log': ('kdevelop_log', editor_lines('kdevelop'), True, {}),
+    'gcc_log': ('gcc_log', block_lines('gcc', 4, True, False), True, {}),
+    'gdb_log': ('gdb_log', block_lines('gdb', 6, False, False), True, {}),
+    'valgrind_log': ('valgrind_log', block_lines('valgrind', 6, False, True),
+                     True, {})
+    }
+
+def generate(format_name, directory, lines, users, seed):
+    """
+    Generate the files of the given format in the directory with a total of
+    (approximately) the given number of lines. Files in user directories are
+    spread over the given number of users. Returns the pair (files, lines)
+    with the value for the variable "files" of the rule and the number of lines
+    written.
+    """
+
+    global formats
+
+    (rule, function, user_directories, options) = formats[format_name]
+    gen = Generator(users, seed)
+
+    if not user_directories:
+        file_name = os.path.join(directory, format_name + '.log')
+        data_out = open(file_name, 'w')
+        written = function(data_out, lines, gen)
+        data_out.close()
+        return (file_name, written)
+
+    written = 0
+    for user in gen.users:
+        os.makedirs(os.path.join(directory, user))
+        data_out = open(os.path.join(directory, user, format_name + '.log'),
+                        'w')
+        written += function(data_out, lines / users, gen)
+        data_out.close()
+    return (os.path.join(directory, '*', format_name + '.log'), written)
+
+def run(format_name, directory, lines, users, seed, jobs):
+    """
+    Generate the data for the given format in the directory, execute
+    update_events over it, and return a dictionary with the results.
+    """
+
+    global formats
+
+    (rule, function, user_directories, options) = formats[format_name]
+
+    (files, written) = generate(format_name, directory, lines, users, seed)
+
+    # Empty anonymize map and configuration with one rule
+    codecs.open(os.path.join(directory, 'map.csv'), 'w', 'utf-8').close()
+    output_file = os.path.join(directory, 'events.csv')
+    config_file = os.path.join(directory, 'benchmark.cfg')
+    data_out = codecs.open(config_file, 'w', 'utf-8')
+    print >> data_out, '[anonymize]'
+    print >> data_out, 'file =', os.path.join(directory, 'map.csv')
+    print >> data_out
+    print >> data_out, '[event_output]'
+    print >> data_out, 'output_file =', output_file
+    print >> data_out
+    print >> data_out, '[' + rule + ']'
+    print >> data_out, 'files =', files
+    for (name, value) in options.items():
+        print >> data_out, name, '=', value
+    data_out.close()
+
+    command = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'update_events.py')]
+    if jobs != 1:
+        command.extend(['-j', str(jobs), '-s'])
+    command.append(config_file)
+
+    # The resource usage of the process is obtained with wait4 (it includes
+    # its worker processes)
+    log_file = open(os.path.join(directory, 'stderr.txt'), 'w')
+    start = time.time()
+    process = subprocess.Popen(command, stdout = log_file, stderr = log_file)
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    log_file.close()
+    process.returncode = os.WEXITSTATUS(status)
+
+    if process.returncode != 0:
+        print >> sys.stderr, 'Error while processing', format_name, '(see',
+        print >> sys.stderr, os.path.join(directory, 'stderr.txt') + ')'
+        sys.exit(1)
+
+    # Events are the lines of the output except the header
+    events = -1
+    for line in open(output_file):
+        events += 1
+
+    return {'format': format_name,
+            'lines': written,
+            'bytes': sum([os.path.getsize(os.path.join(x[0], y))
+                          for x in os.walk(directory) for y in x[2]
+                          if y.startswith(format_name)]),
+            'events': events,
+            'seconds': elapsed,
+            'lines_per_second': written / elapsed,
+            'events_per_second': events / elapsed,
+            # ru_maxrss is in kilobytes
+            'peak_rss_mb': usage.ru_maxrss / 1024.0}
+
+def main():
+    """
+    Generate synthetic logs and measure the throughput of the parsers.
+
+    script [options] [format format ...]
+
+    Options:
+
+    -n N, --lines=N   Lines generated for each format (default 100000)
+
+    -u N, --users=N   Number of users (and user directories) (default 50)
+
+    -j N, --jobs=N    Execute update_events with N worker processes
+
+    -s N, --seed=N    Seed for the random generator (default 1)
+
+    -o F, --output=F  Write the results in file F (JSON)
+
+    -k DIR, --keep=DIR Generate the data in DIR and do not remove it
+
+    The formats are: apache_log, embeddedq_log, svn_apache, moodle_csv,
+    moodle_html, bash_log, firefox_log, kate_log, kdevelop_log, gcc_log,
+    gdb_log, valgrind_log (all of them if none is given).
+
+    Example:
+
+    script -n 1000000 apache_log moodle_csv
+    """
+
+    global formats
+
+    lines = 100000
+    users = 50
+    jobs = 1
+    seed = 1
+    output_file = None
+    keep_dir = None
+
+    # Swallow the options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:u:j:s:o:k:",
+                                   ["lines=", "users=", "jobs=", "seed=",
+                                    "output=", "keep="])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, 'Incorrect option.'
+        print >> sys.stderr, main.__doc__
+        sys.exit(2)
+
+    # Parse the options
+    try:
+        for optstr, value in opts:
+            if optstr == "-n" or optstr == "--lines":
+                lines = int(value)
+            elif optstr == "-u" or optstr == "--users":
+                users = int(value)
+            elif optstr == "-j" or optstr == "--jobs":
+                jobs = int(value)
+            elif optstr == "-s" or optstr == "--seed":
+                seed = int(value)
+            elif optstr == "-o" or optstr == "--output":
+                output_file = value
+            elif optstr == "-k" or optstr == "--keep":
+                keep_dir = value
+    except ValueError:
+        print >> sys.stderr, 'Incorrect value', value
+        sys.exit(2)
+
+    format_names = args
+    if format_names == []:
+        format_names = sorted(formats.keys())
+    incorrect = next((x for x in format_names if not x in formats), None)
+    if incorrect != None:
+        print >> sys.stderr, 'Unknown format', incorrect
+        sys.exit(2)
+
+    if keep_dir == None:
+        base_dir = tempfile.mkdtemp(prefix = 'benchmark')
+    else:
+        base_dir = keep_dir
+
+    print '%-14s %9s %9s %8s %11s %11s %8s' % \
+        ('format', 'lines', 'events', 'seconds', 'lines/s', 'events/s',
+         'RSS(MB)')
+    results = []
+    try:
+        for format_name in format_names:
+            directory = os.path.join(base_dir, format_name)
+            os.makedirs(directory)
+            result = run(format_name, directory, lines, users, seed, jobs)
+            results.append(result)
+            print '%-14s %9d %9d %8.2f %11.0f %11.0f %8.1f' % \
+                (format_name, result['lines'], result['events'],
+                 result['seconds'], result['lines_per_second'],
+                 result['events_per_second'], result['peak_rss_mb'])
+            sys.stdout.flush()
+    finally:
+        if keep_dir == None:
+            shutil.rmtree(base_dir)
+
+    if output_file != None:
+        data_out = codecs.open(output_file, 'w', 'utf-8')
+        json.dump({'lines': lines, 'users': users, 'jobs': jobs,
+                   'seed': seed, 'results': results}, data_out, indent = 2)
+        data_out.close()
+
+# Execution as script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Continuous execution of the rules (update_events --daemon). The rules are
+# executed in cycles. After each cycle the buffered events are written and the
+# process waits until:
+#
+# - A file matching the "files" variable of a rule is modified (only if
+#   pyinotify is available). The rules with files modified are executed.
+#
+# - The interval expires. All the rules are executed (without pyinotify, this
+#   is the only way to detect modifications).
+#
+# Since the files are processed from the offset recorded in detect_new_files
+# (see pipeline), each cycle only processes the data appended to the files, for
+# which the file_modification_cache must be enabled.
+#
+# SIGHUP reloads the configuration, SIGTERM and SIGINT terminate the process
+# after the current cycle.
+#
+import sys, locale, codecs, os, glob, fnmatch, signal, time
+
+import rule_manager, detect_new_files, event_output, pipeline, parallel
+import metrics
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Seconds between two executions of all the rules
+interval = 5
+
+# Flags set by the signal handlers
+reload_requested = False
+stop_requested = False
+
+def request_reload(signum, frame):
+    """
+    Handler of SIGHUP
+    """
+    global reload_requested
+    reload_requested = True
+
+def request_stop(signum, frame):
+    """
+    Handler of SIGTERM and SIGINT
+    """
+    global stop_requested
+    stop_requested = True
+
+def watched_directories(rules):
+    """
+    Given a list of rules, return a dictionary with pairs directory: [(pattern,
+    module_name), ...] with the directories containing the files of the rules
+    (the patterns are those in their "files" variable).
+    """
+
+    result = {}
+    for module_name in rules:
+        if not module_name.split('.')[0] in parallel.file_modules:
+            continue
+
+        for pattern in rule_manager.get_property(None, module_name,
+                                                 'files').split():
+            pattern = os.path.abspath(pattern)
+            for directory in glob.glob(os.path.dirname(pattern)):
+                result.setdefault(directory, []).append((pattern, module_name))
+    return result
+
+class Watcher(object):
+    """
+    Notification of the modifications in the files of the rules through
+    inotify. Without pyinotify, no modification is ever notified.
+    """
+
+    def __init__(self):
+        self.directories = {}
+        self.modified = set()
+        self.manager = None
+        self.notifier = None
+        if pyinotify == None:
+            print >> sys.stderr, 'pyinotify not available. Polling every',
+            print >> sys.stderr, interval, 'seconds'
+            return
+
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.process_event)
+
+    def update(self, rules):
+        """
+        Watch the directories with files of the given rules (new directories
+        matching the patterns may appear at any time).
+        """
+
+        directories = watched_directories(rules)
+        if self.manager != None:
+            mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | \
+                pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+            for directory in set(directories) - set(self.directories):
+                self.manager.add_watch(directory, mask)
+        self.directories = directories
+
+    def process_event(self, event):
+        """
+        Register the rules with a pattern matching the modified file (other
+        files in the directories, such as the output, are ignored).
+        """
+
+        for (pattern, module_name) in self.directories.get(event.path, []):
+            if fnmatch.fnmatch(event.pathname, pattern):
+                self.modified.add(module_name)
+
+    def wait(self, timeout):
+        """
+        Wait until a file of a rule is modified, a signal is received, or the
+        timeout (in seconds) expires. Returns the set of rules with files
+        modified, or None if the timeout expired.
+        """
+
+        deadline = time.time() + timeout
+        while not (stop_requested or reload_requested):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+
+            # Wait in steps of at most one second to attend the signals
+            if self.notifier == None:
+                time.sleep(min(remaining, 1))
+                continue
+
+            if not self.notifier.check_events(int(min(remaining, 1) * 1000)):
+                continue
+
+            self.notifier.read_events()
+            self.notifier.process_events()
+            if self.modified != set():
+                result = self.modified
+                self.modified = set()
+                return result
+
+        return set()
+
+    def close(self):
+        """
+        Release the inotify resources
+        """
+
+        if self.notifier != None:
+            self.notifier.stop()
+            self.notifier = None
+            self.manager = None
+
+def run(load_rules, execute_rules):
+    """
+    Execute the rules continuously until SIGTERM or SIGINT is received.
+    load_rules() is a function loading the configuration and returning the list
+    of rules (invoked again when SIGHUP is received), and
+    execute_rules(rules) a function executing the given rules.
+    """
+
+    global interval
+    global reload_requested
+    global stop_requested
+
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    # The last line of a file may be still being written
+    pipeline.complete_lines = True
+
+    rules = load_rules()
+    if detect_new_files.file_data == None:
+        print >> sys.stderr, 'WARNING: No file_modification_cache given.',
+        print >> sys.stderr, 'All the files are processed in every cycle.'
+
+    watcher = Watcher()
+    watcher.update(rules)
+    pending = rules
+    while not stop_requested:
+        if reload_requested:
+            reload_requested = False
+            print >> sys.stderr, '### Reloading configuration'
+            event_output.append_output = True
+            rules = load_rules()
+            watcher.close()
+            watcher = Watcher()
+            watcher.update(rules)
+            pending = rules
+
+        # Execute the rules in the order of the configuration
+        execute_rules([x for x in rules if x in pending])
+
+        # Make the events and the positions in the files durable
+        event_output.flush()
+        detect_new_files.save_file_data()
+        metrics.write_reports()
+
+        modified = watcher.wait(interval)
+        if modified == None:
+            # Timeout, all the rules are executed, watch new directories
+            pending = rules
+            watcher.update(rules)
+        else:
+            pending = modified
+
+    watcher.close()
+    print >> sys.stderr, '### Terminating'
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Detection of events already written in previous executions (for example,
+# when processing overlapping copies of the same log). Each event is
+# identified by its digest (see event_record.Event.digest). The digests of the
+# events written are stored in two files:
+#
+# - FILE.bloom: Bloom filter with a fixed number of bits (the memory budget),
+#   memory-mapped. An event whose digest is not in the filter is new.
+#
+# - FILE.db: SQLite database with all the digests, queried only when the filter
+#   gives a positive (which may be false), so that only exact duplicates are
+#   dropped.
+#
+# The new digests are inserted in the database in a transaction committed by
+# commit, which must be invoked after the events have been written (see
+# event_output.flush), so that the events lost in an abrupt termination are not
+# considered duplicates in the next execution. The Bloom filter is marked as
+# dirty while open, and rebuilt from the database if the previous execution did
+# not close it (or if its size or number of hashes changed).
+#
+import sys, locale, codecs, os, mmap, struct, sqlite3
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Header of the Bloom filter file: magic, number of bits, number of hashes and
+# clean flag (the bits start at header_size)
+header_format = '<8sQII'
+header_size = 64
+magic = 'PLABLOOM'
+
+# Number of digests inserted in the database in a single statement
+insert_batch = 10000
+
+class BloomFilter(object):
+    """
+    Bloom filter stored in a memory-mapped file. The positions of an item are
+    obtained from its digest (at least 16 bytes) with double hashing.
+    """
+
+    def __init__(self, file_name, bits, hashes):
+        self.file_name = file_name
+        self.bits = bits
+        self.hashes = hashes
+        self.valid = False
+
+        size = header_size + (bits + 7) // 8
+        if os.path.exists(file_name) and os.path.getsize(file_name) == size:
+            data_in = open(file_name, 'rb')
+            (file_magic, file_bits, file_hashes, clean) = \
+                struct.unpack(header_format, data_in.read(24))
+            data_in.close()
+            self.valid = file_magic == magic and file_bits == bits and \
+                file_hashes == hashes and clean == 1
+
+        if not self.valid:
+            # Create the file with all the bits to zero
+            data_out = open(file_name, 'wb')
+            data_out.truncate(size)
+            data_out.close()
+
+        self.file = open(file_name, 'r+b')
+        self.data = mmap.mmap(self.file.fileno(), size)
+        self.set_clean(False)
+
+    def set_clean(self, clean):
+        """
+        Write the header with the given clean flag
+        """
+        self.data[0:24] = struct.pack(header_format, magic, self.bits,
+                                      self.hashes, int(clean))
+
+    def positions(self, digest):
+        """
+        Bit positions of the digest
+        """
+
+        (first, second) = struct.unpack_from('<QQ', digest)
+        bits = self.bits
+        return [(first + x * second) % bits for x in xrange(self.hashes)]
+
+    def __contains__(self, digest):
+        data = self.data
+        for position in self.positions(digest):
+            if not ord(data[header_size + (position >> 3)]) & \
+                    (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, digest):
+        data = self.data
+        for position in self.positions(digest):
+            index = header_size + (position >> 3)
+            data[index] = chr(ord(data[index]) | (1 << (position & 7)))
+
+    def close(self):
+        """
+        Write the filter and mark it as clean
+        """
+
+        self.data.flush()
+        self.set_clean(True)
+        self.data.close()
+        self.file.close()
+
+class DedupIndex(object):
+    """
+    Set of digests of the events written (see the top of the module)
+    """
+
+    def __init__(self, file_name, memory, hashes):
+        self.connection = sqlite3.connect(file_name + '.db', timeout = 60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # The table has no rowid (the digest is the only key, and the table
+        # is smaller) if SQLite supports it (3.8.2 and later)
+        table_options = ''
+        if sqlite3.sqlite_version_info >= (3, 8, 2):
+            table_options = ' WITHOUT ROWID'
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS digests '
+                                    '(digest BLOB PRIMARY KEY)' +
+                                    table_options)
+
+        self.bloom = BloomFilter(file_name + '.bloom', memory * 8 * 1048576,
+                                 hashes)
+        if not self.bloom.valid:
+            self.rebuild()
+
+        # Digests inserted in the current transaction
+        self.pending = set()
+
+    def rebuild(self):
+        """
+        Add to the Bloom filter all the digests in the database
+        """
+
+        count = 0
+        add = self.bloom.add
+        for (digest,) in self.connection.execute('SELECT digest FROM digests'):
+            add(str(digest))
+            count += 1
+
+        if count != 0:
+            print >> sys.stderr, 'Rebuilt', self.bloom.file_name, 'with',
+            print >> sys.stderr, count, 'events'
+
+    def is_duplicate(self, digest):
+        """
+        Check if the digest was already added. If not, add it.
+        """
+
+        if digest in self.bloom:
+            if digest in self.pending:
+                return True
+            if self.connection.execute('''SELECT 1 FROM digests
+                                          WHERE digest = ?''',
+                                       (buffer(digest),)).fetchone() != None:
+                return True
+        else:
+            self.bloom.add(digest)
+
+        self.pending.add(digest)
+        if len(self.pending) >= insert_batch:
+            self.insert_pending()
+        return False
+
+    def select(self, events):
+        """
+        Return the list of events not added before, and add them
+        """
+        return [x for x in events if not self.is_duplicate(x.digest())]
+
+    def insert_pending(self):
+        """
+        Insert the pending digests (in the current transaction)
+        """
+
+        self.connection.executemany('''INSERT OR IGNORE INTO digests
+                                       VALUES (?)''',
+                                    [(buffer(x),) for x in self.pending])
+        self.pending = set()
+
+    def commit(self):
+        """
+        Make the digests added so far permanent
+        """
+
+        self.insert_pending()
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+        self.bloom.close()
@@ -32,8 +32,17 @@
 # 
 # Additionally, the file returns a tuple with additional values stored for the
 # file that might be used for other purposes.
+#
+# The information is stored in a SQLite database (see FileStore). Files in the
+# CSV format of previous versions are imported.
+#
+# For files that only grow (logs), the position up to which the file was
+# processed can be stored as part of these values (see file_position). It
+# contains the device and inode of the file, the byte offset, and a checksum of
+# the bytes preceding the offset, thus the processing may resume at the offset
+# unless the file was replaced (rotated) or truncated (see resume_offset).
 
-import sys, locale, codecs, getopt, os, atexit
+import sys, locale, codecs, getopt, os, atexit, hashlib, sqlite3
 
 # Fix the output encoding when redirecting stdout
 if sys.stdout.encoding is None:
@@ -43,30 +52,185 @@ if sys.stdout.encoding is None:
         # sw will encode Unicode data to the locale-specific character set.
         sys.stdout = sw(sys.stdout)
 
-file_data = None # Dictionary to store pairs filename: (modification time, other
-                 # data, ...)
+file_data = None # FileStore (or dictionary) to store pairs filename:
+                 # (modification time, other data, ...)
 
-persistent_file_name = None # File where to store the dictionary upon exit
+persistent_file_name = None # File where the data is stored
 
 minimum_difference = 0.005 # Minimum value for the difference to rule as modified
 
+checksum_size = 4096 # Bytes preceding the offset included in the checksum
+
+class FileStore(object):
+    """
+    Dictionary with pairs filename: (modification time, other data, ...)
+    stored in a SQLite database (in WAL mode). Each modification is committed
+    in its own transaction, thus the data survives an abrupt termination. The
+    file names have the form module_name//path, and the module name is stored
+    in its own indexed column to obtain the files of a module.
+
+    The connection is not shared with the processes created with fork, they
+    open their own connection. A process may defer the modifications (see
+    defer), to pass them to another process instead of storing them.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.deferred = None
+        self.pid = None
+        self.connection = None
+        # Connections inherited from the parent process. They are never used
+        # or closed (closing them might checkpoint the parent WAL).
+        self.inherited = []
+        self.connect()
+
+    def connect(self):
+        """
+        Open the connection of the current process and create the table
+        """
+
+        if self.connection != None:
+            self.inherited.append(self.connection)
+
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(self.file_name, timeout = 60)
+        self.connection.text_factory = unicode
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS files 
+                                       (name TEXT PRIMARY KEY, 
+                                        module TEXT, 
+                                        mtime REAL, 
+                                        data TEXT)''')
+            self.connection.execute('''CREATE INDEX IF NOT EXISTS 
+                                       files_module ON files (module)''')
+
+    def cursor(self):
+        """
+        Connection of the current process
+        """
+
+        if self.pid != os.getpid():
+            self.connect()
+        return self.connection
+
+    @staticmethod
+    def value(row):
+        """
+        Translate a row (mtime, data) into the tuple stored in the dictionary
+        """
+
+        if row[1] == '':
+            return (row[0],)
+        return tuple([row[0]] + row[1].split(','))
+
+    def get(self, key, default = None):
+        if self.deferred != None and key in self.deferred:
+            return self.deferred[key]
+
+        row = self.cursor().execute('SELECT mtime, data FROM files '
+                                    'WHERE name = ?', (key,)).fetchone()
+        if row == None:
+            return default
+        return FileStore.value(row)
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result == None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        return self.get(key) != None
+
+    def __setitem__(self, key, value):
+        if self.deferred != None:
+            self.deferred[key] = value
+            return
+        self.update({key: value})
+
+    def __len__(self):
+        return self.cursor().execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def update(self, pairs):
+        """
+        Store the given dictionary in a single transaction
+        """
+
+        if self.deferred != None:
+            self.deferred.update(pairs)
+            return
+
+        connection = self.cursor()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO files '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(k, k.split('//')[0], float(v[0]),
+                                     ','.join([unicode(x) for x in v[1:]]))
+                                    for (k, v) in pairs.items()])
+
+    def items(self):
+        result = [(x[0], FileStore.value(x[1:])) for x in \
+                      self.cursor().execute('SELECT name, mtime, data '
+                                            'FROM files')]
+        if self.deferred != None:
+            result = dict(result)
+            result.update(self.deferred)
+            result = result.items()
+        return result
+
+    def module_items(self, module_name):
+        """
+        Dictionary with the pairs stored for the files of the given module
+        """
+
+        result = dict([(x[0], FileStore.value(x[1:])) for x in \
+                           self.cursor().execute('SELECT name, mtime, data '
+                                                 'FROM files '
+                                                 'WHERE module = ?',
+                                                 (module_name,))])
+        if self.deferred != None:
+            result.update([(k, v) for (k, v) in self.deferred.items()
+                           if k.split('//')[0] == module_name])
+        return result
+
+    def defer(self):
+        """
+        Keep the following modifications in memory instead of storing them
+        """
+        self.deferred = {}
+
+    def take_deferred(self):
+        """
+        Return the dictionary with the modifications deferred and reset it
+        """
+
+        result = self.deferred
+        self.deferred = {}
+        return result
+
+    def commit(self):
+        """
+        Commit the pending modifications (if any)
+        """
+        if self.pid == os.getpid():
+            self.connection.commit()
+
 def save_file_data():
     """
-    Save the information in the global file_data to the persistent_file_name
+    Make sure the information in the global file_data is stored in the
+    persistent_file_name (the modifications are stored when they are made)
     """
 
     global file_data
     global persistent_file_name
     
     # If no persisten file given, nothing to do
-    if persistent_file_name == None or file_data == None:
+    if persistent_file_name == None or not isinstance(file_data, FileStore):
         return
 
-    data_out = codecs.open(persistent_file_name, 'w', 'utf-8')
-    for k, v in file_data.items():
-        print >> data_out, k + ',' + ','.join(map(lambda x: str(x), list(v)))
-
-    data_out.close()
+    file_data.commit()
     return
 
 #
@@ -74,11 +238,41 @@ def save_file_data():
 #
 atexit.register(save_file_data);
 
+def import_csv(file_name):
+    """
+    Read a file in the format used by previous versions (CSV lines with the
+    file name, modification time and other data) and return the dictionary
+    with its content.
+    """
+
+    result = {}
+    data_in = codecs.open(file_name, 'r', 'utf-8')
+    for line in data_in:
+        # Ignore comments
+        if line[0] == '#':
+            continue
+        line = line[:-1]
+
+        fields = line.split(',')
+
+        last_modification = float(fields[1])
+        
+        # Insert it in the global dictionary
+        annotation = fields[2:]
+        annotation.insert(0, last_modification)
+        result[fields[0]] = tuple(annotation)
+    data_in.close()
+
+    return result
+
 def initialize(file_name, create = None):
     """
     Loads the information contained in the given file name as the initial values
     of the file detection mechanism. If the file does not exist and create is
     True, the file is then created. If not, an exception is produced.
+
+    If the file is in the CSV format of previous versions, its content is
+    imported and the file is renamed with the suffix .bak.
     """
     
     global file_data
@@ -88,31 +282,28 @@ def initialize(file_name, create = None):
 	return
 
     persistent_file_name = file_name
-    file_data = {}
 
     # If file does not exist, either create or raise exception
-    if not os.path.exists(file_name):
-        if create == True:
-            data_out = codecs.open(file_name, 'w', 'utf-8')
-            data_out.close()
-            return
+    if not os.path.exists(file_name) and create != True:
         raise ValueError('File ', file_name, ' not found and not allowed to create')
 
-    data_in = codecs.open(file_name, 'r', 'utf-8')
-    for line in data_in:
-        # Ignore comments
-        if line[0] == '#':
-            continue
-        line = line[:-1]
-
-        fields = line.split(',')
-
-        last_modification = float(fields[1])
-        
-        # Insert it in the global dictionary
-        annotation = fields[2:]
-        annotation.insert(0, last_modification)
-        file_data[fields[0]] = tuple(annotation)
+    # Detect the files in CSV format
+    previous_data = None
+    if os.path.exists(file_name):
+        data_in = open(file_name, 'rb')
+        header = data_in.read(16)
+        data_in.close()
+        if header != 'SQLite format 3\x00' and header != '':
+            previous_data = import_csv(file_name)
+            os.rename(file_name, file_name + '.bak')
+            print >> sys.stderr, 'Importing', file_name, '(previous content',
+            print >> sys.stderr, 'in', file_name + '.bak)'
+        elif header == '':
+            os.remove(file_name)
+
+    file_data = FileStore(file_name)
+    if previous_data != None:
+        file_data.update(previous_data)
         
     return file_data
 
@@ -149,10 +340,12 @@ def needs_processing(data, file_name):
     # If file_data not present, or file exists but older, it was modified.
     return fdata
 
-def update(data, file_name, other_data = None):
+def update(data, file_name, other_data = None, modification_time = None):
     """
     Given a dictionary and a file name, update the modification time and the
-    given file data
+    given file data. If a modification time is given, it is stored instead of
+    the one of the file (a value of zero forces the file to be processed
+    again).
     """
     
     global file_data
@@ -168,8 +361,65 @@ def update(data, file_name, other_data = None):
         other_data = []
 
     # Update the mtime
-    other_data.insert(0, os.path.getmtime(file_name.split('//')[1]))
+    if modification_time == None:
+        modification_time = os.path.getmtime(file_name.split('//')[1])
+    other_data.insert(0, modification_time)
     data[file_name] = tuple(other_data)
 
     return
 
+def file_position(file_name, offset):
+    """
+    Given a file name and a byte offset, return the list 
+
+    [device, inode, offset, checksum]
+
+    to be stored as part of the file data, where checksum is the MD5 of the
+    checksum_size bytes preceding the offset.
+    """
+
+    global checksum_size
+
+    stat = os.stat(file_name)
+    start = max(offset - checksum_size, 0)
+
+    data_in = open(file_name, 'rb')
+    data_in.seek(start)
+    checksum = hashlib.md5(data_in.read(offset - start)).hexdigest()
+    data_in.close()
+
+    return [stat.st_dev, stat.st_ino, offset, checksum]
+
+def resume_offset(file_name, position):
+    """
+    Given a file name and the list [device, inode, offset, checksum] returned
+    by file_position (or read from the persistent file), return the offset at
+    which the processing of the file can resume. Returns zero if there is no
+    position or the file was replaced or truncated.
+    """
+
+    if len(position) < 4:
+        return 0
+
+    try:
+        (device, inode, offset) = [int(x) for x in position[0:3]]
+    except (TypeError, ValueError):
+        return 0
+
+    if offset == 0:
+        return 0
+
+    stat = os.stat(file_name)
+    if stat.st_dev != device or stat.st_ino != inode:
+        print >> sys.stderr, 'File', file_name, 'replaced.',
+        print >> sys.stderr, 'Processing from the beginning'
+        return 0
+
+    if stat.st_size < offset or \
+            file_position(file_name, offset)[3] != position[3]:
+        print >> sys.stderr, 'File', file_name, 'truncated or rewritten.',
+        print >> sys.stderr, 'Processing from the beginning'
+        return 0
+
+    return offset
+
@@ -6,8 +6,7 @@
 # 
 import sys, locale, codecs, getopt, os, glob, re, datetime
 
-import detect_new_files, rules_common, rule_manager, event_output, anonymize
-import process_filters
+import rule_manager, process_filters, pipeline, event_record, timestamps
 
 #
 # See update_events and event_output for the structure of the events
@@ -34,6 +33,7 @@ config_params = {
     'files': '',               # Files to process
     'filter_file': '',         # File containing a function to filter events
     'filter_function': '',     # Function to use to filter
+    'filter': '',              # Declarative filter (see filter_expr)
     'remap_pairs': '',         # Comma separated list of pairs regexp, label to
                                # group the events by blocks.
     'mark_word': '_bogus.html' # Mark used to detect URL in logs
@@ -110,105 +110,68 @@ def execute(module_name):
             
     """
 
-    global clf_re
     global filter_function
     global remap_pairs
 
-    # Get the window date to process events
-    (from_date, until_date) = rules_common.window_dates(module_name)
-
-    # Get the files to process, lines and mark lines
-    (files, total_lines, mark_lines) = \
-        rules_common.files_to_process(module_name)
-
     # Get the remap_pairs evaluated from the options
     remap_pairs = eval('[' + rule_manager.get_property(None, module_name,
                                                        'remap_pairs') + \
                            ']')
     remap_pairs = [(re.compile(x), y) for (x, y) in remap_pairs]
 
-    # Fetch the word to detect an embeddedq to use it later
-    mark_word = rule_manager.get_property(None, module_name, 'mark_word')
-
-    # Loop over all the given args
-    total_counter = 0
-    for file_annotation in files:
-        # Get the file name and (if it exists, the date of the last event)
-        filename = file_annotation[0]
-        last_event = datetime.datetime.min
-        if len(file_annotation[1]) != 0:
-            last_event = datetime.datetime.strptime(file_annotation[1][0], 
-                                                        '%Y-%m-%d %H:%M:%S')
-        new_last_event = last_event
-
-        data_in = codecs.open(filename, 'r', encoding = 'utf8', 
-                              errors = 'replace')
-        old = ''
-        counter = 0
-        for line in data_in:
-
-            counter += 1
-            total_counter += 1
-            
-            if total_counter % mark_lines == 0:
-                print >> sys.stderr, '+',
-                sys.stderr.flush()
-
-            line = line[:-1]
-            
-            fields = clf_re.match(line).groups()
+    pipeline.run(module_name, parse_file, filter_function, prefilter = True)
 
-            if fields[2] == '':
-                raise ValueError('Empty string' + line)
+def parse_file(context, lines):
+    """
+    Generator parsing the lines of an Apache log and producing the events of
+    the embedded questions (see pipeline)
+    """
 
-            # Translate date time of the event
-            dtime = datetime.datetime.strptime(fields[3].strip()[:-6], 
-                                               '%d/%b/%Y:%H:%M:%S')
+    global clf_re
 
-            if dtime <= last_event:
-                # Event is older than what has been recorded in the
-                # detect_new_files. skip
-                continue
+    # Fetch the word to detect an embeddedq to use it later
+    mark_word = rule_manager.get_property(None, context.module_name, 
+                                          'mark_word')
 
-            if dtime < from_date or dtime > until_date:
-                # Ignore event because it is outside the given window
-                continue
+    for line in lines:
+        line = line[:-1]
             
-            # Split the url to match and see if it has the mark word
-            (method, url, protocol) = fields[4].split()
+        fields = clf_re.match(line).groups()
 
-            # Only 404 that have the mark word substring are accepted
-            if fields[5] != '404' or url.find(mark_word) == -1:
-                continue
+        if fields[2] == '':
+            raise ValueError('Empty string' + line)
 
-            # If there is a filter function and returns None, skip this event
-            if filter_function != None and filter_function(fields) == None:
-                continue
+        # Split the url to match and see if it has the mark word
+        request = fields[4].split()
+        if len(request) != 3:
+            continue
+        url = request[1]
 
-            # Record the event with the highest datetime.
-            if dtime > new_last_event:
-                new_last_event = dtime
+        # Only 404 that have the mark word substring are accepted
+        if fields[5] != '404' or url.find(mark_word) == -1:
+            continue
 
-            # At this point we have an event of an embedded question.
+        if not context.accept(fields):
+            continue
 
-            event_pairs = process_log_line(url, mark_word)
-            
-            for (event_suffix, question_id) in event_pairs:
-                event = ('embedded_question_' + event_suffix, 
-                         dtime,
-                         anonymize.find_or_encode_string(fields[2]),
-                         [('application', 'unknown'), 
-                          ('url', url),
-                          ('ip', fields[0]),
-                          ('question_id', question_id)])
-                
-                event_output.out(event)
+        # Translate date time of the event
+        dtime = timestamps.parse_clf(fields[3].strip()[:-6])
 
-        data_in.close()
-        detect_new_files.update(None, module_name + '//' + filename, 
-                                [new_last_event])
+        # At this point we have an event of an embedded question.
 
-    print >> sys.stderr
+        event_pairs = process_log_line(url, mark_word)
+            
+        for (event_suffix, question_id) in event_pairs:
+            event = event_record.Event('embedded_question_' + 
+                                       event_suffix, 
+                                       dtime,
+                                       fields[2],
+                                       [('application', 'unknown'), 
+                                        ('url', url),
+                                        ('ip', fields[0]),
+                                        ('question_id', question_id)])
+                
+            yield (dtime, fields, event)
 
 def process_log_line(url_body, mark_word):
     """
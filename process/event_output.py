@@ -3,16 +3,49 @@
 #
 # Module to dump events in different formats. 
 #
-# The events are received as tuples with the following structure:
+# The events are received as event_record.Event objects with the fields:
 #
-# (name, datetime, user, [(key1, value1), (key2, value2), ...])
+# name, datetime, user, keys (key1, key2, ...), values (value1, value2, ...)
 #
 #    datetime is a datetime object, the rest strings.
 #
+# The events can be written to several outputs (sinks) in the same execution.
+# The option "sinks" of this rule is a list of rules (event_output.name) each
+# of them with the settings of one output (format, file, DB, exclude_users,
+# buffer_size, threaded), for example:
+#
+#   [event_output]
+#   sinks = event_output.csv event_output.mongo
+#
+#   [event_output.csv]
+#   format = CSV
+#   output_file = events.csv
+#
+#   [event_output.mongo]
+#   format = mongo
+#   db_name = pla
+#   threaded = yes
+#
+# The options not given in a sink are taken from event_output. If no sinks
+# are given, the events are written to a single output with the settings of
+# event_output. Each sink has its own buffer, and with threaded, its own
+# writer thread.
+#
+# If dedup_file is given, the events already written in previous executions
+# (identical in all their fields) are dropped before reaching the sinks (see
+# dedup). Only the events written by some sink (see EventSink.accepts) are
+# recorded as written.
+#
+# If time_order is "yes", the events are given to the sinks sorted by time
+# when the output is flushed (at the end of the execution, or after each cycle
+# in daemon mode), see time_order.
+#
 # Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
 import sys, locale, codecs, getopt, os, anonymize, mysql, datetime, hashlib
+import atexit, threading, Queue, gzip, json, urllib
 
-import rule_manager, rules_common, mongodb
+import rule_manager, rules_common, mongodb, metrics, event_store, dedup
+import time_order, ordereddict
 
 # Fix the output encoding when redirecting stdout
 if sys.stdout.encoding is None:
@@ -31,31 +64,73 @@ module_prefix = 'event_output'
 # Configuration parameters for this module
 #
 config_params = {
-    'format': 'CSV',      # Format to dump the output.
-                          # One of: "CSV", "mongo"
+    'format': 'CSV',       # Format to dump the output. One of: "CSV",
+                           # "mongo", "segment", "partitioned"
     # These parameters apply only to the CSV format
-    'print_ordinal': '',  # Print ordinal as first column in CSV
-    'output_file': '',    # File to write in CSV format
+    'print_ordinal': '',   # Print ordinal as first column in CSV
+    'output_file': '',     # File to write in CSV format
     # These parameter apply only to the DB format
-    'db_host': '',        # Data base connection parameters
+    'db_host': '',         # Data base connection parameters
     'db_user': '',
     'db_passwd': '',
     'db_name': '',
+    'db_batch_size': '1000', # Documents written in a single operation
+    'db_write_concern': '1', # Nodes acknowledging the writes (or "majority")
+    'db_upsert': '',       # "yes" to give the events an _id derived from
+                           # their content and skip those already stored
+    # These parameters apply only to the segment format (see event_store)
+    'segment_dir': '',     # Directory where to write the segments
+    'segment_events': '100000', # Maximum number of events in a segment
+    # These parameters apply only to the partitioned format
+    'partition_dir': '',   # Directory with the partitions
+    'partition_by': 'type date', # Fields defining the partitions (type,
+                           # date, user)
+    'partition_size': '64',# Maximum size of a part (MB, uncompressed)
     # These parameters apply to any format
-    'exclude_users': ''   # Comma separated list of user ids to exclude
+    'exclude_users': '',   # Comma separated list of user ids to exclude
+    'buffer_size': '1000', # Number of events written in a single operation
+    'threaded': '',        # "yes" to write the events in a separate thread
+    'dedup_file': '',      # Files (.bloom and .db) with the events written
+    'dedup_memory': '64',  # Size of the Bloom filter of dedup_file (MB)
+    'dedup_hashes': '7',   # Number of hashes of the Bloom filter
+    'time_order': '',      # "yes" to write the events sorted by time
+    'reorder_buffer': '1000', # Events reordered within each file
+    'time_order_dir': '',  # Directory for the temporary files of time_order
+    'sinks': ''            # Rules with the settings of each output (see above)
 }
 
-event_counter = 0 # Number of events processed
+debug = 0
 
-output_file = None
+# Objects receiving the events (see class EventSink)
+sinks = []
 
-debug = 0
+# Maximum number of batches waiting to be written by the thread of a sink
+queue_batches = 8
+
+# Index of the events written (dedup.DedupIndex) to drop duplicates
+dedup_index = None
+
+# Events pending to be written in time order (time_order.TimeOrder)
+ordered_events = None
 
-output_format = None
+# Columns of the CSV format (see csv_fields)
+csv_header = ['datetime', 'type', 'user', 'application', 'invocation', 'aux1',
+              'aux2']
 
-print_ordinal = False
+# Maximum number of parts open at the same time by PartitionedSink
+max_open_parts = 64
 
-exclude_users = set([])
+# When not None, the events are appended to this object (with the methods
+# append, extend and flush of parallel.EventSpool) instead of being dumped
+# (used by the worker processes in parallel executions)
+captured_events = None
+
+# Functions invoked once the events given so far are written (see after_flush)
+pending_commits = []
+
+# If True, the events are appended to an existing output file instead of
+# replacing it (used when the configuration is reloaded, see daemon)
+append_output = False
 
 # csv_hash = set([])
 
@@ -65,29 +140,68 @@ def initialize(module_name):
     """
 
     global debug
-    global output_format
-    global exclude_users
+    global sinks
+    global dedup_index
+    global ordered_events
+
+    # The rules with the settings of a sink are initialized by event_output
+    if module_name != module_prefix:
+        return
 
     # Get the level of debug
     debug = int(rule_manager.get_property(None, module_name, 'debug'))
 
-    # Fetch format
-    output_format = rule_manager.get_property(None, module_name, 'format')
-
-    # Create set of users to exclude
-    exclude_users = map(lambda x: anonymize.find_or_encode_string(x),
-                        set(rule_manager.get_property(None, module_prefix,
-                                                      'exclude_users').split(',')))
-
     # Make sure we initialize the anonymize features common to all methods
     anonymize.initialize()
 
-    if output_format == 'CSV':
-        init_csv(module_name)
-    elif output_format == 'mongo':
-        init_mongo_db(module_name)
+    sink_names = rule_manager.get_property(None, module_name, 'sinks').split()
+    if sink_names == []:
+        sink_names = [module_name]
+
+    if len([x for x in sink_names
+            if rule_manager.get_property(None, x, 'format') == 'mongo']) > 1:
+        print >> sys.stderr, 'Only one sink with format mongo is allowed'
+        sys.exit(1)
+
+    sinks = [create_sink(x) for x in sink_names]
+
+    dedup_file = rule_manager.get_property(None, module_name, 'dedup_file')
+    if dedup_file != '':
+        dedup_index = dedup.DedupIndex(dedup_file,
+            int(rule_manager.get_property(None, module_name, 'dedup_memory')),
+            int(rule_manager.get_property(None, module_name, 'dedup_hashes')))
+
+    if rule_manager.get_property(None, module_name, 'time_order') == 'yes':
+        ordered_events = time_order.TimeOrder(
+            int(rule_manager.get_property(None, module_name,
+                                          'reorder_buffer')),
+            rule_manager.get_property(None, module_name, 'time_order_dir'))
+
+    # Make sure the buffered events are written upon termination
+    atexit.register(close)
+
+def create_sink(module_name):
+    """
+    Create the sink with the settings of the given rule
+    """
+
+    output_format = rule_manager.get_property(None, module_name, 'format')
+    buffer_size = int(rule_manager.get_property(None, module_name,
+                                                'buffer_size'))
+
+    if output_format == 'mongo':
+        result = MongoSink(module_name, buffer_size)
+    elif output_format == 'segment':
+        result = SegmentSink(module_name, buffer_size)
+    elif output_format == 'partitioned':
+        result = PartitionedSink(module_name, buffer_size)
     else:
-        init_csv(module_name)
+        result = CSVSink(module_name, buffer_size)
+
+    if rule_manager.get_property(None, module_name, 'threaded') == 'yes':
+        result = ThreadedSink(result)
+
+    return result
 
 def execute(module_name):
     """
@@ -98,187 +212,746 @@ def execute(module_name):
 
 def out(event):
     """
-    Function that receives an event and dumps it depending on the value of the
-    global variable output_format.
+    Function that receives an event and passes it to the sinks.
 
+    The event is received as an event_record.Event (see the top of the module).
 
-    The event is received as a tuple with the following structure:
-    
-    (name, datetime, user, [(key1, value1), (key2, value2), ...]
-    
-    datetime is a datetime object, the rest strings.
+    """
+
+    global captured_events
+    global sinks
+    global dedup_index
+    global ordered_events
 
+    # Events are captured to be dumped by another process
+    if captured_events != None:
+        captured_events.append(event)
+        return
+
+    # The events filtered by all the sinks (excluded user or out of the
+    # window) are not written
+    if not reaches_sink(event):
+        metrics.count('events_excluded')
+        return
+
+    if dedup_index != None and dedup_index.is_duplicate(event.digest()):
+        metrics.count('events_duplicated')
+        return
+
+    metrics.count('events_written')
+    if ordered_events != None:
+        ordered_events.add([event])
+        return
+
+    for sink in sinks:
+        sink.write(event)
+
+def out_batch(events):
+    """
+    Function that receives a list of events and passes them to the sink in a
+    single operation. See function out.
     """
 
-    global module_prefix
-    global output_format
-    global exclude_users
+    global captured_events
+    global sinks
+    global dedup_index
+    global ordered_events
 
-    # Loop over all the events and print them
-    # for event in event_list:
-    #     print_event(event)
+    # Events are captured to be dumped by another process
+    if captured_events != None:
+        captured_events.extend(events)
+        return
 
-    # Filter those events that have a user in the exclude_users list
-    if event[2] in exclude_users:
+    selected = [x for x in events if reaches_sink(x)]
+    metrics.count('events_excluded', len(events) - len(selected))
+    events = selected
+    if dedup_index != None:
+        events = dedup_index.select(selected)
+        metrics.count('events_duplicated', len(selected) - len(events))
+
+    metrics.count('events_written', len(events))
+    if ordered_events != None:
+        ordered_events.add(events)
         return
 
-    if output_format == 'CSV':
-        out_csv(event)
-    elif output_format == 'mongo':
-        out_mongo_db(event)
-    else:
-        out_csv(event)
+    for sink in sinks:
+        sink.write_batch(events)
+
+def reaches_sink(event):
+    """
+    Check if some sink writes the event (it is not filtered by all of them)
+    """
+
+    for sink in sinks:
+        if sink.accepts(event):
+            return True
+    return False
+
+def after_flush(function):
+    """
+    Invoke the function (without parameters) once the events given so far have
+    been written, that is, at the end of the next flush or close. Used to
+    record that a file has been processed only when its events are durable.
+    When the events are captured (worker processes), the function is invoked
+    right away, the parent records the data after writing the events.
+    """
+
+    global pending_commits
+
+    if captured_events != None:
+        function()
+        return
+    pending_commits.append(function)
+
+def run_pending_commits():
+    """
+    Invoke the functions given to after_flush
+    """
+
+    global pending_commits
+
+    functions = pending_commits
+    pending_commits = []
+    for function in functions:
+        function()
 
 def flush():
     """
-    Make sure all the transactions have been executed
+    Make sure all the buffered events have been written
     """
 
-    global module_prefix
+    global sinks
+    global dedup_index
 
-    # Fetch format
-    output_format = rule_manager.get_property(None, module_prefix, 'format')
+    # The events captured are written by the parent process (the sinks and the
+    # dedup index belong to the parent), which flushes its output at the same
+    # points
+    if captured_events != None:
+        captured_events.flush()
+        return
 
-    if output_format == 'CSV':
-        flush_csv(event_list)
-    elif output_format == 'mongo':
-        flush_mongo_db(event_list)
-    else:
-        flush_csv(event_list)
+    write_ordered()
 
-################################################################################
+    for sink in sinks:
+        sink.flush()
 
-def init_csv(module_name):
+    # The events are considered written once in the sinks
+    if dedup_index != None:
+        dedup_index.commit()
+
+    run_pending_commits()
+
+def close():
     """
-    Initalize the dump procedure in CSV format.
+    Write the buffered events and release the resources of the sink. The
+    function can be invoked more than once.
     """
 
-    global config_parmas
-    global output_file
-    # global csv_hash
-    global print_ordinal
+    global sinks
+    global dedup_index
+    global ordered_events
 
-    # Reset the set of hashes
-    # csv_hash = set([])
+    write_ordered()
 
-    # Set the output_file
-    if rule_manager.get_property(None, module_name, 'output_file') == '':
-        output_file = sys.stdout
-    else:
-        output_file = codecs.open(config_params['output_file'], 'w',
-                                  encoding = 'utf-8')
+    for sink in sinks:
+        sink.close()
+    sinks = []
 
-    # Create the header to print as first line
-    header = ["datetime", "type", "user", "application", "invocation",
-              "aux1", "aux2"]
+    if ordered_events != None:
+        ordered_events.close()
+        ordered_events = None
 
-    # See if the first column should include the ordinal
-    print_ordinal = rule_manager.get_property(None, module_name, \
-                                                  'print_ordinal') == 'yes'
-    if print_ordinal:
-        header.index(0, 'n')
+    if dedup_index != None:
+        dedup_index.close()
+        dedup_index = None
 
-    # Print the first line of the CSV with the column names
-    print >> output_file, ','.join(header)
+    run_pending_commits()
 
-def init_mongo_db(module_name):
+def write_ordered():
     """
-    Initialize the mongo db process
+    Give the events pending in time order to the sinks
     """
 
-    mongodb.connect(rule_manager.get_property(None, module_name, 'db_host'),
-                    rule_manager.get_property(None, module_name, 'db_user'),
-                    rule_manager.get_property(None, module_name, 'db_passwd'),
-                    rule_manager.get_property(None, module_name, 'db_name'))
+    global sinks
+    global ordered_events
 
+    if ordered_events == None or len(ordered_events) == 0:
+        return
+
+    batch = []
+    for event in ordered_events.merge():
+        batch.append(event)
+        if len(batch) >= time_order.run_batch_size:
+            for sink in sinks:
+                sink.write_batch(batch)
+            batch = []
+    for sink in sinks:
+        sink.write_batch(batch)
 
 ################################################################################
-def out_csv(event):
+
+class EventSink(object):
+    """
+    Base class for the objects writing events. The events of the users not in
+    exclude_users are accumulated in a buffer and written in batches of
+    buffer_size events through the method write_events that must be provided
+    by the subclasses.
     """
-    Dump the given data in CSV format. See function out
+
+    def __init__(self, module_name, buffer_size):
+        self.module_name = module_name
+        self.buffer_size = max(buffer_size, 1)
+        self.buffer = []
+
+        # Create set of users to exclude (once the anonymize map is loaded)
+        self.exclude_users = \
+            set(map(lambda x: anonymize.find_or_encode_string(x),
+                    rule_manager.get_property(None, module_name,
+                                              'exclude_users').split(',')))
+
+    def accepts(self, event):
+        """
+        Check if the event is written by this sink (its user is not in
+        exclude_users)
+        """
+        return not event.user in self.exclude_users
+
+    def write(self, event):
+        """
+        Add an event to the buffer and write the buffer if full
+        """
+
+        # Filter those events that have a user in the exclude_users list
+        if event.user in self.exclude_users:
+            return
+
+        self.buffer.append(event)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush_buffer()
+
+    def write_batch(self, events):
+        """
+        Add a list of events to the buffer and write the buffer if full
+        """
+
+        exclude_users = self.exclude_users
+        self.buffer.extend([x for x in events if not x.user in exclude_users])
+        if len(self.buffer) >= self.buffer_size:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        """
+        Write all the events in the buffer
+        """
+        if self.buffer == []:
+            return
+        events = self.buffer
+        self.buffer = []
+        self.write_events(events)
+
+    def flush(self):
+        """
+        Write all the events received so far
+        """
+        self.flush_buffer()
+
+    def close(self):
+        """
+        Write the pending events and release the resources
+        """
+        self.flush()
+
+    def write_events(self, events):
+        """
+        Write the list of events (event_record.Event) taken from the buffer.
+        Provided by the subclasses. It is invoked with events of users not in
+        exclude_users, and filters out any other event the sink does not take
+        (see accepts). The events must be written (or handed to another
+        object that writes them) when flush or close return.
+        """
+        return
+
+class CSVSink(EventSink):
+    """
+    Dump the events in CSV format:
 
     n,datetime,type,user,application,invocation,[opt1, opt2]
 
     """
 
-    global module_prefix
-    global event_counter
-    global output_file
-    # global csv_hash
-    global print_ordinal
+    def __init__(self, module_name, buffer_size):
+        EventSink.__init__(self, module_name, buffer_size)
 
-    # Get some global variables
-    if output_file == None:
-        output_file = sys.stdout
+        self.event_counter = 0 # Number of events processed
 
-    # Get the window date to process events
-    (from_date, until_date) = rules_common.window_dates(module_prefix)
+        # Reset the set of hashes
+        # csv_hash = set([])
 
-    # Chop event into pieces
-    (event_name, dt, user, other_keys) = event
+        # Set the output_file
+        file_name = rule_manager.get_property(None, module_name, 
+                                              'output_file')
+        print_header = True
+        if file_name == '':
+            self.output_file = sys.stdout
+        elif append_output and os.path.exists(file_name):
+            print_header = os.path.getsize(file_name) == 0
+            self.output_file = codecs.open(file_name, 'a', encoding = 'utf-8')
+        else:
+            self.output_file = codecs.open(file_name, 'w', encoding = 'utf-8')
 
-    if len(other_keys) > 4:
-        print >> sys.stderr, "Event longer than expected."
-        print >> sys.stderr, print_event(event)
-        sys.exit(1)
+        # Get the window date to process events
+        (self.from_date, self.until_date) = \
+            rules_common.window_dates(module_name)
 
-    # Calculate the event hash and see if it exists
-    # event_hash = hashlib.sha256(unicode(event).encode('utf-8')).hexdigest()
+        # Create the header to print as first line
+        header = list(csv_header)
 
-    # if event_hash in csv_hash:
-    #     # Event is already in the database, skip
-    #     return
-    # csv_hash.add(event_hash)
+        # See if the first column should include the ordinal
+        self.print_ordinal = \
+            rule_manager.get_property(None, module_name, 
+                                      'print_ordinal') == 'yes'
+        if self.print_ordinal:
+            header.insert(0, 'n')
 
-    # Ignore event because if outside the given window
-    if dt < from_date or dt > until_date:
-        return
+        # Print the first line of the CSV with the column names
+        if print_header:
+            print >> self.output_file, ','.join(header)
 
-    event_counter += 1
+    def accepts(self, event):
+        """
+        Check if the event is written by this sink (its user is not excluded
+        and its time is in the window given)
+        """
+        return EventSink.accepts(self, event) and \
+            self.from_date <= event.datetime <= self.until_date
 
-    # Create the event with the first three entities and add the rest
-    out_line = [unicode(dt), '"' + event_name + '"', '"' + user + '"']
+    def write_events(self, events):
+        out_lines = []
+        for event in events:
+            dt = event.datetime
 
-    # Put the event ordinal as the first column
-    if print_ordinal:
-        out_line.insert(0, unicode(event_counter))
+            if len(event.values) > 4:
+                print >> sys.stderr, "Event longer than expected."
+                print_event(event)
+                sys.exit(1)
 
-    # Attach any remaining entities
-    for entity in other_keys:
-        field = unicode(entity[1]).replace('"', '""')
-        out_line.append(u'"' + field.strip() + u'"')
+            # Calculate the event hash and see if it exists
+            # event_hash = hashlib.sha256(unicode(event).encode('utf-8')).hexdigest()
+
+            # if event_hash in csv_hash:
+            #     # Event is already in the database, skip
+            #     return
+            # csv_hash.add(event_hash)
 
-    # Dump the line
-    print >> output_file, ','.join(out_line)
+            # Ignore event because if outside the given window
+            if dt < self.from_date or dt > self.until_date:
+                continue
 
-def out_mongo_db(event):
+            self.event_counter += 1
+
+            out_line = csv_fields(event)
+
+            # Put the event ordinal as the first column
+            if self.print_ordinal:
+                out_line.insert(0, unicode(self.event_counter))
+
+            out_lines.append(','.join(out_line))
+
+        if out_lines == []:
+            return
+
+        # Dump the lines in a single write
+        self.output_file.write(u'\n'.join(out_lines) + u'\n')
+
+    def flush(self):
+        EventSink.flush(self)
+        self.output_file.flush()
+
+    def close(self):
+        self.flush()
+        if self.output_file != sys.stdout:
+            self.output_file.close()
+
+class PartitionedSink(EventSink):
     """
-    Save the given event in a mongoDB.
+    Dump the events in CSV format (see CSVSink) in gzip files in a directory
+    tree with a level for each of the fields in partition_by, for example
+
+      type=gcc/date=2012-03-04/part-00000.csv.gz
+
+    A part is closed when its uncompressed size reaches partition_size, and
+    the following events of the partition go to the next part. The parts stay
+    open until then (or until the sink is closed), across flushes.
+
+    Flushing the sink ends the gzip member being written in each open part
+    (the part is opened again to append a new member when more events
+    arrive), and writes the file manifest.json with the list of parts (path,
+    partition values, number of events, size, first and last datetime, and
+    whether the part is complete). The size is that of the members written
+    at the flush, thus the data of a part up to its size in the manifest is
+    always a valid gzip file, even if the part is still being written.
+
+    As in CSVSink, the events outside the window given by from_date and
+    until_date are ignored.
     """
 
-    global module_prefix
-    global event_counter
+    # Functions obtaining the value of each partition field
+    partition_fields = {'type': lambda x: x.name,
+                        'date': lambda x: x.datetime.date().isoformat(),
+                        'user': lambda x: x.user}
+
+    def __init__(self, module_name, buffer_size):
+        EventSink.__init__(self, module_name, buffer_size)
+
+        self.directory = rule_manager.get_property(None, module_name,
+                                                   'partition_dir')
+        if self.directory == '':
+            print >> sys.stderr, 'No partition_dir given in', module_name
+            sys.exit(1)
+
+        self.partition_by = rule_manager.get_property(None, module_name,
+                                                      'partition_by').split()
+        incorrect = [x for x in self.partition_by
+                     if not x in self.partition_fields]
+        if incorrect != []:
+            print >> sys.stderr, 'Incorrect partition_by field', incorrect[0]
+            sys.exit(1)
+        self.key_functions = [self.partition_fields[x]
+                              for x in self.partition_by]
+
+        self.part_size = int(float(rule_manager.get_property(None,
+            module_name, 'partition_size')) * 1048576)
+
+        # Get the window date to process events
+        (self.from_date, self.until_date) = \
+            rules_common.window_dates(module_name)
+
+        # Entries of the manifest of the closed parts (from previous executions
+        # too)
+        self.manifest_name = os.path.join(self.directory, 'manifest.json')
+        self.parts = []
+        if os.path.exists(self.manifest_name):
+            data_in = open(self.manifest_name, 'r')
+            self.parts = json.load(data_in)['parts']
+            data_in.close()
+
+        # Dictionary with pairs partition key: open part (see open_part), in
+        # the order in which they were last written (least recent first)
+        self.open_parts = ordereddict.OrderedDict()
+
+    def partition_path(self, key):
+        """
+        Directory of the partition with the given key
+        """
+
+        return os.path.join(self.directory,
+                            *[name + '=' + urllib.quote(value.encode('utf-8'),
+                                                        safe = '')
+                              for (name, value) in zip(self.partition_by,
+                                                       key)])
+
+    def open_part(self, key):
+        """
+        Open the next part of the partition with the given key
+        """
+
+        directory = self.partition_path(key)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        number = len([x for x in os.listdir(directory)
+                      if x.startswith('part-')])
+        file_name = os.path.join(directory, 'part-%05d.csv.gz' % number)
+        part = {'file': gzip.open(file_name, 'wb'), 'name': file_name,
+                'path': os.path.relpath(file_name, self.directory),
+                'partition': dict(zip(self.partition_by, key)),
+                'events': 0, 'size': 0, 'first': None, 'last': None}
+        part['file'].write((','.join(csv_header) + '\n').encode('utf-8'))
+
+        # Keep a bounded number of files open
+        if len(self.open_parts) >= max_open_parts:
+            self.close_part(iter(self.open_parts).next())
+        self.open_parts[key] = part
+        return part
+
+    def end_member(self, part):
+        """
+        Terminate the gzip member being written in the part, if any
+        """
+
+        if part['file'] != None:
+            part['file'].close()
+            part['file'] = None
+
+    def close_part(self, key):
+        """
+        Close the part open for the partition and add it to the manifest
+        """
+
+        part = self.open_parts.pop(key)
+        self.end_member(part)
+        self.parts.append(self.manifest_entry(part, True))
+
+    def manifest_entry(self, part, complete):
+        """
+        Entry of the manifest for the part (with its gzip members terminated)
+        """
+
+        return {'path': part['path'], 'partition': part['partition'],
+                'events': part['events'],
+                'size': os.path.getsize(part['name']),
+                'first_datetime': unicode(part['first']),
+                'last_datetime': unicode(part['last']),
+                'complete': complete}
+
+    def accepts(self, event):
+        """
+        Check if the event is written by this sink (its user is not excluded
+        and its time is in the window given)
+        """
+        return EventSink.accepts(self, event) and \
+            self.from_date <= event.datetime <= self.until_date
+
+    def write_events(self, events):
+        # Group the lines by partition
+        partitions = {}
+        key_functions = self.key_functions
+        for event in events:
+            if len(event.values) > 4:
+                print >> sys.stderr, "Event longer than expected."
+                print_event(event)
+                sys.exit(1)
+
+            # Ignore the events outside the given window
+            if event.datetime < self.from_date or \
+                    event.datetime > self.until_date:
+                continue
+
+            key = tuple([x(event) for x in key_functions])
+            partitions.setdefault(key, []).append(event)
+
+        for (key, partition_events) in partitions.items():
+            part = self.open_parts.pop(key, None)
+            if part == None:
+                part = self.open_part(key)
+            else:
+                # Move the partition to the end of the order of use
+                self.open_parts[key] = part
+                if part['file'] == None:
+                    part['file'] = gzip.open(part['name'], 'ab')
+
+            data = (u'\n'.join([','.join(csv_fields(x))
+                                for x in partition_events]) +
+                    u'\n').encode('utf-8')
+            part['file'].write(data)
+            part['events'] += len(partition_events)
+            part['size'] += len(data)
+            dates = [x.datetime for x in partition_events]
+            if part['first'] == None:
+                part['first'] = min(dates)
+                part['last'] = max(dates)
+            else:
+                part['first'] = min(part['first'], min(dates))
+                part['last'] = max(part['last'], max(dates))
+
+            if part['size'] >= self.part_size:
+                self.close_part(key)
+
+    def flush(self):
+        EventSink.flush(self)
+        for part in self.open_parts.values():
+            self.end_member(part)
+        self.write_manifest()
+
+    def close(self):
+        EventSink.flush(self)
+        for key in self.open_parts.keys():
+            self.close_part(key)
+        self.write_manifest()
+
+    def write_manifest(self):
+        """
+        Write the manifest (closed and open parts) replacing the previous one
+        """
+
+        parts = self.parts + [self.manifest_entry(x, False)
+                              for x in self.open_parts.values()]
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data_out = open(self.manifest_name + '.tmp', 'w')
+        json.dump({'columns': csv_header, 'partition_by': self.partition_by,
+                   'parts': parts}, data_out, indent = 1, 
+                  sort_keys = True)
+        data_out.close()
+        os.rename(self.manifest_name + '.tmp', self.manifest_name)
+
+class MongoSink(EventSink):
+    """
+    Save the events in a mongoDB.
+    """
 
-    mongodb.insert_event(event)
+    def __init__(self, module_name, buffer_size):
+        EventSink.__init__(self, module_name, buffer_size)
+
+        mongodb.connect(rule_manager.get_property(None, module_name, 
+                                                  'db_host'),
+                        rule_manager.get_property(None, module_name, 
+                                                  'db_user'),
+                        rule_manager.get_property(None, module_name, 
+                                                  'db_passwd'),
+                        rule_manager.get_property(None, module_name, 
+                                                  'db_name'),
+                        rule_manager.get_property(None, module_name,
+                                                  'db_batch_size'),
+                        rule_manager.get_property(None, module_name,
+                                                  'db_write_concern'),
+                        rule_manager.get_property(None, module_name,
+                                                  'db_upsert') == 'yes')
+
+    def write_events(self, events):
+        mongodb.insert_events(events)
+
+    def close(self):
+        self.flush()
+        # Indexes are created once the events are loaded
+        mongodb.create_indexes()
+        mongodb.disconnect()
+
+class SegmentSink(EventSink):
+    """
+    Save the events in columnar segment files (see event_store). A segment is
+    written every segment_events events, and when the sink is flushed.
+    """
+
+    def __init__(self, module_name, buffer_size):
+        EventSink.__init__(self, module_name, buffer_size)
+
+        self.directory = rule_manager.get_property(None, module_name,
+                                                   'segment_dir')
+        if self.directory == '':
+            print >> sys.stderr, 'No segment_dir given in', module_name
+            sys.exit(1)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.segment_events = int(rule_manager.get_property(None, module_name,
+                                                            'segment_events'))
+        self.writer = event_store.SegmentWriter()
+
+    def write_events(self, events):
+        add = self.writer.add
+        for event in events:
+            add(event)
+            if len(self.writer) >= self.segment_events:
+                self.write_segment()
+
+    def write_segment(self):
+        """
+        Write the events in the writer as a new segment
+        """
+        if len(self.writer) == 0:
+            return
+        self.writer.write(event_store.segment_name(self.directory))
+
+    def flush(self):
+        EventSink.flush(self)
+        self.write_segment()
+
+class ThreadedSink(EventSink):
+    """
+    Give the batches of events to the given sink in a separate thread, so that
+    writing them overlaps with the processing of the rules. flush and close
+    wait until the thread has written all the batches.
+    """
+
+    def __init__(self, target):
+        EventSink.__init__(self, target.module_name, target.buffer_size)
+        self.target = target
+        self.queue = Queue.Queue(queue_batches)
+        self.error = []
+        self.thread = threading.Thread(target = self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        """
+        Body of the thread. A None batch terminates it.
+        """
+
+        while True:
+            events = self.queue.get()
+            try:
+                if events == None:
+                    return
+                if self.error == []:
+                    self.target.write_events(events)
+            except BaseException:
+                self.error.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def accepts(self, event):
+        return self.target.accepts(event)
+
+    def write_events(self, events):
+        self.check_error()
+        self.queue.put(events)
+
+    def check_error(self):
+        """
+        Raise in this thread the exception raised by the writer thread
+        """
+
+        if self.error != []:
+            error = self.error[0]
+            self.error = []
+            raise error[0], error[1], error[2]
+
+    def flush(self):
+        self.flush_buffer()
+        self.queue.join()
+        self.check_error()
+        self.target.flush()
+
+    def close(self):
+        if self.thread == None:
+            return
+        self.flush_buffer()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.check_error()
+        self.target.close()
 
 ################################################################################
 
-def print_event(event):
+def csv_fields(event):
     """
-    Function to print an event. Events are a list of pairs (key, value) with the
-    following structure:
+    List with the fields of the event in the CSV format (see csv_header)
+    """
+
+    # Create the event with the first three entities and add the rest
+    result = [unicode(event.datetime), '"' + event.name + '"',
+              '"' + event.user + '"']
 
-    (name, datetime, user, [(key1, value1), (key2, value2), ...])
+    # Attach any remaining entities
+    for value in event.values:
+        field = unicode(value).replace('"', '""')
+        result.append(u'"' + field.strip() + u'"')
 
-    datetime is a datetime object, the rest strings.
+    return result
 
+def print_event(event):
+    """
+    Function to print an event (see the top of the module).
     """
 
-    print str(event[1]), str(event[0]), str(event[2])
+    print str(event.datetime), str(event.name), str(event.user)
     
-    for element in events[3]:
+    for element in event.pairs():
         print '  ',
-        print str(element[0]) + ': ' + str(event[element[1]])
+        print str(element[0]) + ': ' + str(element[1])
 
 def main():
     """
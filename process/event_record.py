@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Compact representation of an event. Each event has three fixed fields (name,
+# datetime and user) and a set of additional (key, value) pairs that depend on
+# the event (see update_events). Instead of storing a list of pairs per event,
+# the keys are stored in a tuple (the schema) shared by all the events with the
+# same keys, and the values in a tuple. Event names and keys are interned so
+# that all the events share the same string objects.
+#
+# For compatibility with the previous representation as tuples
+#
+# (name, datetime, user, [(key1, value1), (key2, value2), ...])
+#
+# the events can be indexed and unpacked as if they were such tuples.
+#
+import sys, locale, codecs, hashlib
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Dictionary with the interned strings (intern does not accept unicode)
+_strings = {}
+
+# Dictionary with the tuples of keys shared by the events
+_schemas = {}
+
+def intern_string(value):
+    """
+    Return the unique copy of the given string
+    """
+
+    global _strings
+
+    return _strings.setdefault(value, value)
+
+def schema(keys):
+    """
+    Given a tuple of keys, return the unique copy of the tuple with all its
+    keys interned.
+    """
+
+    global _schemas
+
+    result = _schemas.get(keys)
+    if result == None:
+        result = tuple([intern_string(x) for x in keys])
+        _schemas[result] = result
+    return result
+
+def restore(name, dtime, user, keys, values):
+    """
+    Create an event from its schema and values (used when unpickling)
+    """
+
+    result = Event.__new__(Event)
+    result.name = intern_string(name)
+    result.datetime = dtime
+    result.user = user
+    result.keys = schema(keys)
+    result.values = values
+    return result
+
+class Event(object):
+    """
+    Event with fields name, datetime, user, keys (tuple of key names) and
+    values (tuple with the values of the keys).
+    """
+
+    __slots__ = ('name', 'datetime', 'user', 'keys', 'values')
+
+    def __init__(self, name, dtime, user, pairs):
+        self.name = intern_string(name)
+        self.datetime = dtime
+        self.user = user
+        self.keys = schema(tuple([x[0] for x in pairs]))
+        self.values = tuple([x[1] for x in pairs])
+
+    def pairs(self):
+        """
+        List of pairs (key, value)
+        """
+        return zip(self.keys, self.values)
+
+    def document(self):
+        """
+        Dictionary with all the fields of the event (as stored in mongo)
+        """
+        result = dict(zip(self.keys, self.values))
+        result['name'] = self.name
+        result['datetime'] = self.datetime
+        result['user'] = self.user
+        return result
+
+    def digest(self):
+        """
+        MD5 digest (16 bytes) of all the fields. Identical events have the
+        same digest (see dedup).
+        """
+
+        text = u'\x1f'.join([self.name, unicode(self.datetime), self.user] +
+                            [unicode(x) for x in self.keys] +
+                            [unicode(x) for x in self.values])
+        return hashlib.md5(text.encode('utf-8')).digest()
+
+    def __reduce__(self):
+        return (restore, (self.name, self.datetime, self.user, self.keys,
+                          self.values))
+
+    # Tuple interface
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return (self.name, self.datetime, self.user, self.pairs())[index]
+
+    def __iter__(self):
+        return iter((self.name, self.datetime, self.user, self.pairs()))
+
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self.name == other.name and \
+            self.datetime == other.datetime and self.user == other.user and \
+            self.keys == other.keys and self.values == other.values
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    # The fields may be modified (for example, the user when it is
+    # anonymized), thus the events cannot be hashed, like the tuples they
+    # replace (with a list of pairs). See digest.
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Event' + repr((self.name, self.datetime, self.user,
+                               self.pairs()))
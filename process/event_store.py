@@ -0,0 +1,457 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Columnar binary storage of events (format "segment" of event_output). The
+# events are written in segment files (*.seg) in a directory. Each segment
+# contains the events in columns:
+#
+#   datetime        int64, microseconds since 1970-01-01 (naive datetime)
+#   name            int32, code in the dictionary of event names
+#   user            int32, code in the dictionary of users
+#   program         int32, code in the dictionary of programs (value of the
+#                   key "program" or "application", -1 if the event has none)
+#   schema          int32, code in the dictionary of tuples of keys
+#   value_start     int64 (count + 1 entries), index in string_offsets of the
+#                   first value of each event (the values are in the order of
+#                   the schema)
+#   string_offsets  int64, offset of each value in the strings blob (one more
+#                   entry marking the end of the last value)
+#
+# and the blob "strings" with all the values encoded in utf-8 (values which
+# are not strings, such as dates, are stored as their unicode version). The
+# layout of the file is
+#
+#   magic (8 bytes) | header length (uint64) | header (JSON) | data
+#
+# where the header has the number of events, the dictionaries, and the type,
+# offset (from the beginning of the data, aligned to 8 bytes) and size of the
+# columns and blobs. The segments are written to a temporary file and renamed,
+# thus a segment is never seen partially written.
+#
+# The class Segment memory-maps a segment and returns the columns as NumPy
+# arrays pointing to the mapped file (no copy). The class Store gives the
+# columns of all the segments in a directory as single arrays with merged
+# dictionaries. Without NumPy, the columns are tuples.
+#
+import sys, locale, codecs, getopt, os, glob, json, mmap, struct, datetime
+import time
+
+import event_record
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# First bytes of a segment file
+magic = 'PLASEG\x00\x01'
+
+# Columns with codes in a dictionary
+dictionary_columns = ['name', 'user', 'program', 'schema']
+
+# Keys whose value is stored in the column program
+program_keys = ('program', 'application')
+
+# Struct format of the column types
+_struct_formats = {'<i8': 'q', '<i4': 'i'}
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+# Number of segments written by the process
+_sequence = 0
+
+def to_microseconds(dtime):
+    """
+    Microseconds since 1970-01-01 of a naive datetime
+    """
+
+    delta = dtime - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_microseconds(value):
+    """
+    Inverse of to_microseconds
+    """
+    return _epoch + datetime.timedelta(microseconds = value)
+
+class SegmentWriter(object):
+    """
+    Accumulates events and writes them as a segment
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.columns = dict([(x, []) for x in ['datetime', 'value_start',
+                                               'string_offsets'] +
+                             dictionary_columns])
+        self.dictionaries = dict([(x, {}) for x in dictionary_columns])
+        self.strings = []
+        self.strings_length = 0
+
+    def __len__(self):
+        return len(self.columns['datetime'])
+
+    def code(self, column, value):
+        """
+        Code of the value in the dictionary of the column
+        """
+
+        dictionary = self.dictionaries[column]
+        result = dictionary.get(value)
+        if result == None:
+            result = dictionary[value] = len(dictionary)
+        return result
+
+    def add(self, event):
+        """
+        Add an event_record.Event to the segment
+        """
+
+        columns = self.columns
+        columns['datetime'].append(to_microseconds(event.datetime))
+        columns['name'].append(self.code('name', event.name))
+        columns['user'].append(self.code('user', event.user))
+        columns['schema'].append(self.code('schema', event.keys))
+
+        program = -1
+        for key in program_keys:
+            if key in event.keys:
+                program = self.code('program',
+                                    event.values[event.keys.index(key)])
+                break
+        columns['program'].append(program)
+
+        string_offsets = columns['string_offsets']
+        columns['value_start'].append(len(string_offsets))
+        for value in event.values:
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            string_offsets.append(self.strings_length)
+            self.strings.append(value)
+            self.strings_length += len(value)
+
+    def write(self, file_name):
+        """
+        Write the events added so far in the given file, and empty the segment
+        """
+
+        count = len(self)
+        columns = self.columns
+        data = [('datetime', '<i8', columns['datetime']),
+                ('value_start', '<i8',
+                 columns['value_start'] + [len(columns['string_offsets'])]),
+                ('string_offsets', '<i8',
+                 columns['string_offsets'] + [self.strings_length])]
+        data.extend([(x, '<i4', columns[x]) for x in dictionary_columns])
+
+        # Dictionaries as lists ordered by code
+        dictionaries = {}
+        for (column, dictionary) in self.dictionaries.items():
+            values = [None] * len(dictionary)
+            for (value, code) in dictionary.items():
+                values[code] = value
+            dictionaries[column] = values
+
+        # Place the columns and the blob
+        header = {'count': count, 'columns': {}, 'blobs': {},
+                  'dictionaries': dictionaries}
+        chunks = []
+        offset = 0
+        for (column, column_type, values) in data:
+            chunk = struct.pack('<%d%s' % (len(values),
+                                           _struct_formats[column_type]),
+                                *values)
+            header['columns'][column] = {'type': column_type,
+                                         'offset': offset,
+                                         'count': len(values)}
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        header['blobs']['strings'] = {'offset': offset,
+                                      'length': self.strings_length}
+        chunks.extend(self.strings)
+
+        header_data = json.dumps(header, separators = (',', ':'))
+        header_data += ' ' * (-(len(header_data) + 16) % 8)
+
+        data_out = open(file_name + '.tmp', 'wb')
+        data_out.write(magic)
+        data_out.write(struct.pack('<Q', len(header_data)))
+        data_out.write(header_data)
+        data_out.write(''.join(chunks))
+        data_out.close()
+        os.rename(file_name + '.tmp', file_name)
+
+        self.reset()
+        return count
+
+class Segment(object):
+    """
+    Memory-mapped segment file
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        data_in = open(file_name, 'rb')
+        try:
+            self.data = mmap.mmap(data_in.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        finally:
+            data_in.close()
+
+        if self.data[0:8] != magic:
+            raise ValueError('Incorrect segment file ' + file_name)
+
+        (header_length,) = struct.unpack_from('<Q', self.data, 8)
+        self.header = json.loads(self.data[16:16 + header_length])
+        self.base = 16 + header_length
+        self.count = self.header['count']
+
+        schemas = self.header['dictionaries']['schema']
+        self.header['dictionaries']['schema'] = \
+            [event_record.schema(tuple(x)) for x in schemas]
+
+        self._value_start = None
+        self._string_offsets = None
+
+    def __len__(self):
+        return self.count
+
+    def dictionary(self, column):
+        """
+        List with the values of the codes of the column
+        """
+        return self.header['dictionaries'][column]
+
+    def column(self, column):
+        """
+        Values of the column (NumPy array, or tuple without NumPy)
+        """
+
+        info = self.header['columns'][column]
+        if numpy != None:
+            return numpy.frombuffer(self.data, numpy.dtype(info['type']),
+                                    info['count'], self.base + info['offset'])
+
+        return struct.unpack_from('<%d%s' % (info['count'],
+                                             _struct_formats[info['type']]),
+                                  self.data, self.base + info['offset'])
+
+    def datetimes(self):
+        """
+        Column datetime as NumPy datetime64 (or datetime objects without
+        NumPy)
+        """
+
+        if numpy != None:
+            return self.column('datetime').view('datetime64[us]')
+        return [from_microseconds(x) for x in self.column('datetime')]
+
+    def values(self, index):
+        """
+        Tuple with the values of the event with the given index
+        """
+
+        # Arrays cannot be compared with ==
+        if self._value_start is None:
+            self._value_start = self.column('value_start')
+            self._string_offsets = self.column('string_offsets')
+
+        start = self.base + self.header['blobs']['strings']['offset']
+        offsets = self._string_offsets
+        data = self.data
+        return tuple([data[start + offsets[x]:
+                               start + offsets[x + 1]].decode('utf-8')
+                      for x in xrange(self._value_start[index],
+                                      self._value_start[index + 1])])
+
+    def events(self):
+        """
+        Generator with the events of the segment as event_record.Event
+        """
+
+        dictionaries = self.header['dictionaries']
+        columns = [self.column(x) for x in ['datetime', 'name', 'user',
+                                            'schema']]
+        for index in xrange(self.count):
+            yield event_record.restore(
+                dictionaries['name'][columns[1][index]],
+                from_microseconds(int(columns[0][index])),
+                dictionaries['user'][columns[2][index]],
+                dictionaries['schema'][columns[3][index]],
+                self.values(index))
+
+    def close(self):
+        self.data.close()
+
+class Store(object):
+    """
+    All the segments in a directory
+    """
+
+    def __init__(self, directory):
+        self.segments = [Segment(x) for x in
+                         sorted(glob.glob(os.path.join(directory, '*.seg')))]
+        self.count = sum([len(x) for x in self.segments])
+        self._dictionaries = {}
+
+    def __len__(self):
+        return self.count
+
+    def dictionary(self, column):
+        """
+        List with the values of the codes of the column merging those of the
+        segments (see column)
+        """
+
+        result = self._dictionaries.get(column)
+        if result != None:
+            return result
+
+        codes = {}
+        for segment in self.segments:
+            for value in segment.dictionary(column):
+                codes.setdefault(value, len(codes))
+        result = [None] * len(codes)
+        for (value, code) in codes.items():
+            result[code] = value
+        self._dictionaries[column] = result
+        return result
+
+    def column(self, column):
+        """
+        Values of the column in all the segments (NumPy array, or list without
+        NumPy). The codes of the dictionary columns refer to the merged
+        dictionary.
+        """
+
+        parts = []
+        if column in dictionary_columns:
+            codes = dict([(y, x) for (x, y) in
+                          enumerate(self.dictionary(column))])
+        for segment in self.segments:
+            values = segment.column(column)
+            if column in dictionary_columns:
+                # The last entry translates -1 (no value)
+                translation = [codes[x] for x in
+                               segment.dictionary(column)] + [-1]
+                if numpy != None:
+                    values = numpy.array(translation, numpy.int32)[values]
+                else:
+                    values = [translation[x] for x in values]
+            parts.append(values)
+
+        if numpy != None:
+            if parts == []:
+                return numpy.zeros(0, numpy.int64)
+            return numpy.concatenate(parts)
+        return [x for part in parts for x in part]
+
+    def datetimes(self):
+        """
+        Column datetime of all the segments (see Segment.datetimes)
+        """
+
+        if numpy != None:
+            return self.column('datetime').view('datetime64[us]')
+        return [from_microseconds(x) for x in self.column('datetime')]
+
+    def events(self):
+        """
+        Generator with the events in all the segments
+        """
+
+        for segment in self.segments:
+            for event in segment.events():
+                yield event
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+def segment_name(directory):
+    """
+    Name of a new segment (the names sort in the order in which they were
+    written by the process)
+    """
+
+    global _sequence
+
+    _sequence += 1
+    return os.path.join(directory, 'events-%s-%d-%06d.seg' %
+                        (time.strftime('%Y%m%d%H%M%S'), os.getpid(),
+                         _sequence))
+
+def main():
+    """
+    Script to print the events stored in segments
+
+    script [options] directory
+
+    Options:
+
+    -e Print the events (by default, only the number of events of each type)
+    """
+
+    #######################################################################
+    #
+    # OPTIONS
+    #
+    #######################################################################
+    # Swallow the options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "e", [])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, 'Incorrect option.'
+        print >> sys.stderr, main.__doc__
+        sys.exit(2)
+
+    print_events = False
+    for optstr, value in opts:
+        if optstr == "-e":
+            print_events = True
+
+    # Check that there are additional arguments
+    if len(args) != 1:
+        print >> sys.stderr, 'Script needs a directory'
+        print >> sys.stderr, main.__doc__
+        sys.exit(1)
+
+    #######################################################################
+    #
+    # MAIN PROCESSING
+    #
+    #######################################################################
+    store = Store(args[0])
+    if print_events:
+        for event in store.events():
+            print unicode(event.datetime), event.name, event.user,
+            print u' '.join([u'%s=%s' % x for x in event.pairs()])
+        return
+
+    print len(store.segments), 'segments', len(store), 'events'
+    counts = {}
+    for code in store.column('name'):
+        counts[code] = counts.get(code, 0) + 1
+    names = store.dictionary('name')
+    for (code, number) in sorted(counts.items(), key = lambda x: -x[1]):
+        print '%10d %s' % (number, names[code])
+
+# Execution as script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Declarative filters given in the "filter" option of a rule, as an
+# alternative (or a complement) to filter_file/filter_function. The filter
+# receives the same list of fields as the filter functions (see the parsers),
+# and is a sequence of clauses separated by ';'. All the clauses must hold for
+# the event to be kept. Each clause is a sequence of terms separated by '|', of
+# which at least one must hold. A term is
+#
+#   FIELD [not] OPERATOR VALUE [VALUE ...]
+#
+# FIELD is the index of the field (5), or the index of the field followed by
+# the index of a word in that field (4.1 is the second word of field 4). A
+# missing field or word is the empty string. The operators are:
+#
+#   in        The field is equal to one of the values
+#   prefix    The field starts with one of the values
+#   suffix    The field ends with one of the values
+#   contains  The field contains one of the values
+#   regex     One of the regular expressions matches some part of the field
+#
+# Values containing spaces, ';' or '|' must be quoted with ' or ". For
+# example, the filter filters.filter_apache is equivalent to
+#
+#   filter = 5 in 200; 4.1 suffix .html | 4.1 in / | 4.1 contains .html?
+#
+# The expression is compiled once into a single Python function. The terms of a
+# clause over the same field are fused: the values of "in" are a set, the
+# prefixes are a regular expression with the structure of a trie, the suffixes
+# a tuple given to endswith, and "contains" and "regex" a single regular
+# expression. The clauses are evaluated from the cheapest to the most
+# expensive. The parsers apply the filter before translating the date of the
+# event whenever possible (see pipeline.FileContext.accept).
+#
+import sys, locale, codecs, re
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Operators and their relative cost
+operators = {'in': 0, 'prefix': 1, 'suffix': 1, 'contains': 2, 'regex': 2}
+
+# Tokens of the expression: quoted value, separator or plain word
+_token_re = re.compile(r'''\s*(?:"([^"]*)"|'([^']*)'|([;|])|([^\s;|"']+))''')
+
+_field_re = re.compile(r'^(\d+)(?:\.(\d+))?$')
+
+class Filter(object):
+    """
+    Filter of a rule. The declarative expression (predicate) is applied before
+    the optional filter function. Both return None if the event is dropped, and
+    the fields otherwise.
+    """
+
+    def __init__(self, expression, function = None):
+        self.expression = expression
+        self.predicate = compile_expression(expression)
+        self.function = function
+
+    def __call__(self, fields):
+        if self.predicate(fields) == None:
+            return None
+        if self.function == None:
+            return fields
+        return self.function(fields)
+
+def tokenize(expression):
+    """
+    Return the list of tokens in the expression. Separators are returned as
+    (';',) and ('|',), values as strings.
+    """
+
+    result = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _token_re.match(expression, position)
+        if match == None:
+            raise ValueError('Unbalanced quotes in filter: ' + expression)
+        (double, single, separator, word) = match.groups()
+        if separator != None:
+            result.append((separator,))
+        elif double != None:
+            result.append(double)
+        elif single != None:
+            result.append(single)
+        else:
+            result.append(word)
+        position = match.end()
+    return result
+
+def parse(expression):
+    """
+    Return the list of clauses in the expression. Each clause is a list of
+    terms (field, word, negated, operator, values) where word is None if the
+    term refers to the whole field.
+    """
+
+    if isinstance(expression, str):
+        expression = expression.decode('utf-8')
+
+    clauses = [[[]]]
+    for token in tokenize(expression):
+        if token == (';',):
+            clauses.append([[]])
+        elif token == ('|',):
+            clauses[-1].append([])
+        else:
+            clauses[-1][-1].append(token)
+
+    result = []
+    for clause in clauses:
+        terms = []
+        for tokens in clause:
+            if tokens == [] and len(clause) == 1:
+                # Empty clause (for example, a trailing ';')
+                continue
+            terms.append(parse_term(tokens))
+        if terms != []:
+            result.append(terms)
+    return result
+
+def parse_term(tokens):
+    """
+    Translate the tokens of a term into (field, word, negated, operator,
+    values)
+    """
+
+    text = ' '.join(tokens)
+    if len(tokens) < 3:
+        raise ValueError('Incomplete filter term: ' + text)
+
+    match = _field_re.match(tokens[0])
+    if match == None:
+        raise ValueError('Incorrect field in filter term: ' + text)
+    field = int(match.group(1))
+    word = None
+    if match.group(2) != None:
+        word = int(match.group(2))
+
+    negated = tokens[1] == 'not'
+    if negated:
+        tokens = tokens[1:]
+
+    operator = tokens[1]
+    values = tokens[2:]
+    if not operator in operators:
+        raise ValueError('Incorrect operator in filter term: ' + text)
+    if values == []:
+        raise ValueError('No values in filter term: ' + text)
+
+    if operator == 'regex':
+        for value in values:
+            try:
+                re.compile(value, re.UNICODE)
+            except re.error, e:
+                raise ValueError('Incorrect regular expression ' + value +
+                                 ' (' + str(e) + ')')
+
+    return (field, word, negated, operator, values)
+
+def trie_pattern(prefixes):
+    """
+    Regular expression matching the given prefixes at the beginning of a
+    string, with the common prefixes factored as in a trie (so that the
+    matching never backtracks more than one character).
+    """
+
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # A shorter prefix already accepts the longer ones
+        node.clear()
+        node[None] = True
+
+    return _node_pattern(trie)
+
+def _node_pattern(node):
+    if None in node:
+        return ''
+
+    branches = [re.escape(char) + _node_pattern(child)
+                for (char, child) in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+def _word(value, index):
+    """
+    Word with the given index in the value (empty if not present)
+    """
+
+    words = value.split()
+    if index < len(words):
+        return words[index]
+    return u''
+
+def compile_clause(clause, variables, constants):
+    """
+    Return the Python expression (and its cost) for the clause. variables is
+    a dictionary (field, word): name with the names of the variables holding
+    the values of the fields, constants a dictionary with the objects
+    referenced by the expression.
+    """
+
+    def constant(value):
+        name = 'c' + str(len(constants))
+        constants[name] = value
+        return name
+
+    # Fuse the positive terms over the same field
+    fused = {}
+    tests = []
+    cost = 0
+    for (field, word, negated, operator, values) in clause:
+        variable = variables[(field, word)]
+        cost = max(cost, operators[operator] + (word != None))
+        if negated:
+            tests.append('not ' + term_test(variable, operator, values,
+                                            constant))
+            continue
+        fused.setdefault((variable, operator), []).extend(values)
+
+    for (variable, operator) in sorted(fused.keys()):
+        if operator == 'contains' and (variable, 'regex') in fused:
+            continue
+        values = fused[(variable, operator)]
+        if operator == 'regex':
+            values = values + [re.escape(x) for x in
+                               fused.get((variable, 'contains'), [])]
+        tests.append(term_test(variable, operator, values, constant))
+
+    return (' or '.join(tests), cost)
+
+def term_test(variable, operator, values, constant):
+    """
+    Python expression testing the values of the operator on the variable
+    """
+
+    if operator == 'in':
+        return '(' + variable + ' in ' + constant(frozenset(values)) + ')'
+
+    if operator == 'prefix':
+        matcher = re.compile(trie_pattern(values), re.UNICODE).match
+        return '(' + constant(matcher) + '(' + variable + ') is not None)'
+
+    if operator == 'suffix':
+        return variable + '.endswith(' + constant(tuple(values)) + ')'
+
+    if operator == 'contains':
+        values = [re.escape(x) for x in values]
+
+    pattern = '|'.join(['(?:' + x + ')' for x in values])
+    matcher = re.compile(pattern, re.UNICODE).search
+    return '(' + constant(matcher) + '(' + variable + ') is not None)'
+
+def compile_expression(expression):
+    """
+    Return a function receiving the list of fields, and returning it if the
+    expression holds or None otherwise.
+    """
+
+    clauses = parse(expression)
+
+    # Names of the variables with the value of the fields
+    variables = {}
+    for clause in clauses:
+        for (field, word, negated, operator, values) in clause:
+            variables.setdefault((field, word), 'v' + str(len(variables)))
+
+    constants = {'_word': _word}
+    tests = [compile_clause(x, variables, constants) + (x,) for x in clauses]
+    tests.sort(key = lambda x: x[1])
+
+    # Each variable is assigned right before the first clause using it
+    lines = ['def predicate(fields):']
+    assigned = set()
+    for (test, cost, clause) in tests:
+        for (field, word) in sorted(set([x[0:2] for x in clause])):
+            variable = variables[(field, word)]
+            if variable in assigned:
+                continue
+            assigned.add(variable)
+            value = '((fields[%d] or u"") if len(fields) > %d else u"")' % \
+                (field, field)
+            if word != None:
+                value = '_word(%s, %d)' % (value, word)
+            lines.append('    ' + variable + ' = ' + value)
+        lines.append('    if not (' + test + '):')
+        lines.append('        return None')
+    lines.append('    return fields')
+
+    exec '\n'.join(lines) + '\n' in constants
+    return constants['predicate']
@@ -3,9 +3,31 @@
 #
 # Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
 #
-import sys, locale, codecs, getopt, os, ldap
+# Look up of user names in a directory to obtain their synonyms (see
+# anonymize.find_or_encode_string). The uri may be that of an LDAP server, or
+# ldif:///path/to/file.ldif to search the entries in an LDIF file instead
+# (useful to test without a server).
+#
+# Each name is searched in all the attributes in "fields", and the result is
+# the dictionary with the attributes of the entry found (None if there is no
+# entry, or more than one). The results are kept in memory and, if cache_file
+# is given, in an SQLite database for cache_ttl seconds (negative_ttl seconds
+# for the names not found).
+#
+# Several names may be looked up at once with prefetch. They are searched in
+# batches of batch_size names, each in a single query with the filter
+# (|(uid=name1)(cn=name1)...(uid=name2)...), and the batches are sent
+# concurrently through a pool of connections to the server.
+#
+import sys, locale, codecs, getopt, os, time, json, base64, sqlite3
+import threading, Queue
 
-import rule_manager
+import rule_manager, metrics
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
 
 # Fix the output encoding when redirecting stdout
 if sys.stdout.encoding is None:
@@ -32,21 +54,42 @@ module_prefix = 'ldap_lookup'
 # Configuration parameters for this module
 #
 config_params = {
-    'uri': '',              # URI where the server is located
+    'uri': '',              # URI where the server is located (or ldif:///FILE)
     'base': '',             # Base ou=*,c=*
-    'fields': 'uid cn mail' # Fields to search
+    'fields': 'uid cn mail',# Fields to search
+    'cache_file': '',       # SQLite file to keep the results
+    'cache_ttl': '604800',  # Seconds the results are kept
+    'negative_ttl': '86400',# Seconds the names not found are kept
+    'batch_size': '50',     # Names searched in a single query
+    'connections': '4'      # Connections to the server
     }
 
-ldap_obj = None
+# Object searching the entries (LDAPBackend or LDIFBackend)
+backend = None
+
+# Values of the options
+search_base = ''
+search_fields = []
+batch_size = 50
+
+# Results obtained in this execution (name: attributes or None), and
+# persistent cache (ResultCache)
+results = {}
+cache = None
 
 debug = 0
 
 def initialize(module_name):
     """
-    Initialize the ldap_obj.
+    Initialize the backend and the cache
     """
 
-    global ldap_obj
+    global backend
+    global search_base
+    global search_fields
+    global batch_size
+    global results
+    global cache
     global debug
 
     # Get the level of debug
@@ -57,12 +100,31 @@ def initialize(module_name):
         # Nothing to do
         return
 
+    search_base = rule_manager.get_property(None, module_name, 'base')
+    search_fields = rule_manager.get_property(None, module_name,
+                                              'fields').split()
+    batch_size = max(int(rule_manager.get_property(None, module_name,
+                                                   'batch_size')), 1)
+    connections = max(int(rule_manager.get_property(None, module_name,
+                                                    'connections')), 1)
+
     try:
-        ldap_obj = ldap.initialize(uri)
-    except:
-        print >> sys.stderr, 'LDAP exception when initializing'
+        if uri.startswith('ldif://'):
+            backend = LDIFBackend(uri[len('ldif://'):])
+        else:
+            backend = LDAPBackend(uri, connections)
+    except Exception, e:
+        print >> sys.stderr, 'LDAP exception when initializing:', e
         sys.exit(1)
 
+    results = {}
+    cache_file = rule_manager.get_property(None, module_name, 'cache_file')
+    if cache_file != '':
+        cache = ResultCache(cache_file,
+                            float(rule_manager.get_property(None, module_name,
+                                                            'cache_ttl')),
+                            float(rule_manager.get_property(None, module_name,
+                                                            'negative_ttl')))
 
     print >> sys.stderr, 'LDAP object initialized successfully'
 
@@ -73,38 +135,313 @@ def execute(module_name):
     """
     return
 
-def get(lookup_name):
+class LDAPBackend(object):
     """
-    Looks up the given name in the directory and returns synonyms
+    Pool of connections to an LDAP server. The connections are created in each
+    process when first needed.
     """
 
-    global module_prefix
-    global ldap_obj
-    
+    def __init__(self, uri, size):
+        if ldap == None:
+            raise ImportError('python-ldap is not available')
+        self.uri = uri
+        self.size = size
+        self.pid = None
+        self.pool = None
+
+        # Check the URI
+        ldap.initialize(uri)
+
+    def search(self, base, fields, names):
+        """
+        Return the list of dictionaries with the attributes of the entries
+        with any of the fields equal to any of the names
+        """
+
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pool = Queue.Queue()
+            for index in range(self.size):
+                self.pool.put(ldap.initialize(self.uri))
+
+        connection = self.pool.get()
+        try:
+            result = connection.search_s(base, ldap.SCOPE_SUBTREE,
+                                         search_filter(fields, names),
+                                         [str(x) for x in fields])
+        finally:
+            self.pool.put(connection)
+
+        # Skip the references
+        return [x[1] for x in result if x[0] != None]
+
+class LDIFBackend(object):
+    """
+    Entries read from an LDIF file
+    """
+
+    def __init__(self, file_name):
+        # Dictionary (attribute, value) with the entries with that value,
+        # attributes and values in lower case
+        self.index = {}
+        for (dn, attributes) in read_ldif(file_name):
+            entry = (dn.lower(), attributes)
+            for (name, values) in attributes.items():
+                for value in values:
+                    self.index.setdefault((name.lower(), value.lower()),
+                                          []).append(entry)
+
+    def search(self, base, fields, names):
+        result = []
+        found = set()
+        base = base.lower()
+        for field in fields:
+            for name in names:
+                key = (field.lower(), name.encode('utf-8').lower())
+                for (dn, attributes) in self.index.get(key, []):
+                    if dn in found or not dn.endswith(base):
+                        continue
+                    found.add(dn)
+                    result.append(attributes)
+        return result
+
+def read_ldif(file_name):
+    """
+    Return the list of entries (dn, attributes) in the LDIF file, where
+    attributes is a dictionary name: list of values (utf-8)
+    """
+
+    # Join the continuation lines
+    lines = []
+    data_in = open(file_name, 'rb')
+    for line in data_in:
+        line = line.rstrip('\r\n')
+        if line.startswith(' ') and lines != [] and lines[-1] != '':
+            lines[-1] += line[1:]
+        elif not line.startswith('#'):
+            lines.append(line)
+    data_in.close()
+    lines.append('')
+
+    result = []
+    dn = None
+    attributes = {}
+    for line in lines:
+        if line == '':
+            if dn != None:
+                result.append((dn, attributes))
+            dn = None
+            attributes = {}
+            continue
+
+        (name, separator, value) = line.partition(':')
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip())
+        elif value.startswith('<'):
+            # Values given by URL are not supported
+            continue
+        else:
+            value = value.strip()
+
+        if name.lower() == 'dn':
+            dn = value
+        elif name.lower() != 'version':
+            attributes.setdefault(name, []).append(value)
+    return result
+
+class ResultCache(object):
+    """
+    Results of the lookups stored in an SQLite database (connected again in
+    each process)
+    """
+
+    def __init__(self, file_name, ttl, negative_ttl):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.pid = None
+
+    def cursor(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.connection = sqlite3.connect(self.file_name, timeout = 60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS lookups
+                                           (name TEXT PRIMARY KEY,
+                                            attributes TEXT,
+                                            time REAL)''')
+        return self.connection
+
+    def get(self, names):
+        """
+        Dictionary with the results of the given names that have not expired
+        """
+
+        now = time.time()
+        result = {}
+        names = list(names)
+        for index in range(0, len(names), 500):
+            chunk = names[index:index + 500]
+            for (name, attributes, stamp) in self.cursor().execute(
+                'SELECT name, attributes, time FROM lookups WHERE name IN (' +
+                ','.join(['?'] * len(chunk)) + ')', chunk):
+                if attributes == None:
+                    if now - stamp < self.negative_ttl:
+                        result[name] = None
+                elif now - stamp < self.ttl:
+                    result[name] = dict([(str(x), [z.encode('utf-8')
+                                                   for z in y])
+                                         for (x, y) in
+                                         json.loads(attributes).items()])
+        return result
+
+    def update(self, pairs):
+        """
+        Store the dictionary name: attributes (or None) with the results
+        """
+
+        now = time.time()
+        rows = []
+        for (name, attributes) in pairs.items():
+            if attributes != None:
+                try:
+                    attributes = json.dumps(attributes)
+                except UnicodeDecodeError:
+                    # Binary values are not stored
+                    continue
+            rows.append((name, attributes, now))
+
+        connection = self.cursor()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO lookups '
+                                   'VALUES (?, ?, ?)', rows)
+
+def to_unicode(value):
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    return value
+
+def escape_value(value):
+    """
+    Escape the special characters of a value in a search filter (RFC 4515)
+    """
+
+    for char in '\\*()\x00':
+        value = value.replace(char, '\\%02x' % ord(char))
+    return value
+
+def search_filter(fields, names):
+    """
+    Filter matching the entries with any of the fields equal to any of the
+    names
+    """
+
+    terms = ['(' + field + '=' + escape_value(name.encode('utf-8')) + ')'
+             for name in names for field in fields]
+    return '(|' + ''.join(terms) + ')'
+
+def search(names):
+    """
+    Search the names with the backend. Returns the dictionary name: attributes
+    (None if the name was not found, or matches more than one entry).
+    """
+
+    entries = backend.search(search_base, search_fields, names)
+
+    # Assign the entries to the names they match
+    matches = dict([(x.lower(), []) for x in names])
+    for attributes in entries:
+        matched = set()
+        for field in search_fields:
+            for value in attributes.get(field, []):
+                value = value.decode('utf-8', 'replace').lower()
+                if value in matches and not value in matched:
+                    matched.add(value)
+                    matches[value].append(attributes)
+
+    result = {}
+    for name in names:
+        entries = matches[name.lower()]
+        if len(entries) == 1:
+            result[name] = entries[0]
+        else:
+            result[name] = None
+    return result
+
+def prefetch(names):
+    """
+    Look up all the given names (those not in the cache), in batches sent
+    concurrently through the pool of connections
+    """
+
+    global results
+
     # If the object has not been initialized, terminate
-    if ldap_obj == None:
-        return None
+    if backend == None:
+        return
 
-    base = rule_manager.get_property(None, module_prefix, 'base')
-    attr_list = rule_manager.get_property(None, module_prefix, 
-                                          'fields').split()
+    pending = set([to_unicode(x) for x in names]) - set(results)
+    if pending != set() and cache != None:
+        cached = cache.get(pending)
+        metrics.count('ldap_cache_hits', len(cached))
+        results.update(cached)
+        pending -= set(cached)
+    if pending == set():
+        return
 
-    expr = reduce(lambda x, y: '(|(' + y + '=' + lookup_name + ')' \
-                      + x + ')', attr_list, '')
+    pending = sorted(pending)
+    batches = Queue.Queue()
+    for index in range(0, len(pending), batch_size):
+        batches.put(pending[index:index + batch_size])
 
-    try:
-        l = ldap_obj.search_s(base, ldap.SCOPE_SUBTREE, expr, 
-                              map(lambda x: str(x), attr_list))
-    except:
-        # Something went wrong, punt.
-        return None
+    # Each thread takes batches until there are none left
+    found = {}
+    errors = []
+    def search_batches():
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                found.update(search(batch))
+            except Exception, e:
+                # The names of the batch are looked up again next time
+                errors.append(e)
+
+    threads = [threading.Thread(target = search_batches)
+               for x in range(min(getattr(backend, 'size', 1),
+                                  batches.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    # If empty result or more than one record, ignore
-    if l == [] or len(l) != 1:
+    metrics.count('ldap_lookups', len(pending))
+    if errors != []:
+        metrics.count('ldap_errors', len(errors))
+        print >> sys.stderr, 'LDAP exception in', len(errors), 'queries:',
+        print >> sys.stderr, errors[0]
+
+    results.update(found)
+    if cache != None and found != {}:
+        cache.update(found)
+
+def get(lookup_name):
+    """
+    Looks up the given name in the directory and returns synonyms
+    """
+
+    # If the object has not been initialized, terminate
+    if backend == None:
         return None
 
-    # Return the dictionary with the attributes of the first element
-    return l[0][1]
+    lookup_name = to_unicode(lookup_name)
+    if not lookup_name in results:
+        prefetch([lookup_name])
+    return results.get(lookup_name)
 
 def main():
     """
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Runtime metrics of the rules. Two types of values are kept for each rule:
+#
+# - Counters (lines read, events filtered, emitted, anonymize hits, etc.). They
+#   are attributed to the rule being executed (global variable rule), thus the
+#   modules invoked by the rules (anonymize, ldap_lookup, event_output) only
+#   call count(name). The values counted outside any rule (for example, when
+#   the events are written at the end of the execution) are reported without
+#   rule.
+#
+# - Wall and CPU time of the stages of the pipeline processing the files, and
+#   of the whole execution of the rule.
+#
+# The counters are only kept and the stages only timed when a report is
+# requested (global variable enabled), as counting each item has a cost.
+#
+# The values are written as JSON and in the text format of Prometheus
+# (node_exporter textfile collector) with write_reports. The values in the
+# worker processes are obtained with take and incorporated in the parent with
+# merge.
+#
+import sys, locale, codecs, os, time, json
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Files where to write the reports (None to skip them)
+json_file = None
+prometheus_file = None
+
+# Prefix of the names of the metrics in the Prometheus format
+prometheus_prefix = 'pla_'
+
+# True if the stages must be timed (a report has been requested)
+enabled = False
+
+# Rule to which the values are attributed
+rule = None
+
+# Dictionary with pairs rule: {counter: value}
+counters = {}
+
+# Dictionary with pairs rule: {stage: [wall seconds, cpu seconds]}
+times = {}
+
+def configure(json_name = None, prometheus_name = None):
+    """
+    Set the files where the reports are written. The stages are timed if any
+    of them is given.
+    """
+
+    global json_file
+    global prometheus_file
+    global enabled
+
+    json_file = json_name
+    prometheus_file = prometheus_name
+    enabled = json_file != None or prometheus_file != None
+
+def count(name, amount = 1):
+    """
+    Add the amount to the given counter of the current rule (nothing is done
+    if the metrics are not enabled)
+    """
+
+    global counters
+    global rule
+    global enabled
+
+    if not enabled:
+        return
+
+    rule_counters = counters.get(rule)
+    if rule_counters == None:
+        rule_counters = counters.setdefault(rule, {})
+    rule_counters[name] = rule_counters.get(name, 0) + amount
+
+def add_time(stage, wall, cpu):
+    """
+    Add the given wall and CPU seconds to the stage of the current rule
+    """
+
+    global times
+    global rule
+
+    value = times.setdefault(rule, {}).setdefault(stage, [0.0, 0.0])
+    value[0] += wall
+    value[1] += cpu
+
+def cpu_time():
+    """
+    CPU time (user and system) consumed by the process
+    """
+    (user, system) = os.times()[0:2]
+    return user + system
+
+def execute(module_name, function):
+    """
+    Execute the function (the rule with the given name) attributing the
+    values to the rule and accounting its wall and CPU time.
+    """
+
+    global rule
+
+    previous_rule = rule
+    rule = module_name
+    wall = time.time()
+    cpu = cpu_time()
+    try:
+        return function(module_name)
+    finally:
+        add_time('total', time.time() - wall, cpu_time() - cpu)
+        rule = previous_rule
+
+def take():
+    """
+    Return the pair (counters, times) and reset them
+    """
+
+    global counters
+    global times
+
+    result = (counters, times)
+    counters = {}
+    times = {}
+    return result
+
+def merge(values):
+    """
+    Add the given pair (counters, times) as returned by take
+    """
+
+    global counters
+    global times
+
+    (new_counters, new_times) = values
+    for (rule_name, rule_counters) in new_counters.items():
+        target = counters.setdefault(rule_name, {})
+        for (name, value) in rule_counters.items():
+            target[name] = target.get(name, 0) + value
+
+    for (rule_name, rule_times) in new_times.items():
+        target = times.setdefault(rule_name, {})
+        for (stage, value) in rule_times.items():
+            total = target.setdefault(stage, [0.0, 0.0])
+            total[0] += value[0]
+            total[1] += value[1]
+
+class StageTiming(object):
+    """
+    Time spent in a chain of generators. The generators are wrapped in the
+    order of the chain. The time of a stage is the time spent obtaining its
+    items minus the time spent in the previous stage. If the metrics are not
+    enabled, the generators are not wrapped.
+    """
+
+    def __init__(self):
+        # List of [stage, wall, cpu] with the times including the previous
+        # stages
+        self.stages = []
+
+    def wrap(self, items, stage):
+        """
+        Return an iterator over the items accounting the time to the stage
+        """
+
+        global enabled
+
+        if not enabled:
+            return items
+
+        entry = [stage, 0.0, 0.0]
+        self.stages.append(entry)
+        return self.timed(iter(items), entry)
+
+    def timed(self, iterator, entry):
+        wall_clock = time.time
+        cpu_clock = time.clock
+        while True:
+            wall = wall_clock()
+            cpu = cpu_clock()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                entry[1] += wall_clock() - wall
+                entry[2] += cpu_clock() - cpu
+                return
+            entry[1] += wall_clock() - wall
+            entry[2] += cpu_clock() - cpu
+            yield item
+
+    def finish(self, stage, wall, cpu):
+        """
+        Account the time of the stages to the current rule, given the total
+        time of the last stage consuming the chain.
+        """
+
+        previous = (0.0, 0.0)
+        for (name, stage_wall, stage_cpu) in self.stages + [[stage, wall,
+                                                              cpu]]:
+            add_time(name, stage_wall - previous[0], stage_cpu - previous[1])
+            previous = (stage_wall, stage_cpu)
+        self.stages = []
+
+def report():
+    """
+    Dictionary with the values of all the rules. The values counted outside
+    any rule are in 'other'.
+    """
+
+    global counters
+    global times
+
+    rules = {}
+    for rule_name in set(counters.keys()) | set(times.keys()):
+        rules[rule_name] = \
+            {'counters': counters.get(rule_name, {}),
+             'stages': dict([(stage, {'wall_seconds': value[0],
+                                      'cpu_seconds': value[1]})
+                             for (stage, value) in \
+                                 times.get(rule_name, {}).items()])}
+
+    result = {'timestamp': time.time()}
+    if None in rules:
+        result['other'] = rules.pop(None)
+    result['rules'] = dict([(unicode(x), y) for (x, y) in rules.items()])
+    return result
+
+def rule_labels(rule_name):
+    """
+    Prometheus labels identifying the rule (none for the values counted
+    outside any rule)
+    """
+
+    if rule_name == None:
+        return []
+    return ['rule="%s"' % rule_name]
+
+def prometheus_text():
+    """
+    Values of all the rules in the text format of Prometheus
+    """
+
+    global counters
+    global times
+    global prometheus_prefix
+
+    # Group the samples by metric
+    samples = {}
+    for (rule_name, rule_counters) in counters.items():
+        for (name, value) in rule_counters.items():
+            samples.setdefault(name + '_total', []).append(
+                (','.join(rule_labels(rule_name)), value))
+
+    for (rule_name, rule_times) in times.items():
+        for (stage, value) in rule_times.items():
+            labels = ','.join(rule_labels(rule_name) +
+                              ['stage="%s"' % stage])
+            samples.setdefault('stage_wall_seconds_total', []).append(
+                (labels, value[0]))
+            samples.setdefault('stage_cpu_seconds_total', []).append(
+                (labels, value[1]))
+
+    result = []
+    for name in sorted(samples.keys()):
+        result.append('# TYPE ' + prometheus_prefix + name + ' counter')
+        for (labels, value) in sorted(samples[name]):
+            if labels != '':
+                labels = '{' + labels + '}'
+            result.append(prometheus_prefix + name + labels + ' ' +
+                          repr(value))
+    return '\n'.join(result) + '\n'
+
+def write_file(file_name, content):
+    """
+    Write the content replacing the file in a single operation (the file may
+    be read at any time)
+    """
+
+    data_out = codecs.open(file_name + '.tmp', 'w', 'utf-8')
+    data_out.write(content)
+    data_out.close()
+    os.rename(file_name + '.tmp', file_name)
+
+def write_reports():
+    """
+    Write the reports in the files given in configure
+    """
+
+    global json_file
+    global prometheus_file
+
+    if json_file != None:
+        write_file(json_file, json.dumps(report(), indent = 2,
+                                         sort_keys = True) + '\n')
+
+    if prometheus_file != None:
+        write_file(prometheus_file, prometheus_text())
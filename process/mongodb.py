@@ -21,6 +21,20 @@
 #
 # Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
 #
+# The events are written in batches (see insert_events) with unordered bulk
+# inserts. The _id of the users is kept in memory (loaded when connecting), and
+# the users not yet in the database are added with a single bulk upsert per
+# batch of events. Works both with pymongo 3 (insert_many, bulk_write) and
+# older versions (insert of a list of documents).
+#
+# With upsert_events, the _id of each event is derived from its content (see
+# event_record.Event.digest), and the events are written with upserts that only
+# insert the events not already present. Thus processing the same data again
+# does not duplicate the events.
+#
+# The indexes of the event collection (see event_indexes) slow down the bulk
+# inserts, thus they are created by create_indexes after the events are written.
+#
 import sys, pymongo, datetime
 
 host = None
@@ -37,11 +51,36 @@ event_collection = None
 user_collection_name = 'users'
 user_collection = None
 
+# Dictionary user name: _id in the users collection
+user_ids = {}
+
+# Number of documents written in a single operation
+batch_size = 1000
+
+# If True, the events have an _id derived from their content and are upserted
+upsert_events = False
+
+# Indexes of the event collection (see create_indexes)
+event_indexes = [[('user._id', pymongo.ASCENDING),
+                  ('datetime', pymongo.ASCENDING)],
+                 [('name', pymongo.ASCENDING),
+                  ('datetime', pymongo.ASCENDING)]]
+
+# Collections used to write (with the write concern), and the additional
+# arguments of the write operations (older pymongo versions)
+event_writer = None
+user_writer = None
+write_args = {}
+
 def connect(givenHost = None, givenUser = None, givenPasswd = None, 
-            givenDB = None):
+            givenDB = None, givenBatchSize = 1000, givenWriteConcern = '1',
+            givenUpsert = False):
     """
     Connect to the given database and store the connection in the global
-    variable dbconnection. Create also the cursor_obj
+    variable dbconnection. Create also the cursor_obj. The write concern is
+    the number of nodes that must acknowledge the writes, or a tag such as
+    "majority". If givenUpsert is True, the events are upserted (see the top
+    of the module).
     """
 
     global host
@@ -55,6 +94,12 @@ def connect(givenHost = None, givenUser = None, givenPasswd = None,
     global event_collection
     global user_collection_name
     global user_collection
+    global user_ids
+    global batch_size
+    global upsert_events
+    global event_writer
+    global user_writer
+    global write_args
 
     # If not enough information is given, bomb out
     if givenHost == None or givenDB == None:
@@ -74,17 +119,38 @@ def connect(givenHost = None, givenUser = None, givenPasswd = None,
     if user_str != '':
         connect_URL = user_str + '@' + connect_URL
 
-    dbconnection = pymongo.Connection(host=connect_URL)
+    if hasattr(pymongo, 'MongoClient'):
+        dbconnection = pymongo.MongoClient(host=connect_URL)
+    else:
+        dbconnection = pymongo.Connection(host=connect_URL)
 
     database = dbconnection[dbname]
 
     event_collection = database[event_collection_name]
     user_collection = database[user_collection_name]
 
-    # event_collection.ensure_index([("datetime", pymongo.ASCENDING), 
-    #                                ("user", pymongo.ASCENDING)])
+    # The indexes of the event collection are created by create_indexes
 
     user_collection.ensure_index([("name", pymongo.ASCENDING)], unique = True)
+
+    batch_size = max(int(givenBatchSize), 1)
+    upsert_events = givenUpsert
+    write_concern = givenWriteConcern
+    if str(write_concern).isdigit():
+        write_concern = int(write_concern)
+    if hasattr(event_collection, 'with_options'):
+        concern = pymongo.write_concern.WriteConcern(w = write_concern)
+        event_writer = event_collection.with_options(write_concern = concern)
+        user_writer = user_collection.with_options(write_concern = concern)
+        write_args = {}
+    else:
+        event_writer = event_collection
+        user_writer = user_collection
+        write_args = {'w': write_concern}
+
+    # Load the ids of the users
+    user_ids = dict([(x['name'], x['_id'])
+                     for x in user_collection.find({}, {'name': 1})])
     return
 
 def disconnect():
@@ -100,36 +166,116 @@ def disconnect():
     global cursor_obj
     global event_collection
     global user_collection
+    global user_ids
+    global event_writer
+    global user_writer
 
     host = None
     user = None
     passwd = None
-    dbconnection.disconnect()
+    if hasattr(dbconnection, 'close'):
+        dbconnection.close()
+    else:
+        dbconnection.disconnect()
     dbconnection = None
     cursor_obj = None
     event_collection = None
     user_collection = None
+    user_ids = {}
+    event_writer = None
+    user_writer = None
 
 def insert_event(event):
     """
-    The events are received as tuples with the following structure:
-    
-    (name, datetime, user, [(key1, value1), (key2, value2), ...])
-    
-    datetime is a datetime object, the rest strings.
+    The events are received as event_record.Event objects (name, datetime,
+    user, keys, values). The datetime is a datetime object, the rest strings.
     """
 
     global event_collection
 
-    (event_name, dt, user, other_keys) = event
+    user_id = find_or_add_user(event.user)
+
+    event_data = event.document()
+    event_data['user'] = [{'_id': user_id}]
+
+    return event_collection.insert(event_data, safe = True)
+
+def insert_events(events):
+    """
+    Insert the given events (see insert_event) with unordered bulk inserts of
+    batch_size documents. The users not yet in the database are added first.
+    """
+
+    global user_ids
+
+    add_users(set([x.user for x in events if not x.user in user_ids]))
 
-    user_id = find_or_add_user(user)
+    documents = []
+    for event in events:
+        event_data = event.document()
+        event_data['user'] = [{'_id': user_ids[event.user]}]
+        if upsert_events:
+            event_data['_id'] = event.digest().encode('hex')
+        documents.append(event_data)
 
-    event_data = [('name', event_name), ('datetime', dt), 
-                  ('user', [{'_id': user_id}])]
+    for index in range(0, len(documents), batch_size):
+        insert_documents(documents[index:index + batch_size])
 
-    event_data.extend(other_keys)
-    return event_collection.insert(dict(event_data), safe = True)
+def insert_documents(documents):
+    """
+    Insert the documents in the event collection in a single unordered
+    operation (the documents after a failed one are inserted anyway)
+    """
+
+    global event_writer
+    global write_args
+
+    if upsert_events:
+        upsert_documents(documents)
+        return
+
+    if hasattr(event_writer, 'insert_many'):
+        event_writer.insert_many(documents, ordered = False)
+    else:
+        event_writer.insert(documents, continue_on_error = True,
+                            **write_args)
+
+def upsert_documents(documents):
+    """
+    Insert in a single unordered operation the documents whose _id is not
+    present in the event collection
+    """
+
+    global event_writer
+    global write_args
+
+    # The _id is given by the filter
+    operations = [({'_id': x['_id']},
+                   {'$setOnInsert': dict([y for y in x.items()
+                                          if y[0] != '_id'])})
+                  for x in documents]
+
+    if hasattr(event_writer, 'bulk_write'):
+        event_writer.bulk_write([pymongo.UpdateOne(x, y, upsert = True)
+                                 for (x, y) in operations], ordered = False)
+    elif hasattr(event_writer, 'initialize_unordered_bulk_op'):
+        bulk = event_writer.initialize_unordered_bulk_op()
+        for (spec, update) in operations:
+            bulk.find(spec).upsert().update_one(update)
+        bulk.execute(write_args or None)
+    else:
+        for (spec, update) in operations:
+            event_writer.update(spec, update, upsert = True, **write_args)
+
+def create_indexes():
+    """
+    Create the indexes of the event collection (if not present)
+    """
+
+    global event_collection
+
+    for index in event_indexes:
+        event_collection.create_index(index)
 
 # 
 # User related function
@@ -142,14 +288,58 @@ def find_or_add_user(user):
     global dbconnection
     global user_collection
 
+    global user_ids
+
+    user_id = user_ids.get(user)
+    if user_id != None:
+        return user_id
+
     # Find
     found_obj = find_user(user)
 
     if found_obj != None:
+        user_ids[user] = found_obj['_id']
         return found_obj['_id']
 
     # Add the given user
-    return user_collection.insert({'name': user}, safe = True)
+    user_id = user_collection.insert({'name': user}, safe = True)
+    user_ids[user] = user_id
+    return user_id
+
+def add_users(users):
+    """
+    Add the given users (if not present, another process may have added them)
+    with bulk upserts, and store their ids in user_ids
+    """
+
+    global user_ids
+    global user_writer
+    global write_args
+
+    users = sorted(users)
+    for index in range(0, len(users), batch_size):
+        batch = users[index:index + batch_size]
+        if hasattr(user_writer, 'bulk_write'):
+            user_writer.bulk_write([pymongo.UpdateOne({'name': x},
+                                                      {'$setOnInsert':
+                                                           {'name': x}},
+                                                      upsert = True)
+                                    for x in batch], ordered = False)
+        elif hasattr(user_writer, 'initialize_unordered_bulk_op'):
+            bulk = user_writer.initialize_unordered_bulk_op()
+            for user in batch:
+                bulk.find({'name': user}).upsert().update_one(
+                    {'$setOnInsert': {'name': user}})
+            bulk.execute(write_args or None)
+        else:
+            for user in batch:
+                user_writer.update({'name': user}, {'$set': {'name': user}},
+                                   upsert = True, **write_args)
+
+        # Take the ids of the new users
+        user_ids.update([(x['name'], x['_id']) for x in
+                         user_collection.find({'name': {'$in': batch}},
+                                              {'name': 1})])
 
 def find_user(user):
     """
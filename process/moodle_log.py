@@ -5,8 +5,7 @@
 # 
 import sys, locale, codecs, getopt, os, glob, datetime, re
 
-import detect_new_files, rule_manager, rules_common, event_output, anonymize
-import process_filters
+import rule_manager, process_filters, pipeline, event_record, timestamps
 from lxml import etree
 
 #
@@ -33,6 +32,7 @@ config_params = {
     'files': '',                            # Files to process
     'filter_file': '',                      # File containing a function to filter events
     'filter_function': '',                  # Function to use to filter
+    'filter': '',              # Declarative filter (see filter_expr)
     'event_file_type': 'csv',  # Format of the files with events: csv or html
     'remap_pairs': '',         # Comma separated list of pairs regexp, label to
                                # rename events.
@@ -81,13 +81,7 @@ def execute(module_name):
     """
 
     global remap_pairs
-
-    # Get the window date to process events
-    (from_date, until_date) = rules_common.window_dates(module_name)
-
-    # Get the files to process, lines and mark lines
-    (files, total_lines, mark_lines) = \
-        rules_common.files_to_process(module_name)
+    global filter_function
 
     # Get the type of file to process
     event_file_type = rule_manager.get_property(None, module_name, 
@@ -105,158 +99,85 @@ def execute(module_name):
                            ']')
     remap_pairs = [(re.compile(x), y) for (x, y) in remap_pairs]
 
-    datetime_fmt = rule_manager.get_property(None, module_name, 
-                                             'datetime_format')
+    if event_file_type == 'csv':
+        parse_file = parse_csv_file
+    else:
+        parse_file = parse_html_file
+
+    # The files are exports (with headers), they are always processed in full
+    pipeline.run(module_name, parse_file, filter_function, sort_files = True,
+                 incremental = False, prefilter = True)
 
-    print >> sys.stderr, 'Processing', len(files), 'files'
-
-    # Loop over all the given args
-    total_counter = 0
-    for file_annotation in sorted(files):
-
-        # Get the file name and (if it exists, the date of the last event)
-        filename = file_annotation[0]
-        last_event = datetime.datetime.min
-        if len(file_annotation[1]) != 0:
-            last_event = datetime.datetime.strptime(file_annotation[1][0], 
-                                                        '%Y-%m-%d %H:%M:%S')
-
-        if event_file_type == 'csv':
-            total_counter = process_csv_file(module_name, 
-                                             filename, 
-                                             mark_lines, 
-                                             total_counter,
-                                             last_event, 
-                                             from_date, 
-                                             until_date,
-                                             datetime_fmt)
-        else:
-            total_counter = process_html_file(module_name, 
-                                              filename, 
-                                              mark_lines, 
-                                              total_counter,
-                                              last_event, 
-                                              from_date, 
-                                              until_date,
-                                              datetime_fmt)
-    print >> sys.stderr
-
-def process_csv_file(module_name, filename, mark_lines, total_counter, 
-                     last_event, from_date, until_date, datetime_fmt):
+def parse_csv_file(context, lines):
     """
-    Receives the following parameters:
-    - module_name: to record the modification of the file.
-    - filename: file to process in CSV format
-    - mark_lines: the number of lines to process to print out a mark
-    - total_counter: total number of lines to be processed
-    - last_event: the last event processed by this function in this file
-    - from_date - to_date: the date limits to process events
-
-    Returns the total_counter updated with the processed lines.
+    Generator parsing the lines of a Moodle log in CSV format (see
+    pipeline). Lines are split in fields:
     
-    Operations:
-    - Open the file
-    - Loop over each line 
-      - Mark a line if needed
-      - Split the line into fields
-      - Check if the date/time of the event is allowed
-      - Store the new_last_event
-      - Dump the event 
-    - Close the file
-    - Update the info in the detect_new_files
+    - Course name
+    - Date time
+    - IP
+    - Username
+    - Event name
+    - Resource
 
+    Lines terminated by \x0D are ignored.
     """
 
-    global filter_function
-
-    new_last_event = last_event
-
-    data_in = codecs.open(filename, 'r', encoding = 'utf8', errors = 'replace')
-    old = ''
-    counter = 0
-    for line in data_in:
-        counter += 1
-        total_counter += 1
-        if total_counter % mark_lines == 0:
-            print >> sys.stderr, '+',
-            sys.stderr.flush()
+    datetime_fmt = rule_manager.get_property(None, context.module_name, 
+                                             'datetime_format')
 
+    for line in lines:
         line = line[:-1]
         
-        # Detect, accumulate \x0D to be removed
-        if line[-1] == '\x0D':
-            old = old + line[:-1]
+        # Detect \x0D to be removed
+        if line == '' or line[-1] == '\x0D':
             continue
 
-        # If there is something in old, dump it
-        if old != '':
-            old = ''
-
         # Check the number of fields and skip lines without 6 fields
         fields = line.split('\t')
         if len(fields) != 6:
             continue
 
-        # Dump event and remember the last one
-        new_last_event = check_data_and_dump_event(fields,
-                                                   datetime_fmt,
-                                                   last_event,
-                                                   new_last_event,
-                                                   from_date, 
-                                                   until_date)
-
-    data_in.close()
-    detect_new_files.update(None, module_name + '//' + filename, 
-                                [new_last_event])
+        if not context.accept(fields):
+            continue
 
-    return total_counter
+        item = create_event(fields, datetime_fmt)
+        if item != None:
+            yield item
 
-def process_html_file(module_name, filename, mark_lines, total_counter, 
-                      last_event, from_date, until_date, datetime_fmt):
+def parse_html_file(context, lines):
     """
-    Receives the following parameters:
-    - module_name: to record the file modification
-    - filename: file to process in CSV format
-    - mark_lines: the number of lines to process to print out a mark
-    - total_counter: total number of lines to be processed
-    - last_event: the last event processed by this function in this file
-    - from_date - to_date: the date limits to process events
-
-    Returns the total_counter updated with the processed lines.
-    
-    Operations:
-    - Open the file
+    Generator parsing a Moodle log in HTML format (see pipeline). The lines
+    are not used, the file is parsed as a whole:
+
     - Parse the file
     - Obtain the table element
-    - Loop over each table line
-      - Mark a line if needed
-      - Split the line into fields
-      - Check if the date/time of the event is allowed
-      - Store the new_last_event
-      - Dump the event 
-    - Close the file
-    - Update the info in the detect_new_files
-
+    - Loop over each table line and split the line into fields (see
+      parse_csv_file)
     """
 
     global html_parser
     global xpath_get_table
 
-    new_last_event = last_event
+    datetime_fmt = rule_manager.get_property(None, context.module_name, 
+                                             'datetime_format')
 
     try:
-        tree = etree.parse(filename, html_parser)
+        tree = etree.parse(context.filename, html_parser)
     except etree.XMLSyntaxError, e:
-        print >> sys.stderr, 'Error while parsing', filename
+        print >> sys.stderr, 'Error while parsing', context.filename
         print str(e)
         sys.exit(1)
 
+    # The whole file has been read (the lines are not consumed)
+    context.progress.advance(os.path.getsize(context.filename))
+
     # Get the table rows except the first one that is the header
     table_rows = xpath_get_table(tree.getroot())[1:]
     
     if len(table_rows) == 0:
         # If no rows, empty table
-        return total_counter
+        return
 
     # Rows have the format:
     # Date, IP address, User name, Action, Information
@@ -272,6 +193,8 @@ def process_html_file(module_name, filename, mark_lines, total_counter,
 
     # Loop over all the rows
     for row_elem in table_rows:
+        context.line_number += 1
+
         # print(etree.tostring(row_elem, pretty_print=True))
         date_raw_string = row_elem[0].text.partition(' ')[2]
         ip_raw_string = row_elem[1][0].text
@@ -290,81 +213,42 @@ def process_html_file(module_name, filename, mark_lines, total_counter,
         fields = (course_name, date_raw_string, ip_raw_string, user_id,
                   event_name, resource)
 
-        # Dump event and remember the last one
-        new_last_event = check_data_and_dump_event(fields,
-                                                   datetime_fmt,
-                                                   last_event,
-                                                   new_last_event,
-                                                   from_date, 
-                                                   until_date)
-
-    detect_new_files.update(None, module_name + '//' + filename, 
-                                [new_last_event])
+        if not context.accept(fields):
+            continue
 
-        
-    return total_counter
+        item = create_event(fields, datetime_fmt)
+        if item != None:
+            yield item
 
-def check_data_and_dump_event(fields, datetime_fmt, last_event, new_last_event, 
-                              from_date, until_date):
+def create_event(fields, datetime_fmt):
     """
-    Given a tuple with fields, check for some properties and dump the event. The
-    field must have:
-    
-    - Course name
-    - Date time
-    - IP
-    - Username
-    - Event name
-    - Resource
+    Given a tuple with fields (see parse_csv_file), return the triplet (dtime,
+    fields, event) or None if the date cannot be parsed.
     """
 
-    global filter_function
+    global remap_pairs
 
     # Translate date time of the event
     try:
-        dtime = datetime.datetime.strptime(fields[1].strip(), 
-                                           datetime_fmt)
+        dtime = timestamps.parse(fields[1].strip(), datetime_fmt)
     except ValueError, v:
         print >> sys.stderr, 'Skipping line due to date', fields[1].strip()
-        return new_last_event
-
-    if dtime <= last_event:
-        # Event is older than what has been recorded in the
-        # detect_new_files. skip
-        return new_last_event
-
-    if dtime < from_date or dtime > until_date:
-        # Ignore event because it is outside the window
-        return new_last_event
+        return None
 
     # Obtain the event type and apply the remap_pairs
     event_type = 'lms_' + fields[4].replace(' ', '_')
     # Apply the mapping
     event_type = next((y for (x, y) in remap_pairs 
-                       if x.search(item_name) != None), event_type)
-    
-    # If there is a filter function and returns None, skip this event
-    if filter_function != None and filter_function(fields) == None:
-        return new_last_event
+                       if x.search(event_type) != None), event_type)
     
-    # Record the event with the highest datetime.
-    if dtime > new_last_event:
-        new_last_event = dtime
-
     # Create the event data structure
-    event = (event_type, dtime, 
-             anonymize.find_or_encode_string(fields[3]),
-             [('application', 'moodle'), ('community', fields[0]), 
-              ('ip', fields[2]), ('resource', fields[5])])
+    event = event_record.Event(event_type, dtime, fields[3],
+                               [('application', 'moodle'), 
+                                ('community', fields[0]), 
+                                ('ip', fields[2]), 
+                                ('resource', fields[5])])
     
-    try:
-        event_output.out(event)
-    except Exception, e:
-        print 'Exception while processing', filename, ':', counter
-        print str(e)
-        sys.exit(1)
-
-    return new_last_event
+    return (dtime, fields, event)
 
 def main():
     """
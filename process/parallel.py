@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Functions to execute the rules in a pool of worker processes. The auxiliary
+# modules (ldap_lookup, anonymize, event_output) are initialized in the parent
+# process before the pool is created, thus the workers inherit their state. The
+# workers do not dump the events, they capture them in a temporary file (see
+# EventSpool) that the parent reads and dumps in the configured output in the
+# same order in which the rules appear in the configuration. Thus the memory
+# used does not depend on the number of events of a task. The checkpoints of
+# the files made by the workers (see pipeline.FileContext) are recorded in the
+# file too, and the parent stores them once the previous events are written.
+# The workers share the anonymize map through its files (see
+# anonymize_store).
+#
+# Rules processing files may also be sharded: each of their files is processed
+# by a different task and the parent dumps the events in the same order in
+# which the files would be processed sequentially.
+#
+# At most tasks_per_job tasks per worker are submitted and not yet dumped, so
+# the files of the tasks finished ahead of the one being dumped are bounded.
+#
+import sys, locale, codecs, os, multiprocessing, tempfile, cPickle, shutil
+import collections
+
+import detect_new_files, event_output, rules_common, metrics
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Modules with a bogus execute function. They are executed in the parent.
+auxiliary_modules = set(['ldap_lookup', 'anonymize', 'event_output'])
+
+# Modules that obtain their files through rules_common.files_to_process and
+# process each file independently. They can be sharded by file.
+file_modules = set(['moodle_log', 'apache_log', 'bash_log', 'firefox_log',
+                    'kate_log', 'kdevelop_log', 'gdb_log', 'gcc_log',
+                    'valgrind_log', 'svn_apache', 'embeddedq_log'])
+
+# Number of events written to the file of a task in a single operation
+spool_batch_size = 1000
+
+# Directory with the files of the tasks (created by execute_rules)
+spool_directory = None
+
+# Maximum number of tasks submitted and not yet dumped, per worker process
+tasks_per_job = 2
+
+class EventSpool(object):
+    """
+    Events captured in a worker process (see event_output.captured_events),
+    written to a temporary file as a sequence of pickled objects: lists of
+    events, and dictionaries with the entries of detect_new_files.file_data
+    stored at the checkpoints (when the output is flushed). See read_spool.
+    """
+
+    def __init__(self, directory):
+        (handle, self.file_name) = tempfile.mkstemp(prefix = 'task-',
+                                                    dir = directory)
+        self.data_out = os.fdopen(handle, 'wb')
+        self.batch = []
+
+    def append(self, event):
+        self.batch.append(event)
+        if len(self.batch) >= spool_batch_size:
+            self.write_batch()
+
+    def extend(self, events):
+        self.batch.extend(events)
+        if len(self.batch) >= spool_batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        if self.batch == []:
+            return
+        cPickle.dump(self.batch, self.data_out, 2)
+        self.batch = []
+
+    def flush(self):
+        """
+        Write the events so far followed by the data stored in
+        detect_new_files (deferred in the workers), to be stored by the parent
+        after writing them
+        """
+
+        self.write_batch()
+        if detect_new_files.file_data != None:
+            cPickle.dump(dict(detect_new_files.file_data.deferred),
+                         self.data_out, 2)
+
+    def close(self):
+        self.write_batch()
+        self.data_out.close()
+
+def read_spool(file_name):
+    """
+    Generator with the objects written by an EventSpool in the given file. The
+    file is removed.
+    """
+
+    data_in = open(file_name, 'rb')
+    try:
+        while True:
+            try:
+                yield cPickle.load(data_in)
+            except EOFError:
+                return
+    finally:
+        data_in.close()
+        os.remove(file_name)
+
+def execute_rule(task):
+    """
+    Function executed in a worker process. The task is a pair (module_name,
+    files) where files is either None (process all the files of the rule) or a
+    list of pairs (file, annotation) as returned by
+    rules_common.files_to_process. Runs the execute function of the given rule
+    capturing the events in a file instead of dumping them. Returns the tuple
+
+    (module_name, exit_code, spool_name, file_data, values)
+
+    where spool_name is the file with the events (see EventSpool), file_data
+    is a dictionary with the entries modified in detect_new_files.file_data,
+    and values are the metrics of the task (see metrics.take).
+    """
+
+    (module_name, files) = task
+    module_prefix = module_name.split('.')[0]
+
+    # Remember the state that needs to be propagated to the parent. The
+    # events are dumped by the parent, thus the modifications in
+    # detect_new_files are not stored by the worker, they are deferred and
+    # stored by the parent after dumping the events.
+    if detect_new_files.file_data != None:
+        detect_new_files.file_data.defer()
+
+    # Discard the metrics inherited from the parent
+    metrics.take()
+
+    if files == None:
+        print >> sys.stderr, '### Execute' , module_name
+
+    spool = EventSpool(spool_directory)
+    event_output.captured_events = spool
+    rules_common.forced_files = files
+    exit_code = 0
+    try:
+        metrics.execute(module_name,
+                        getattr(sys.modules[module_prefix], 'execute'))
+    except SystemExit, e:
+        # sys.exit would kill the worker and leave the pool waiting forever
+        exit_code = e.code
+        if exit_code == None:
+            exit_code = 0
+    spool.close()
+    event_output.captured_events = None
+    rules_common.forced_files = None
+
+    file_data = {}
+    if detect_new_files.file_data != None:
+        file_data = detect_new_files.file_data.take_deferred()
+
+    return (module_name, exit_code, spool.file_name, file_data,
+            metrics.take())
+
+def write_spool(module_name, spool_name):
+    """
+    Give the events in the file of a task to event_output, storing the data of
+    the checkpoints once the previous events are written (as
+    pipeline.FileContext.checkpoint does)
+    """
+
+    for item in read_spool(spool_name):
+        if isinstance(item, list):
+            metrics.execute(module_name,
+                            lambda name: event_output.out_batch(item))
+            continue
+
+        event_output.after_flush(lambda data = item:
+                                     detect_new_files.file_data.update(data))
+        event_output.flush()
+        detect_new_files.save_file_data()
+
+def execute_rules(rules, jobs, shard = False):
+    """
+    Given the list of rules (already initialized) execute them using a pool
+    with the given number of worker processes. If jobs is zero, the number of
+    CPUs is used. If shard is True, the rules processing files are split in one
+    task per file. The events produced by each task are dumped in the order in
+    which the rules (and their files) are given.
+    """
+
+    global spool_directory
+
+    if jobs <= 0:
+        jobs = multiprocessing.cpu_count()
+
+    # Auxiliary rules are executed in the parent, the rest are collected
+    tasks = []
+    for module_name in rules:
+        module_prefix = module_name.split('.')[0]
+        if module_prefix in auxiliary_modules:
+            metrics.execute(module_name,
+                            getattr(sys.modules[module_prefix], 'execute'))
+            continue
+
+        if not shard or not module_prefix in file_modules:
+            tasks.append((module_name, None))
+            continue
+
+        # Sharded rule, one task per file
+        files = rules_common.expand_files(module_name)
+        print >> sys.stderr, '### Execute' , module_name, '(' + \
+            str(len(files)) + ' files)'
+        tasks.extend([(module_name, [x]) for x in files])
+
+    if tasks == []:
+        return
+
+    spool_directory = tempfile.mkdtemp(prefix = 'pla-tasks-')
+    jobs = min(jobs, len(tasks))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Tasks submitted, in order
+        pending = collections.deque()
+        next_task = 0
+        while len(pending) > 0 or next_task < len(tasks):
+            while next_task < len(tasks) and \
+                    len(pending) < jobs * tasks_per_job:
+                pending.append(pool.apply_async(execute_rule,
+                                                (tasks[next_task],)))
+                next_task += 1
+
+            (module_name, exit_code, spool_name, file_data,
+             values) = pending.popleft().get()
+
+            metrics.merge(values)
+            write_spool(module_name, spool_name)
+
+            # Incorporate the changes made in the worker once its events are
+            # written
+            if detect_new_files.file_data != None:
+                event_output.after_flush(
+                    lambda data = file_data:
+                        detect_new_files.file_data.update(data))
+
+            if exit_code != 0:
+                print >> sys.stderr, 'Rule', module_name, 'terminated with',
+                print >> sys.stderr, 'error'
+                pool.terminate()
+                sys.exit(exit_code)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(spool_directory, True)
+        spool_directory = None
+
+    return
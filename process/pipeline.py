@@ -0,0 +1,500 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Streaming pipeline to process the files of a rule. Each file is processed
+# by a chain of generators (stages):
+#
+#   read_lines -> parse_file -> after_last_event -> in_window -> apply_filter
+#              -> record_last_event -> anonymize_user -> write_events
+#
+# The parser modules only provide the generator parse_file(context, lines)
+# receiving the lines of the file and yielding triplets
+#
+#   (dtime, fields, event)
+#
+# where dtime is the datetime of the event, fields is the list given to the
+# filter function of the rule, and event is an event_record.Event (with the
+# user not anonymized yet).
+#
+# The stages between the parser and the output are functions stage(items,
+# context) returning an iterator. The list of stages can be given to run to
+# reorder the predicates, or to insert additional stages (for example,
+# threaded to execute the upstream stages in a separate thread).
+#
+# For incremental rules, the byte offset after the line that completed the last
+# event given by the parser is recorded in detect_new_files (see
+# detect_new_files.file_position). In the following executions, the file is read
+# from that offset, unless it was rotated or truncated. The position is also
+# checkpointed every checkpoint_bytes while processing the file (after flushing
+# event_output), so that an interrupted execution resumes near where it
+# stopped.
+#
+# A last line without end of line (the file may be still being written) is
+# processed (unless complete_lines), but the offset recorded is that of the
+# last item completed before it, so that it is read again whole. The end of
+# the line is recorded too, and in the next execution the items of the lines
+# starting before it are dropped if not newer than the last event recorded,
+# as they were given in the previous execution (see after_last_event).
+#
+# If the filter of the rule has a declarative expression (see filter_expr), the
+# parsers supporting it (run with prefilter = True) apply the expression with
+# context.accept(fields) as soon as the fields are available, before translating
+# the date and creating the event.
+#
+import sys, locale, codecs, os, datetime, threading, Queue, time, traceback
+
+import detect_new_files, rules_common, anonymize, event_output, timestamps
+import metrics, filter_expr, ldap_lookup
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Number of events given to event_output in a single operation
+batch_size = 1000
+
+# Bytes of a file processed between two checkpoints of its position
+checkpoint_bytes = 64 * 1048576
+
+# If True, a last line without end of line is not processed (it may be still
+# being written, see daemon)
+complete_lines = False
+
+class FileContext(object):
+    """
+    Information shared by all the stages processing a file
+    """
+
+    def __init__(self, module_name, filename, annotation, from_date,
+                 until_date, filter_function, progress, incremental = False,
+                 prefilter = None):
+        global checkpoint_bytes
+
+        self.module_name = module_name
+        self.filename = filename
+        self.from_date = from_date
+        self.until_date = until_date
+        self.filter_function = filter_function
+        self.prefilter = prefilter
+        self.progress = progress
+        self.line_number = 0
+
+        # Counters of the items given by the parser and dropped by the stages
+        # (see metrics)
+        self.counters = {'items_parsed': 0, 'skipped_last_event': 0,
+                         'skipped_window': 0, 'filtered': 0, 
+                         'events_emitted': 0}
+
+        # Date of the last event processed in a previous execution
+        self.last_event = datetime.datetime.min
+        if len(annotation) != 0 and annotation[0] != None:
+            self.last_event = timestamps.parse_iso(str(annotation[0]))
+        self.new_last_event = self.last_event
+
+        # Offset of the next line to read (excluding a last line without end
+        # of line), offset after the line that completed the last event parsed
+        # and the one before it, and if a last line without end of line has
+        # been read, its end (see read_lines)
+        self.offset = 0
+        self.event_offset = 0
+        self.item_start = 0
+        self.partial_end = 0
+
+        # End of the part of the file read again, processed in a previous
+        # execution (see after_last_event), or zero
+        self.rescan_end = 0
+
+        # Offsets are only recorded for incremental rules
+        self.incremental = incremental
+        self.checkpoint_bytes = None
+        if incremental:
+            self.offset = detect_new_files.resume_offset(filename, 
+                                                         annotation[1:])
+            self.event_offset = self.offset
+            self.checkpoint_bytes = checkpoint_bytes
+            if self.offset != 0 and len(annotation) > 5:
+                self.rescan_end = int(annotation[5])
+
+        # The events sorted by time are written at the end (see event_output)
+        if event_output.ordered_events != None:
+            self.checkpoint_bytes = None
+
+        # The previous events are in the part of the file already processed
+        # (except those read again, see after_last_event)
+        if self.offset != 0 and self.rescan_end == 0:
+            self.last_event = datetime.datetime.min
+        self.checkpoint_offset = self.offset
+
+        # User ids when the file is stored in a directory named as the user
+        self.user_id = None
+        self.anon_user_id = None
+
+    def set_user_from_path(self):
+        """
+        Take the user id from the name of the directory containing the file
+        """
+        self.user_id = self.filename.split('/')[-2]
+        self.anon_user_id = anonymize.find_or_encode_string(self.user_id)
+
+    def scrub(self, line):
+        """
+        Replace the user ids (of the owner of the file and of any other user
+        known to anonymize) by their anonymized version in the given line
+        """
+        if self.user_id != None and self.user_id in line:
+            line = line.replace(self.user_id, self.anon_user_id)
+        return anonymize.scrub(line)
+
+    def accept(self, fields):
+        """
+        Apply the prefilter to the fields given by the parser. Returns False if
+        the item must be dropped.
+        """
+
+        if self.prefilter == None or self.prefilter(fields) != None:
+            return True
+
+        self.counters['filtered'] += 1
+        # Nothing before this point needs to be processed again
+        if self.partial_end == 0:
+            self.event_offset = self.offset
+        return False
+
+    def checkpoint(self, final = False):
+        """
+        Record in detect_new_files the date of the last event and (for
+        incremental rules) the position of the file. If final, the data is
+        recorded once the events are written (see event_output.after_flush).
+        If not, the events are flushed, the file is marked to be processed
+        again, and the data in detect_new_files is saved (in the worker
+        processes, see parallel.EventSpool, this happens when the parent
+        writes the events).
+        """
+
+        other_data = [self.new_last_event]
+        if self.incremental:
+            other_data.extend(detect_new_files.file_position(self.filename,
+                                                             self.event_offset))
+            other_data.append(self.partial_end)
+        self.checkpoint_offset = self.event_offset
+
+        if final:
+            # The modification time is that of the data processed
+            key = self.module_name + '//' + self.filename
+            modification_time = os.path.getmtime(self.filename)
+            event_output.after_flush(lambda: detect_new_files.update(None,
+                key, other_data, modification_time))
+            return
+
+        key = self.module_name + '//' + self.filename
+        event_output.after_flush(lambda: detect_new_files.update(None,
+            key, other_data, modification_time = 0))
+        event_output.flush()
+        detect_new_files.save_file_data()
+
+################################################################################
+#
+# Stages
+#
+################################################################################
+def read_lines(context):
+    """
+    Yield the lines in the file (decoded as utf-8) starting at the offset in
+    the context, and advance the progress with the number of bytes read. A
+    last line without end of line is not included in the offset (see the top
+    of the module).
+    """
+
+    global complete_lines
+
+    advance = context.progress.advance
+    data_in = open(context.filename, 'rb')
+    try:
+        if context.offset != 0:
+            data_in.seek(context.offset)
+            advance(context.offset)
+
+        for line in data_in:
+            advance(len(line))
+            # A last line without end of line may be incomplete
+            if line[-1:] != '\n':
+                if complete_lines:
+                    break
+                context.partial_end = context.offset + len(line)
+            else:
+                context.offset += len(line)
+            context.line_number += 1
+            yield line.decode('utf-8', 'replace')
+    finally:
+        data_in.close()
+
+def mark_offset(items, context):
+    """
+    Record the offset after the line that completed each item given by the
+    parser (must be the stage right after the parser). The items given after
+    reading a last line without end of line keep the offset of the previous
+    one, to be read again.
+    """
+
+    counters = context.counters
+    for item in items:
+        context.item_start = context.event_offset
+        if context.partial_end == 0:
+            context.event_offset = context.offset
+        counters['items_parsed'] += 1
+        yield item
+
+def after_last_event(items, context):
+    """
+    Drop the events older than what has been recorded in detect_new_files. If
+    the file is read from an offset, only the items starting in the part
+    processed in the previous execution (up to rescan_end) are compared.
+    """
+
+    last_event = context.last_event
+    counters = context.counters
+    for item in items:
+        if context.rescan_end != 0 and \
+                context.item_start >= context.rescan_end:
+            context.rescan_end = 0
+            last_event = datetime.datetime.min
+        if item[0] > last_event:
+            yield item
+        else:
+            counters['skipped_last_event'] += 1
+
+def in_window(items, context):
+    """
+    Drop the events outside the window given by from_date and until_date
+    """
+
+    from_date = context.from_date
+    until_date = context.until_date
+    counters = context.counters
+    for item in items:
+        if item[0] < from_date or item[0] > until_date:
+            counters['skipped_window'] += 1
+            continue
+        yield item
+
+def apply_filter(items, context):
+    """
+    Drop the events for which the filter function of the rule returns None
+    """
+
+    filter_function = context.filter_function
+    if filter_function == None:
+        return items
+
+    return filtered_items(items, context, filter_function)
+
+def filtered_items(items, context, filter_function):
+    """
+    Generator with the items accepted by the filter function
+    """
+
+    counters = context.counters
+    for item in items:
+        if filter_function(item[1]) != None:
+            yield item
+        else:
+            counters['filtered'] += 1
+
+def record_last_event(items, context):
+    """
+    Record the event with the highest datetime in the context
+    """
+
+    for item in items:
+        if item[0] > context.new_last_event:
+            context.new_last_event = item[0]
+        yield item
+
+def anonymize_user(items, context):
+    """
+    Anonymize the user of the events. From this stage on, the items are the
+    events. If the users are looked up in a directory, the new users of each
+    batch of batch_size items are looked up at once (see anonymize.prefetch).
+    """
+
+    global batch_size
+
+    find_or_encode_string = anonymize.find_or_encode_string
+    if ldap_lookup.backend == None:
+        for (dtime, fields, event) in items:
+            event.user = find_or_encode_string(event.user)
+            yield event
+        return
+
+    # The items are read ahead, thus the position of each one is restored
+    # when its event is given
+    batch = []
+    for (dtime, fields, event) in items:
+        batch.append((event, context.event_offset))
+        if len(batch) < batch_size:
+            continue
+        for event in anonymize_batch(batch, context):
+            yield event
+        batch = []
+    for event in anonymize_batch(batch, context):
+        yield event
+
+def anonymize_batch(batch, context):
+    """
+    Anonymize the user of the events in the list of pairs (event, offset)
+    given by anonymize_user, looking them up at once
+    """
+
+    find_or_encode_string = anonymize.find_or_encode_string
+    anonymize.prefetch([x[0].user for x in batch])
+    for (event, offset) in batch:
+        context.event_offset = offset
+        event.user = find_or_encode_string(event.user)
+        yield event
+
+def threaded(items, context, queue_size = 1000):
+    """
+    Consume the given items in a separate thread. Allows to overlap the stages
+    before this one (for example, reading and parsing) with those after. The
+    thread runs ahead of the output, thus the file position is not
+    checkpointed until the end of the file.
+    """
+
+    context.checkpoint_bytes = None
+
+    queue = Queue.Queue(queue_size)
+    end_mark = object()
+    error = []
+
+    def producer():
+        try:
+            for item in items:
+                queue.put(item)
+        except BaseException:
+            error.append(sys.exc_info())
+        queue.put(end_mark)
+
+    thread = threading.Thread(target = producer)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item = queue.get()
+        if item is end_mark:
+            break
+        yield item
+
+    thread.join()
+    if error != []:
+        raise error[0][0], error[0][1], error[0][2]
+
+def write_events(events, context):
+    """
+    Terminal stage. Give the events to event_output in batches, and checkpoint
+    the position in the file every checkpoint_bytes (see FileContext).
+    """
+
+    global batch_size
+
+    batch = []
+    try:
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                context.counters['events_emitted'] += len(batch)
+                event_output.out_batch(batch)
+                batch = []
+                if context.checkpoint_bytes != None and \
+                        context.event_offset - context.checkpoint_offset >= \
+                        context.checkpoint_bytes:
+                    context.checkpoint()
+        context.counters['events_emitted'] += len(batch)
+        event_output.out_batch(batch)
+    except Exception:
+        print >> sys.stderr, 'Exception while processing', \
+            context.filename, ':', context.line_number
+        traceback.print_exc()
+        sys.exit(1)
+
+# Stages applied to the output of the parser
+default_stages = [after_last_event, in_window, apply_filter, record_last_event,
+                  anonymize_user]
+
+################################################################################
+
+def run(module_name, parse_file, filter_function, user_from_path = False,
+        sort_files = False, stages = None, incremental = True,
+        prefilter = False):
+    """
+    Process all the files of the given rule. Each file is read, parsed with the
+    given parse_file generator, and processed by the stages (default_stages if
+    none are given). The events are then given to event_output and the date of
+    the last event is recorded in detect_new_files.
+
+    If user_from_path is True, the user is the name of the directory containing
+    each file (available in the context). If sort_files is True, the files are
+    processed in alphabetical order. If incremental is True, the file is
+    processed from the offset recorded in the previous execution (the parser
+    must not carry information between events). If prefilter is True, the
+    parser applies the declarative part of the filter with context.accept.
+    """
+
+    global default_stages
+
+    if stages == None:
+        stages = default_stages
+
+    # Split the declarative filter applied by the parser
+    prefilter_function = None
+    if isinstance(filter_function, filter_expr.Filter):
+        if prefilter:
+            prefilter_function = filter_function.predicate
+            filter_function = filter_function.function
+        elif filter_function.function == None:
+            filter_function = filter_function.predicate
+
+    # Get the window date to process events
+    (from_date, until_date) = rules_common.window_dates(module_name)
+
+    # Get the files to process and their total size
+    (files, total_bytes, mark_bytes) = \
+        rules_common.files_to_process(module_name)
+
+    if sort_files:
+        files = sorted(files)
+
+    progress = rules_common.Progress(total_bytes)
+    for (filename, annotation) in files:
+        context = FileContext(module_name, filename, annotation, from_date,
+                              until_date, filter_function, progress,
+                              incremental, prefilter_function)
+        if user_from_path:
+            context.set_user_from_path()
+
+        # Chain the stages (timed if the metrics are enabled)
+        timing = metrics.StageTiming()
+        items = timing.wrap(read_lines(context), 'read')
+        items = timing.wrap(mark_offset(parse_file(context, items), context),
+                            'parse')
+        for stage in stages:
+            items = timing.wrap(stage(items, context), stage.__name__)
+
+        wall = time.time()
+        cpu = time.clock()
+        write_events(items, context)
+        timing.finish('output', time.time() - wall, time.clock() - cpu)
+
+        context.checkpoint(final = True)
+
+        metrics.count('files')
+        metrics.count('lines_read', context.line_number)
+        for (name, value) in context.counters.items():
+            metrics.count(name, value)
+
+    progress.finish()
@@ -5,7 +5,7 @@
 # 
 import sys, locale, codecs, os
 
-import rule_manager
+import rule_manager, filter_expr
 
 # Fix the output encoding when redirecting stdout
 if sys.stdout.encoding is None:
@@ -21,7 +21,12 @@ def initialize_filter(module_name):
     function. Imports the file and if a function with name "initialize_"
     followed by filter_function is found, it is executed. Modifies the
     dictionary so that filter_function points to the function instead of the
-    name.  """
+    name.
+
+    If the rule has a "filter" option, the expression is compiled (see
+    filter_expr) and the returned function is a filter_expr.Filter applying
+    the expression and then the filter function (if any).
+    """
 
     filter_file = rule_manager.get_property(None, module_name, 'filter_file')
     function = None
@@ -65,5 +70,14 @@ def initialize_filter(module_name):
             print str(e)
             sys.exit(1)
 
+    expression = rule_manager.get_property(None, module_name, 'filter')
+    if expression != '':
+        try:
+            function = filter_expr.Filter(expression, function)
+        except ValueError, e:
+            print >> sys.stderr, 'Incorrect filter in', module_name
+            print >> sys.stderr, str(e)
+            sys.exit(1)
+
     return function
 
@@ -52,6 +52,13 @@
 #   manager is needed in an application. This rule manager is assumed to be the
 #   default one and is used when the functions receive a "None" parameter as
 #   manager.
+#
+#   6.- The values obtained with get_property are memoized, thus looking up the
+#   same rule.option repeatedly (for example, once per processed event) costs
+#   a dictionary access. The memoized values are discarded whenever a value is
+#   modified with set_property. The counter "generation" is incremented every
+#   time this happens so that other modules may keep their own derived values
+#   and detect when they are stale.
 
 
 import sys, os, re, datetime, ConfigParser, StringIO, ordereddict, atexit
@@ -66,6 +73,13 @@ _given_definiton_rule_name = "__GIVEN_DEFINITIONS_RULE_NAME__"
 
 options = None
 
+# Dictionary with the values already resolved by get_property. Keys are
+# triplets (id(config), rule, option).
+_resolved_properties = {}
+
+# Number of times the resolved values have been discarded
+generation = 0
+
 def get_config_parser(fileName):
     """
     Given a set of files, returns the resulting ConfigParser object after being
@@ -106,6 +120,18 @@ def flush_config_parsers():
 #
 atexit.register(flush_config_parsers);
 
+def flush_resolved_properties():
+    """
+    Discard the values memoized by get_property
+    """
+
+    global _resolved_properties
+    global generation
+
+    _resolved_properties = {}
+    generation += 1
+    return
+
 def load_config_file(config, filename, aliasDict, includeChain = None):
     """
     Function that receives a set of config options (ConfigParser) and a
@@ -168,6 +194,7 @@ def load_config_file(config, filename, aliasDict, includeChain = None):
         print >> sys.stderr, str(msg)
         defaultsIO.close()
         sys.exit(1)
+    flush_resolved_properties()
 
     # Move all options to the given config but checking if they are legal
     result = (set([filename]), [])
@@ -312,6 +339,7 @@ def treat_template(config, filename, newOptions, sname, aliasDict, includeChain)
 
     # Remove rule from the original config:
     config.remove_section(sname)
+    flush_resolved_properties()
 
     # Process the template files recursively!
     result = (set([]), [])
@@ -386,15 +414,35 @@ def get_property(config, rule, option):
     and if not found, it keeps asking for the values in the rules obtained by
     dropping the last suffix (from the last dot until the end of the rule
     name.
+
+    The values are memoized until the next invocation of set_property.
     """
 
-    global _given_definiton_rule_name
+    global _resolved_properties
     global options
 
     # If no config is given, use the local to the module
     if config == None:
         config = options
 
+    key = (id(config), rule, option)
+    try:
+        return _resolved_properties[key]
+    except KeyError:
+        pass
+
+    result = resolve_property(config, rule, option)
+    _resolved_properties[key] = result
+    return result
+
+def resolve_property(config, rule, option):
+    """
+    Obtain the value of rule.option traversing the rule hierarchy (see
+    get_property) without using the memoized values.
+    """
+
+    global _given_definiton_rule_name
+
     # If the rule is a.b.c, loop asking if we have the option a.b.c.option,
     # then a.b.option, and then a.option.
     partialRule = rule
@@ -438,6 +486,9 @@ def set_property(config, rule, option, value, fileName = None,
     # Obtain the rule prefix
     rulePrefix = rule.split('.')[0]
 
+    # Any memoized value may depend on the one being modified
+    flush_resolved_properties()
+
     # Check if the rule is allowed,
     if (not createRule) and (not config.has_section(rulePrefix)):
         # Rule prefix does not exist in config, and creation is not allowed
@@ -450,7 +501,7 @@ def set_property(config, rule, option, value, fileName = None,
     # See if the option is already present in the config
     try:
         optionPresent = True
-        get_property(config, rule, option)
+        resolve_property(config, rule, option)
     except ConfigParser.NoOptionError:
         optionPresent = False
 
@@ -490,6 +541,9 @@ def initial_config(configDefaults):
 
     global _given_definiton_rule_name
 
+    # A new config may reuse the id of a discarded one
+    flush_resolved_properties()
+
     result = ConfigParser.SafeConfigParser(configDefaults,
                                            ordereddict.OrderedDict)
 
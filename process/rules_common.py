@@ -4,7 +4,7 @@
 # Functions that are common to all the rules
 #
 # 
-import sys, locale, codecs, os, glob, datetime
+import sys, locale, codecs, os, glob, datetime, time
 
 import rule_manager, detect_new_files
 
@@ -16,23 +16,105 @@ if sys.stdout.encoding is None:
         # sw will encode Unicode data to the locale-specific character set.
         sys.stdout = sw(sys.stdout)
 
-def file_len(fname):
+# When not None, list of pairs (file, annotation) returned by files_to_process
+# instead of expanding the "files" variable (used to execute a rule over a
+# subset of its files in a worker process).
+forced_files = None
+
+# Dictionary with the pairs module_name: (generation, (from_date, until_date))
+# computed by window_dates. The generation is the one of rule_manager when the
+# dates were computed.
+_window_dates = {}
+
+class Progress(object):
     """
-    Calculate the file length
+    Print a tick in stderr every time 1/40 of the total amount of work has been
+    processed. Every 10 ticks, the percentage, the rate and the estimated time
+    to finish are printed as well. The amounts are divided by scale and shown
+    with the given unit.
     """
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+
+    def __init__(self, total, unit = 'MB', scale = 1048576):
+        self.total = total
+        self.mark = total / 40 + 1
+        self.counter = 0
+        self.unit = unit
+        self.scale = float(scale)
+        self.start = time.time()
+
+    def advance(self, amount = 1):
+        """
+        Account for the given amount of work
+        """
+        old_counter = self.counter
+        self.counter += amount
+        if old_counter / self.mark == self.counter / self.mark:
+            return
+
+        print >> sys.stderr, '+',
+        if (self.counter / self.mark) % 10 == 0:
+            print >> sys.stderr, self.status(),
+        sys.stderr.flush()
+
+    def rate(self):
+        """
+        Amount of work per second (scaled)
+        """
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0.0
+        return self.counter / self.scale / elapsed
+
+    def eta(self):
+        """
+        Estimated number of seconds until all the work is processed
+        """
+        rate = self.rate() * self.scale
+        if rate == 0:
+            return None
+        return max(self.total - self.counter, 0) / rate
+
+    def status(self):
+        """
+        String with the percentage, rate and estimated time to finish
+        """
+        percentage = 100
+        if self.total > 0:
+            percentage = min(100 * self.counter / self.total, 100)
+        eta = self.eta()
+        if eta == None:
+            eta = '?'
+        else:
+            eta = str(datetime.timedelta(seconds = int(eta)))
+        return '(%d%%, %.1f %s/s, ETA %s)' % (percentage, self.rate(), 
+                                             self.unit, eta)
+
+    def finish(self):
+        """
+        Terminate the line of ticks with the total amount and rate
+        """
+        if self.counter == 0:
+            print >> sys.stderr
+            return
+
+        print >> sys.stderr, '%.1f %s in %.1f s (%.1f %s/s)' % \
+            (self.counter / self.scale, self.unit, time.time() - self.start,
+             self.rate(), self.unit)
 
 def window_dates(module_name):
     """
     Given a module name, it obtains from the global rule_manager object the
     value of the variables 'from_date' and 'until_date'. Translates them to
     datetime.datetime objects and returns the pair (from_date, until_date) as
-    result.
+    result. The result is memoized while the configuration is not modified.
     """
 
+    global _window_dates
+
+    cached = _window_dates.get(module_name)
+    if cached != None and cached[0] == rule_manager.generation:
+        return cached[1]
+
     # Translate the date from text to datetime
     from_date = rule_manager.get_property(None, module_name, 'from_date')
     if from_date == '':
@@ -46,16 +128,18 @@ def window_dates(module_name):
     else:
         until_date = datetime.datetime.strptime(until_date, '%Y/%m/%d %H:%M:%S')
 
+    _window_dates[module_name] = (rule_manager.generation, 
+                                  (from_date, until_date))
+
     return (from_date, until_date)
 
-def files_to_process(module_name):
+def expand_files(module_name):
     """
     Given a module name, obtains from the global rule manager the value of the
-    "files" variable, computes the total number of lines, and those that need to
-    be processed to print a tick in stdout. Returns:
-
-    ([list of files], total_lines, mark_lines)
-    
+    "files" variable and expands the wildcards. If the cache for modified files
+    is enabled, those not modified are discarded. Returns the list of pairs
+    (file, annotation), where annotation is the list of values stored in the
+    cache for the file.
     """
 
     # Expand wildcards in file names
@@ -69,11 +153,16 @@ def files_to_process(module_name):
                                   'file_modification_cache')
     # If modified files cache enabled, filter out those that were not modified
     if file_modification_cache != '':
+        # Fetch the data of all the files of the module in one query
+        file_data = detect_new_files.file_data
+        if isinstance(file_data, detect_new_files.FileStore):
+            file_data = file_data.module_items(module_name)
+
         new_files = []
         for x in files:
-            file_annotation = detect_new_files.needs_processing(None, 
-                                                                module_name + 
-                                                                '//' + x)
+            file_annotation = \
+                detect_new_files.needs_processing(file_data, 
+                                                  module_name + '//' + x)
             if file_annotation == None:
                 print >> sys.stderr, 'File', x, 'not modified. Skipping'
             else:
@@ -82,8 +171,30 @@ def files_to_process(module_name):
     else:
         files = [(x, ['1970-01-01 00:00:00']) for x in files]
 
-    # Count the total number of lines in the files
-    total_lines = sum(map(lambda x: file_len(x[0]), files))
-    mark_lines = total_lines / 40 + 1
+    return files
+
+def files_to_process(module_name):
+    """
+    Given a module name, obtains from the global rule manager the value of the
+    "files" variable, computes the total size of the files (in bytes, as given
+    by os.stat, the files are not read), and the number of bytes that need to be
+    processed to print a tick in stdout. Returns:
+
+    ([list of files], total_bytes, mark_bytes)
+    
+    If the global variable forced_files is not None, its value is taken as the
+    list of files to process.
+    """
+
+    global forced_files
+
+    if forced_files != None:
+        files = forced_files
+    else:
+        files = expand_files(module_name)
+
+    # Add the size of the files
+    total_bytes = sum([os.stat(x[0]).st_size for x in files])
+    mark_bytes = total_bytes / 40 + 1
   
-    return (files, total_lines, mark_lines)
+    return (files, total_bytes, mark_bytes)
@@ -7,6 +7,7 @@ import sys, locale, codecs, getopt, os, glob, re, datetime, calendar, pysvn
 import fnmatch
 
 import rules_common, rule_manager, event_output, anonymize, process_filters
+import event_record
 
 #
 # See update_events and event_output for the structure of the events
@@ -34,6 +35,7 @@ config_params = {
     'files': '',           # Files to process
     'filter_file': '',     # File containing a function to filter events
     'filter_function': '', # Function to use to filter
+    'filter': '',          # Declarative filter (see filter_expr)
     'msg_length': '256'    # Maximum message size stored
     }
 
@@ -183,10 +185,10 @@ def execute(module_name):
         except ValueError, e:
             event_name = 'svn_commit'
 
-        event = (event_name, dtime, anon_user_id,
-                 [('program', 'svn'), 
-                  ('repository', repository_name), 
-                  ('comment', msg)])
+        event = event_record.Event(event_name, dtime, anon_user_id,
+                                   [('program', 'svn'), 
+                                    ('repository', repository_name), 
+                                    ('comment', msg)])
 
         try:
             event_output.out(event)
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Regression tests of anonymize_store: lookups in the sorted files, replay of
+# the journal after an abrupt termination, and compaction. Execute with
+#
+#   python -m unittest test_anonymize_store
+#
+import sys, locale, codecs, os, tempfile, shutil, unittest
+
+import anonymize_store
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+def abandon(store):
+    """
+    Release the files of the store without compacting it, as if the process
+    had been killed
+    """
+    store.close_map()
+    store.journal.close()
+
+def file_lines(file_name):
+    data_in = open(file_name, 'rb')
+    result = data_in.read().splitlines()
+    data_in.close()
+    return result
+
+class AnonymizeStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pla-test-')
+        self.file_name = os.path.join(self.directory, 'map.csv')
+        open(self.file_name, 'wb').close()
+
+        # Entries with ids of different lengths and non ascii characters
+        self.entries = {}
+        for index in xrange(500):
+            self.entries[u'user%d' % (index * 7)] = u'd%05d' % index
+        self.entries[u'jos\xe9'] = u'dutf8'
+        self.entries[u'a'] = u'dfirst'
+        self.entries[u'zz'] = u'dlast'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def open_store(self):
+        return anonymize_store.AnonymizeStore(self.file_name)
+
+    def fill(self, store):
+        for (key, value) in sorted(self.entries.items()):
+            store[key] = value
+
+    def check(self, store):
+        """
+        Check that the store has exactly the entries in self.entries
+        """
+        self.assertEqual(len(store), len(self.entries))
+        self.assertEqual(sorted(store.items()), sorted(self.entries.items()))
+        for (key, value) in self.entries.items():
+            self.assertEqual(store.get(key), value)
+            self.assertTrue(store.has_digest(value))
+
+    def check_files(self):
+        """
+        Check that the map and digest files are sorted, without repeated
+        entries, and have exactly the entries in self.entries
+        """
+        pairs = [x.split(',') for x in file_lines(self.file_name)]
+        expected = sorted([(x.encode('utf-8'), y.encode('utf-8'))
+                           for (x, y) in self.entries.items()])
+        self.assertEqual([tuple(x) for x in pairs], expected)
+        digests = [x.split(',') for x in
+                   file_lines(self.file_name + '.digests')]
+        self.assertEqual([tuple(x) for x in digests],
+                         sorted([(y, x) for (x, y) in expected]))
+
+    def test_search_lines(self):
+        store = self.open_store()
+        self.fill(store)
+        store.close()
+
+        # Lookups only through the binary search in the files
+        store = self.open_store()
+        for (key, value) in self.entries.items():
+            self.assertEqual(store.search(key.encode('utf-8')),
+                             value.encode('utf-8'))
+        for key in ['', '0', 'a0', 'user', 'user1', 'user34999', 'zzz',
+                    '\xff']:
+            self.assertEqual(store.search(key), None)
+            self.assertFalse(store.has_digest(key))
+        self.assertEqual(store.get(u'missing', u'default'), u'default')
+        self.assertRaises(KeyError, lambda: store[u'missing'])
+        store.close()
+
+        # Maps with a single line, with or without end of line
+        for data in ['a,b\n', 'a,b']:
+            self.assertEqual(anonymize_store.search_lines(data, 'a'), 'b')
+            self.assertEqual(anonymize_store.search_lines(data, 'b'), None)
+
+    def test_unsorted_map(self):
+        # Map edited by hand: unsorted, with comments and MS-DOS lines
+        data_out = open(self.file_name, 'wb')
+        data_out.write('# Comment\n')
+        for (key, value) in reversed(sorted(self.entries.items())):
+            data_out.write(key.encode('utf-8') + ',' + value.encode('utf-8') +
+                           '\r\n')
+        data_out.close()
+
+        store = self.open_store()
+        self.check(store)
+        store.close()
+        self.check_files()
+
+    def test_journal_replay(self):
+        store = self.open_store()
+        self.fill(store)
+        abandon(store)
+
+        # Nothing was compacted, and the entries are in the journal
+        self.assertEqual(os.path.getsize(self.file_name), 0)
+        self.assertEqual(len(file_lines(self.file_name + '.journal')),
+                         len(self.entries))
+
+        store = self.open_store()
+        self.check(store)
+        store.close()
+        self.check_files()
+        self.assertEqual(os.path.getsize(self.file_name + '.journal'), 0)
+
+    def test_incomplete_journal_line(self):
+        store = self.open_store()
+        self.fill(store)
+        abandon(store)
+
+        # The last entry was being written when the process was killed
+        data_out = open(self.file_name + '.journal', 'ab')
+        data_out.write('incomplete,dinc')
+        data_out.close()
+
+        store = self.open_store()
+        self.assertEqual(store.get(u'incomplete'), None)
+        self.check(store)
+        store.close()
+        self.check_files()
+
+    def test_journal_over_map(self):
+        # Entries in the map, and more entries and changes in the journal
+        store = self.open_store()
+        self.fill(store)
+        store.close()
+
+        store = self.open_store()
+        store[u'new'] = u'dnew'
+        store[u'a'] = u'dchanged'
+        abandon(store)
+
+        self.entries[u'new'] = u'dnew'
+        self.entries[u'a'] = u'dchanged'
+        store = self.open_store()
+        self.check(store)
+        store.close()
+        self.check_files()
+
+    def test_compaction_interrupted(self):
+        store = self.open_store()
+        self.fill(store)
+        store.close()
+        store = self.open_store()
+        store[u'new'] = u'dnew'
+        self.entries[u'new'] = u'dnew'
+
+        # The map was replaced, but not the digests, and the journal was not
+        # truncated
+        anonymize_store.write_lines(self.file_name,
+                                    list(store.merged_pairs()))
+        abandon(store)
+
+        store = self.open_store()
+        self.check(store)
+        store.close()
+        self.check_files()
+
+    def test_temporary_file_left(self):
+        store = self.open_store()
+        self.fill(store)
+        abandon(store)
+
+        # The process was killed while writing the new map
+        data_out = open(self.file_name + '.tmp', 'wb')
+        data_out.write('a,incomplete\nb')
+        data_out.close()
+
+        store = self.open_store()
+        self.check(store)
+        store.close()
+        self.check_files()
+        self.assertFalse(os.path.exists(self.file_name + '.tmp'))
+
+    def test_compaction(self):
+        store = self.open_store()
+        self.fill(store)
+        map_inode = os.stat(self.file_name).st_ino
+        store.compact()
+
+        # The map is replaced (not written in place) and the store remains
+        # usable
+        self.assertNotEqual(os.stat(self.file_name).st_ino, map_inode)
+        self.assertEqual(os.path.getsize(self.file_name + '.journal'), 0)
+        self.check(store)
+        store[u'new'] = u'dnew'
+        self.entries[u'new'] = u'dnew'
+        store.close()
+        self.check_files()
+
+        # Compacting without new entries keeps the files
+        map_inode = os.stat(self.file_name).st_ino
+        store = self.open_store()
+        store.close()
+        self.assertEqual(os.stat(self.file_name).st_ino, map_inode)
+
+    def test_other_process(self):
+        # Two stores on the same files (as the workers in parallel)
+        store = self.open_store()
+        other = self.open_store()
+        store[u'first'] = u'd1'
+        other.lock()
+        other.refresh()
+        other.unlock()
+        self.assertEqual(other.get(u'first'), u'd1')
+        self.assertEqual(other.added, [u'first'])
+
+        # One of them compacts the map, the other one sees the new map
+        store.close()
+        other.lock()
+        other.refresh()
+        other[u'second'] = u'd2'
+        other.unlock()
+        self.assertEqual(other.map_version, 1)
+        self.assertEqual(other.get(u'first'), u'd1')
+        other.close()
+
+        self.entries = {u'first': u'd1', u'second': u'd2'}
+        self.check_files()
+
+if __name__ == '__main__':
+    unittest.main()
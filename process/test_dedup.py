@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Regression tests of dedup: detection of the duplicates in the same and in
+# later executions, and rebuild of the Bloom filter after an abrupt
+# termination. Execute with
+#
+#   python -m unittest test_dedup
+#
+import sys, locale, codecs, os, tempfile, shutil, hashlib, datetime, unittest
+
+import dedup, event_record
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+def digest(index):
+    return hashlib.md5(str(index)).digest()
+
+def abandon(index):
+    """
+    Release the files of the index without committing or closing the Bloom
+    filter, as if the process had been killed
+    """
+    index.connection.close()
+    index.bloom.data.close()
+    index.bloom.file.close()
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pla-test-')
+        self.file_name = os.path.join(self.directory, 'dedup')
+
+        # Digests inserted in several statements within a transaction
+        self.saved_size = dedup.insert_batch
+        dedup.insert_batch = 7
+
+    def tearDown(self):
+        dedup.insert_batch = self.saved_size
+        shutil.rmtree(self.directory, True)
+
+    def open_index(self, bits = None):
+        index = dedup.DedupIndex(self.file_name, 1, 3)
+        if bits != None:
+            index.bloom.close()
+            index.bloom = dedup.BloomFilter(self.file_name + '.bloom', bits, 3)
+            if not index.bloom.valid:
+                index.rebuild()
+        return index
+
+    def test_same_execution(self):
+        index = self.open_index()
+        for number in xrange(100):
+            self.assertFalse(index.is_duplicate(digest(number)))
+        for number in xrange(100):
+            self.assertTrue(index.is_duplicate(digest(number)))
+        index.close()
+
+    def test_false_positives(self):
+        # A filter with a few bits gives positives for most new digests, only
+        # the database decides
+        index = self.open_index(64)
+        for number in xrange(200):
+            self.assertFalse(index.is_duplicate(digest(number)))
+        index.commit()
+        for number in xrange(200, 400):
+            self.assertFalse(index.is_duplicate(digest(number)))
+        for number in xrange(400):
+            self.assertTrue(index.is_duplicate(digest(number)))
+        index.close()
+
+    def test_next_execution(self):
+        index = self.open_index()
+        for number in xrange(100):
+            index.is_duplicate(digest(number))
+        index.close()
+
+        index = self.open_index()
+        self.assertTrue(index.bloom.valid)
+        for number in xrange(100):
+            self.assertTrue(index.is_duplicate(digest(number)))
+        self.assertFalse(index.is_duplicate(digest(100)))
+        index.close()
+
+    def test_abrupt_termination(self):
+        index = self.open_index()
+        for number in xrange(100):
+            index.is_duplicate(digest(number))
+        index.commit()
+
+        # The digests not committed belong to events that were not written
+        for number in xrange(100, 200):
+            index.is_duplicate(digest(number))
+        abandon(index)
+
+        saved_stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            index = self.open_index()
+        finally:
+            sys.stderr.close()
+            sys.stderr = saved_stderr
+        self.assertFalse(index.bloom.valid)
+        for number in xrange(100):
+            self.assertTrue(index.is_duplicate(digest(number)))
+        for number in xrange(100, 200):
+            self.assertFalse(index.is_duplicate(digest(number)))
+        index.close()
+
+    def test_select(self):
+        events = [event_record.Event('visit_url',
+                                     datetime.datetime(2012, 3, 3, 11, x),
+                                     'user', [('application', 'unknown')])
+                  for x in range(10)]
+        index = self.open_index()
+        self.assertEqual(index.select(events + events[0:5]), events)
+        index.close()
+
+        index = self.open_index()
+        self.assertEqual(index.select(events), [])
+        index.close()
+
+    def test_old_sqlite(self):
+        # Before 3.8.2, SQLite does not support tables without rowid
+        saved_version = dedup.sqlite3.sqlite_version_info
+        dedup.sqlite3.sqlite_version_info = (3, 7, 17)
+        try:
+            index = self.open_index()
+        finally:
+            dedup.sqlite3.sqlite_version_info = saved_version
+        (sql,) = index.connection.execute('''SELECT sql FROM sqlite_master
+                                             WHERE name = 'digests'
+                                          ''').fetchone()
+        self.assertFalse('WITHOUT ROWID' in sql.upper())
+        self.assertFalse(index.is_duplicate(digest(0)))
+        index.close()
+
+        index = self.open_index()
+        self.assertTrue(index.is_duplicate(digest(0)))
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
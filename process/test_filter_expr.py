@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Regression tests of filter_expr: parsing of the expressions, operators, and
+# equivalence with the filter functions. Execute with
+#
+#   python -m unittest test_filter_expr
+#
+import sys, locale, codecs, re, unittest
+
+import filter_expr, filters
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+def holds(expression, fields):
+    return filter_expr.compile_expression(expression)(fields) != None
+
+class FilterExprTest(unittest.TestCase):
+
+    def test_operators(self):
+        fields = [u'a', u'GET /x/index.html HTTP/1.1', u'\xe1rbol']
+        self.assertTrue(holds('0 in a b', fields))
+        self.assertFalse(holds('0 in b c', fields))
+        self.assertTrue(holds('1 prefix POST GET', fields))
+        self.assertFalse(holds('1 prefix POST PUT', fields))
+        self.assertTrue(holds('1.1 suffix .css .html', fields))
+        self.assertFalse(holds('1 suffix .html', fields))
+        self.assertTrue(holds('1 contains index', fields))
+        self.assertFalse(holds('1 contains Index', fields))
+        self.assertTrue(holds(r'1 regex ^GET\s+/x/', fields))
+        self.assertFalse(holds(r'1 regex ^/x/', fields))
+        self.assertTrue(holds(u'2 in \xe1rbol', fields))
+        self.assertTrue(holds('2 prefix \xc3\xa1r', fields))
+
+    def test_negation(self):
+        fields = [u'a', u'b']
+        self.assertTrue(holds('0 not in b c', fields))
+        self.assertFalse(holds('0 not in a', fields))
+        self.assertTrue(holds('0 not in a | 1 in b', fields))
+        self.assertFalse(holds('0 not contains a; 1 in b', fields))
+
+    def test_clauses(self):
+        fields = [u'a', u'b', u'c']
+        self.assertTrue(holds('0 in a; 1 in b; 2 in c', fields))
+        self.assertFalse(holds('0 in a; 1 in x; 2 in c', fields))
+        self.assertTrue(holds('0 in x | 1 in x | 2 in c', fields))
+        self.assertFalse(holds('0 in x | 1 in x | 2 in x', fields))
+        self.assertTrue(holds('0 in a;', fields))
+        self.assertTrue(holds('', fields))
+
+    def test_fused_terms(self):
+        # Terms over the same field and operator are fused in a single test
+        fields = [u'/a/b.html?x=1']
+        self.assertTrue(holds('0 suffix .css | 0 contains .html?', fields))
+        self.assertTrue(holds('0 contains .htm? | 0 regex x=\\d', fields))
+        self.assertFalse(holds('0 contains .htm? | 0 regex y=\\d', fields))
+        self.assertTrue(holds('0 prefix /b | 0 prefix /a/', fields))
+        self.assertFalse(holds('0 prefix /b | 0 prefix /ab', fields))
+
+    def test_missing_fields(self):
+        fields = [u'one two', None]
+        self.assertTrue(holds('0.5 in ""', fields))
+        self.assertTrue(holds('1 in ""', fields))
+        self.assertTrue(holds('7 in ""', fields))
+        self.assertTrue(holds('7.1 not prefix x', fields))
+        self.assertTrue(holds('0.1 in two', fields))
+
+    def test_quotes(self):
+        fields = [u'a b;c|d', u"it's"]
+        self.assertTrue(holds('0 in "a b;c|d"', fields))
+        self.assertTrue(holds('0 contains \'b;c\' x', fields))
+        self.assertTrue(holds('1 in "it\'s"', fields))
+
+    def test_errors(self):
+        for expression in ['0 in', 'x in a', '0 equals a', '0 not in',
+                           '0 in "a', '0 regex (a', '0.x in a']:
+            self.assertRaises(ValueError, filter_expr.compile_expression,
+                              expression)
+
+    def test_trie_pattern(self):
+        prefixes = ['abc', 'abd', 'ab', 'b', 'bcd', 'c.']
+        matcher = re.compile(filter_expr.trie_pattern(prefixes)).match
+        for value in ['abc', 'abx', 'ab', 'b', 'bz', 'c.d', 'a', 'c', 'cx',
+                      '', 'xab']:
+            expected = len([x for x in prefixes if value.startswith(x)]) > 0
+            self.assertEqual(matcher(value) != None, expected, value)
+
+    def test_filter_apache(self):
+        # Equivalent to filters.filter_apache (see the top of filter_expr)
+        predicate = filter_expr.compile_expression(
+            '5 in 200; 4.1 suffix .html | 4.1 in / | 4.1 contains .html?')
+        for status in ['200', '404']:
+            for url in ['/', '/index.html', '/a.css', '/a.html?b=c', '/x/',
+                        '/a.htm', '/a.html/b']:
+                fields = ['10.0.0.1', 'alice', '03/Mar/2012:11:43:55',
+                          None, 'GET ' + url + ' HTTP/1.1', status, '1234']
+                self.assertEqual(predicate(fields),
+                                 filters.filter_apache(fields), url)
+
+    def test_filter_object(self):
+        fields = [u'a', u'b']
+        self.assertEqual(filter_expr.Filter('0 in a')(fields), fields)
+        self.assertEqual(filter_expr.Filter('0 in b')(fields), None)
+
+        # The function is only applied to the fields kept by the expression
+        applied = []
+        def function(fields):
+            applied.append(fields)
+            return None
+        self.assertEqual(filter_expr.Filter('0 in a', function)(fields), None)
+        self.assertEqual(filter_expr.Filter('0 in b', function)(fields), None)
+        self.assertEqual(applied, [fields])
+
+if __name__ == '__main__':
+    unittest.main()
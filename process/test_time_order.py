@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Regression tests of time_order: the events of several streams, slightly out
+# of order, are given in time order, with the runs merged in tiers. Execute
+# with
+#
+#   python -m unittest test_time_order
+#
+import sys, locale, codecs, os, tempfile, shutil, random, datetime, unittest
+
+import time_order, event_record
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+start = datetime.datetime(2012, 3, 3)
+
+def stream(number, size, displacement, generator):
+    """
+    List of events of a stream, each one at most displacement positions away
+    from its place in time order
+    """
+
+    result = [event_record.Event('visit_url',
+                                 start + datetime.timedelta(seconds = x),
+                                 'user%d' % number, [('ordinal', x)])
+              for x in xrange(size)]
+    for index in xrange(0, size - displacement, displacement + 1):
+        block = result[index:index + displacement + 1]
+        generator.shuffle(block)
+        result[index:index + displacement + 1] = block
+    return result
+
+def key(event):
+    return (event.datetime, event.user)
+
+class TimeOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pla-test-')
+        self.saved = (time_order.run_batch_size, time_order.merge_fanin)
+
+        # Runs written in several batches, and merged in several levels
+        time_order.run_batch_size = 5
+        time_order.merge_fanin = 3
+
+    def tearDown(self):
+        (time_order.run_batch_size, time_order.merge_fanin) = self.saved
+        shutil.rmtree(self.directory, True)
+
+    def check_order(self, streams, reorder_buffer, batch = 7):
+        events = sum(streams, [])
+        order = time_order.TimeOrder(reorder_buffer, self.directory)
+        for index in xrange(0, len(events), batch):
+            order.add(events[index:index + batch])
+        result = list(order.merge())
+
+        self.assertEqual(sorted([key(x) for x in result]),
+                         sorted([key(x) for x in events]))
+        self.assertEqual([x.datetime for x in result],
+                         sorted([x.datetime for x in events]))
+        self.assertEqual(len(order), 0)
+        self.assertEqual(os.listdir(order.directory), [])
+        order.close()
+        self.assertFalse(os.path.exists(order.directory))
+        return order
+
+    def test_reorder_buffer(self):
+        # A single stream with the events displaced less than the buffer is
+        # written as a single run
+        generator = random.Random(1)
+        order = self.check_order([stream(0, 200, 4, generator)], 5)
+        self.assertEqual(order.run_number, 1)
+
+    def test_streams(self):
+        generator = random.Random(2)
+        streams = [stream(x, generator.randint(0, 60), 3, generator)
+                   for x in xrange(40)]
+        self.check_order(streams, 4)
+
+    def test_displaced_more_than_buffer(self):
+        generator = random.Random(3)
+        streams = [stream(x, 100, 20, generator) for x in xrange(5)]
+        self.check_order(streams, 2)
+
+    def test_levels(self):
+        # The runs of the same level are merged while being written (30 runs
+        # are at most two of each of the three levels)
+        generator = random.Random(4)
+        streams = [stream(x, 10, 0, generator) for x in xrange(30)]
+        order = time_order.TimeOrder(1, self.directory)
+        for events in streams:
+            order.add(events)
+            self.assertTrue(len(order.runs) <= 2 * time_order.merge_fanin)
+        self.assertEqual([x.datetime for x in order.merge()],
+                         sorted([x.datetime for x in sum(streams, [])]))
+        order.close()
+
+    def test_final_merge(self):
+        # 26 runs are left as two of each level, and the smallest are merged
+        # so that the final merge reads at most merge_fanin runs
+        generator = random.Random(6)
+        streams = [stream(x, 10, 0, generator) for x in xrange(26)]
+        order = time_order.TimeOrder(1, self.directory)
+        for events in streams:
+            order.add(events)
+
+        merged = []
+        merge_runs = order.merge_runs
+        def record(runs):
+            merged.append(len(runs))
+            return merge_runs(runs)
+        order.merge_runs = record
+        self.assertEqual([x.datetime for x in order.merge()],
+                         sorted([x.datetime for x in sum(streams, [])]))
+        self.assertEqual(len(merged), 2)
+        self.assertTrue(merged[-1] <= time_order.merge_fanin)
+        order.close()
+
+    def test_empty(self):
+        order = time_order.TimeOrder(10, self.directory)
+        self.assertEqual(len(order), 0)
+        self.assertEqual(list(order.merge()), [])
+        order.close()
+
+    def test_close_pending(self):
+        order = time_order.TimeOrder(1, self.directory)
+        order.add(stream(0, 20, 0, random.Random(5)))
+        self.assertNotEqual(len(order), 0)
+        order.close()
+        self.assertFalse(os.path.exists(order.directory))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Sorting of the events by time with bounded memory (time_order option of
+# event_output). The events arrive as the concatenation of streams mostly
+# ordered by time (one per file processed, or one per task in parallel
+# executions) and are written to temporary files (runs):
+#
+# - Each event goes through a reorder buffer (a heap with reorder_buffer
+#   events), so that lines slightly out of order in a stream are placed in the
+#   right position.
+#
+# - The events leaving the buffer are appended to the current run (replacement
+#   selection). An event older than the last one appended to the run (the
+#   beginning of a new stream, or an event displaced more than the buffer
+#   size) is marked for the next run, and stays in the buffer until the events
+#   of the current run leave it. Thus each run is sorted, and the buffer is
+#   available to reorder each new stream.
+#
+# When the events are requested (see merge), the runs are combined with a
+# heap-based k-way merge, in O(n log k) time and keeping in memory a single
+# batch of each run. To bound the number of runs open at the same time, the runs
+# are merged in tiers while being written: the runs have a level (0 when
+# written from the buffer), and when there are merge_fanin runs of the same
+# level they are merged into a single run of the next level. Thus each event
+# is written O(log n) times. Before the final merge, the smallest runs are
+# merged until there are at most merge_fanin runs.
+#
+import sys, locale, codecs, os, heapq, tempfile, cPickle, shutil
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Number of events written to a run in a single operation
+run_batch_size = 1000
+
+# Maximum number of runs merged at the same time
+merge_fanin = 128
+
+class TimeOrder(object):
+    """
+    Events pending to be given in time order
+    """
+
+    def __init__(self, reorder_buffer, directory = None):
+        if directory == '':
+            directory = None
+        self.directory = tempfile.mkdtemp(prefix = 'pla-order-',
+                                          dir = directory)
+        self.reorder_buffer = max(reorder_buffer, 1)
+
+        # Reorder buffer, heap with tuples (run, datetime, ordinal, event)
+        self.heap = []
+        self.ordinal = 0
+
+        # Complete runs, in the order in which they were written, as lists
+        # [file name, number of events, level]
+        self.runs = []
+        self.run_number = 0
+
+        # Run being written (number, file, events pending to be written,
+        # number of events, and datetime of the last event appended to it)
+        self.run_index = 0
+        self.run_file = None
+        self.run_batch = []
+        self.run_events = 0
+        self.last_datetime = None
+
+    def __len__(self):
+        """
+        Zero if there are no events pending
+        """
+        return len(self.heap) + len(self.runs) + (self.run_file != None)
+
+    def add(self, events):
+        """
+        Add the list of events
+        """
+
+        heap = self.heap
+        for event in events:
+            run_index = self.run_index
+            if self.last_datetime != None and \
+                    event.datetime < self.last_datetime:
+                run_index += 1
+            heapq.heappush(heap, (run_index, event.datetime, self.ordinal,
+                                  event))
+            self.ordinal += 1
+            if len(heap) > self.reorder_buffer:
+                self.append(heapq.heappop(heap))
+
+    def append(self, entry):
+        """
+        Append the event in the entry taken from the buffer to its run
+        """
+
+        (run_index, dtime, ordinal, event) = entry
+        if run_index != self.run_index:
+            self.end_run()
+            self.run_index = run_index
+
+        if self.run_file == None:
+            self.run_file = open(self.run_name(), 'wb')
+
+        self.run_batch.append(event)
+        self.run_events += 1
+        self.last_datetime = event.datetime
+        if len(self.run_batch) >= run_batch_size:
+            cPickle.dump(self.run_batch, self.run_file, 2)
+            self.run_batch = []
+
+    def run_name(self):
+        self.run_number += 1
+        return os.path.join(self.directory, 'run-%06d' % self.run_number)
+
+    def end_run(self):
+        """
+        Close the current run
+        """
+
+        if self.run_file == None:
+            return
+
+        if self.run_batch != []:
+            cPickle.dump(self.run_batch, self.run_file, 2)
+            self.run_batch = []
+        self.runs.append([self.run_file.name, self.run_events, 0])
+        self.run_file.close()
+        self.run_file = None
+        self.run_events = 0
+        self.last_datetime = None
+
+        # Merge the levels with merge_fanin runs
+        level = 0
+        while True:
+            runs = [x for x in self.runs if x[2] == level]
+            if len(runs) < merge_fanin:
+                break
+            self.compact(runs, level + 1)
+            level += 1
+
+    def compact(self, runs, level):
+        """
+        Merge the given runs into a single run of the given level, placed in
+        the position of the first of them
+        """
+
+        position = self.runs.index(runs[0])
+        data_out = open(self.run_name(), 'wb')
+        batch = []
+        count = 0
+        for event in self.merge_runs(runs):
+            batch.append(event)
+            count += 1
+            if len(batch) >= run_batch_size:
+                cPickle.dump(batch, data_out, 2)
+                batch = []
+        if batch != []:
+            cPickle.dump(batch, data_out, 2)
+        data_out.close()
+
+        self.runs = [x for x in self.runs if not x in runs]
+        self.runs.insert(position, [data_out.name, count, level])
+
+    @staticmethod
+    def read_run(file_name, index):
+        """
+        Generator with the events of a run as tuples (datetime, index,
+        position, event)
+        """
+
+        data_in = open(file_name, 'rb')
+        position = 0
+        try:
+            while True:
+                try:
+                    batch = cPickle.load(data_in)
+                except EOFError:
+                    break
+                for event in batch:
+                    yield (event.datetime, index, position, event)
+                    position += 1
+        finally:
+            data_in.close()
+
+    def merge_runs(self, runs):
+        """
+        Generator with the events of the given runs in time order. The files
+        of the runs are removed.
+        """
+
+        streams = [self.read_run(x[0], y) for (y, x) in enumerate(runs)]
+        for (dtime, index, position, event) in heapq.merge(*streams):
+            yield event
+        for run in runs:
+            os.remove(run[0])
+
+    def merge(self):
+        """
+        Generator with all the events added so far in time order
+        """
+
+        while self.heap != []:
+            self.append(heapq.heappop(self.heap))
+        self.end_run()
+
+        # Merge the smallest runs to have at most merge_fanin
+        if len(self.runs) > merge_fanin:
+            runs = sorted(self.runs, key = lambda x: x[1])
+            runs = runs[:len(self.runs) - merge_fanin + 1]
+            self.compact([x for x in self.runs if x in runs],
+                         max([x[2] for x in runs]) + 1)
+
+        runs = self.runs
+        self.runs = []
+        return self.merge_runs(runs)
+
+    def close(self):
+        """
+        Remove the temporary files (the pending events are discarded)
+        """
+
+        if self.run_file != None:
+            self.run_file.close()
+            self.run_file = None
+        shutil.rmtree(self.directory, True)
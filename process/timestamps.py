@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-#
+#
+# Author: Abelardo Pardo (abelardo.pardo@uc3m.es)
+#
+# Functions to translate the date/time strings found in the logs into datetime
+# objects. datetime.datetime.strptime is too expensive to be called once per
+# line, thus:
+#
+# - The formats used by the parsers have a fixed-width parser (parse_clf for
+#   the Apache format '%d/%b/%Y:%H:%M:%S' and parse_iso for '%Y-%m-%d
+#   %H:%M:%S'). Strings not matching the fixed layout are given to strptime, so
+#   the result (and the ValueError in case of error) is the same.
+#
+# - The results are stored in a small LRU cache keyed by the string (with
+#   second resolution, logs contain the same string in many consecutive lines).
+#
+# Any other format is handled by parse(text, format), which caches the result
+# of strptime.
+#
+import sys, locale, codecs, datetime, ordereddict
+
+# Fix the output encoding when redirecting stdout
+if sys.stdout.encoding is None:
+    (lang, enc) = locale.getdefaultlocale()
+    if enc is not None:
+        (e, d, sr, sw) = codecs.lookup(enc)
+        # sw will encode Unicode data to the locale-specific character set.
+        sys.stdout = sw(sys.stdout)
+
+# Formats with a fixed-width parser
+clf_format = '%d/%b/%Y:%H:%M:%S'
+iso_format = '%Y-%m-%d %H:%M:%S'
+
+# Maximum number of strings in the cache
+cache_size = 1024
+
+# Cache with the translated strings, the keys are (format, string)
+_cache = ordereddict.OrderedDict()
+
+# Last key translated (to skip the LRU maintenance for consecutive lines)
+_last_key = None
+_last_value = None
+
+_months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+def _strptime(text, format):
+    """
+    Translation for the generic formats
+    """
+    return datetime.datetime.strptime(text, format)
+
+def _clf(text, format):
+    """
+    Translation of 'dd/Mon/YYYY:HH:MM:SS'
+    """
+
+    month = _months.get(text[3:6])
+    if len(text) != 20 or month == None or text[2] != '/' or \
+            text[6] != '/' or text[11] != ':' or text[14] != ':' or \
+            text[17] != ':' or not (text[0:2] + text[7:11] + text[12:14] + \
+                                        text[15:17] + text[18:20]).isdigit():
+        return datetime.datetime.strptime(text, format)
+
+    return datetime.datetime(int(text[7:11]), month, int(text[0:2]),
+                             int(text[12:14]), int(text[15:17]),
+                             int(text[18:20]))
+
+def _iso(text, format):
+    """
+    Translation of 'YYYY-MM-DD HH:MM:SS'
+    """
+
+    if len(text) != 19 or text[4] != '-' or text[7] != '-' or \
+            text[10] != ' ' or text[13] != ':' or text[16] != ':' or \
+            not (text[0:4] + text[5:7] + text[8:10] + text[11:13] + \
+                     text[14:16] + text[17:19]).isdigit():
+        return datetime.datetime.strptime(text, format)
+
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                             int(text[11:13]), int(text[14:16]),
+                             int(text[17:19]))
+
+def _lookup(text, format, function):
+    """
+    Return the datetime for the given text, translating it with the function
+    only if it is not in the cache.
+    """
+
+    global _cache
+    global _last_key
+    global _last_value
+    global cache_size
+
+    key = (format, text)
+    if key == _last_key:
+        return _last_value
+
+    try:
+        value = _cache.pop(key)
+    except KeyError:
+        value = function(text, format)
+        if len(_cache) >= cache_size:
+            _cache.popitem(last = False)
+    _cache[key] = value
+
+    _last_key = key
+    _last_value = value
+    return value
+
+def parse_clf(text):
+    """
+    Translate a date in the Apache format '%d/%b/%Y:%H:%M:%S' (no time zone)
+    """
+    return _lookup(text, clf_format, _clf)
+
+def parse_iso(text):
+    """
+    Translate a date in the format '%Y-%m-%d %H:%M:%S'
+    """
+    return _lookup(text, iso_format, _iso)
+
+def parse(text, format):
+    """
+    Translate a date in any format accepted by strptime. The formats with a
+    fixed-width parser are detected.
+    """
+
+    if format == clf_format:
+        return _lookup(text, format, _clf)
+    if format == iso_format:
+        return _lookup(text, format, _iso)
+    return _lookup(text, format, _strptime)
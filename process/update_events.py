@@ -11,6 +11,15 @@ import rule_manager
 # Manage file modification files
 import detect_new_files
 
+# Execution of rules in worker processes
+import parallel
+
+# Continuous execution
+import daemon
+
+# Runtime metrics
+import metrics
+
 # Modules
 import ldap_lookup, anonymize, event_output, moodle_log
 import apache_log, vm_log, bash_log, firefox_log, kate_log, kdevelop_log
@@ -103,36 +112,22 @@ def load_defaults(configuration):
 
     return
 
-def main():
+def load_rules(config_file):
     """
-    Read a configuration file and perform the different event updates. A list of
-    the modules to execute can be given.
-
-    script configfile [module module ...]
-
-    Example:
-
-    script update_events.cfg moodle_log apache_log
-
+    Load the given configuration file, initialize the file modification cache
+    and the rules, and return the list of rules. If a configuration was
+    already loaded (daemon mode), the data kept by the modules is written
+    first.
     """
 
     global config_defaults
 
-    #######################################################################
-    #
-    # OPTIONS
-    #
-    #######################################################################
-    args = sys.argv[1:]
-
-    # Check that there are additional arguments
-    if len(args) < 1:
-        print >> sys.stderr, 'Script needs at least one parameter'
-        sys.exit(1)
-
-    if not os.path.exists(args[0]):
-        print >> sys.stderr, 'File', args[0], 'not found.'
-        sys.exit(1)
+    if rule_manager.options != None:
+        event_output.close()
+        anonymize.update_map_file(rule_manager.get_property(None, 'anonymize',
+                                                            'file'))
+        detect_new_files.save_file_data()
+        rule_manager.flush_config_parsers()
 
     # Initial options included in the global dictionary at the top of the
     # module.
@@ -142,7 +137,7 @@ def main():
     load_defaults(rule_manager.options)
 
     # Load the rules in the given configuration file
-    rules = rule_manager.load_config_file(None, args[0], {})[1]
+    rules = rule_manager.load_config_file(None, config_file, {})[1]
 
     # Initialize the file modification cache mechanism
     detect_new_files.initialize(\
@@ -151,16 +146,138 @@ def main():
                                   'file_modification_cache'), 
         True)
 
-    # Traverse the sections and run first the "initialize" function and then
-    # the "execute" function.
+    # Traverse the sections and run the "initialize" function
     for module_name in rules:
         module_prefix = module_name.split('.')[0]
         getattr(sys.modules[module_prefix], 'initialize')(module_name)
 
+    return rules
+
+def execute_rules(rules, jobs, shard):
+    """
+    Execute the given rules, in jobs worker processes if jobs is not one (see
+    parallel.execute_rules).
+    """
+
+    if jobs != 1:
+        # Parallel execution of the rules
+        parallel.execute_rules(rules, jobs, shard)
+        return
+
     for module_name in rules:
         module_prefix = module_name.split('.')[0]
         print >> sys.stderr, '### Execute' , module_name
-        getattr(sys.modules[module_prefix], 'execute')(module_name)
+        metrics.execute(module_name,
+                        getattr(sys.modules[module_prefix], 'execute'))
+
+def main():
+    """
+    Read a configuration file and perform the different event updates. A list of
+    the modules to execute can be given.
+
+    script [options] configfile [module module ...]
+
+    Options:
+
+    -j N, --jobs=N Execute the parser rules in N worker processes (0 to use
+                   as many processes as CPUs). The auxiliary modules are
+                   initialized first and the events of every rule are dumped
+                   in the same order as in the sequential execution.
+
+    -s, --shard    Together with --jobs, process each file of the rules in a
+                   different task, so that rules with many files are spread
+                   over all the worker processes.
+
+    -d, --daemon   Keep executing the rules, processing the data appended to
+                   their files as soon as it is written (requires the
+                   file_modification_cache). SIGHUP reloads the configuration
+                   file, SIGTERM terminates.
+
+    -i N, --interval=N  In daemon mode, execute all the rules at least every N
+                   seconds (default 5).
+
+    --metrics=FILE Write the metrics of each rule (lines read, events
+                   skipped, filtered and emitted, anonymize hits, LDAP
+                   lookups, time in each stage) in FILE in JSON format. Written
+                   at the end, and after every cycle in daemon mode.
+
+    --prometheus=FILE  Same as --metrics, in the text format of Prometheus.
+
+    Example:
+
+    script update_events.cfg moodle_log apache_log
+
+    script -j 4 -s update_events.cfg
+
+    script -d update_events.cfg
+
+    """
+
+    #######################################################################
+    #
+    # OPTIONS
+    #
+    #######################################################################
+    jobs = 1
+    shard = False
+    daemon_mode = False
+    json_file = None
+    prometheus_file = None
+
+    # Swallow the options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:sdi:", 
+                                   ["jobs=", "shard", "daemon", "interval=",
+                                    "metrics=", "prometheus="])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, 'Incorrect option.'
+        print >> sys.stderr, main.__doc__
+        sys.exit(2)
+
+    # Parse the options
+    for optstr, value in opts:
+        if optstr == "-j" or optstr == "--jobs":
+            try:
+                jobs = int(value)
+            except ValueError:
+                print >> sys.stderr, 'Incorrect number of jobs', value
+                sys.exit(2)
+        elif optstr == "-s" or optstr == "--shard":
+            shard = True
+        elif optstr == "-d" or optstr == "--daemon":
+            daemon_mode = True
+        elif optstr == "-i" or optstr == "--interval":
+            try:
+                daemon.interval = float(value)
+            except ValueError:
+                print >> sys.stderr, 'Incorrect interval', value
+                sys.exit(2)
+        elif optstr == "--metrics":
+            json_file = value
+        elif optstr == "--prometheus":
+            prometheus_file = value
+
+    metrics.configure(json_file, prometheus_file)
+
+    # Check that there are additional arguments
+    if len(args) < 1:
+        print >> sys.stderr, 'Script needs at least one parameter'
+        sys.exit(1)
+
+    if not os.path.exists(args[0]):
+        print >> sys.stderr, 'File', args[0], 'not found.'
+        sys.exit(1)
+
+    if daemon_mode:
+        daemon.run(lambda: load_rules(args[0]),
+                   lambda rules: execute_rules(rules, jobs, shard))
+    else:
+        execute_rules(load_rules(args[0]), jobs, shard)
+
+    # Write the buffered events
+    event_output.close()
+
+    metrics.write_reports()
 
     return
 
@@ -5,8 +5,7 @@
 #
 import sys, locale, codecs, getopt, os, glob, re, datetime
 
-import detect_new_files, rules_common, rule_manager, event_output, anonymize
-import process_filters
+import rule_manager, process_filters, pipeline, event_record, timestamps
 
 #
 # See update_events and event_output for the structure of the events
@@ -32,6 +31,7 @@ config_params = {
     'files': '',           # Files to process
     'filter_file': '',     # File containing a function to filter events
     'filter_function': '', # Function to use to filter
+    'filter': '',          # Declarative filter (see filter_expr)
     'message_lines': '30'  # Maximum number of special lines in the output
     }
 
@@ -79,116 +79,70 @@ q
 
     global filter_function
 
-    # Get the window date to process events
-    (from_date, until_date) = rules_common.window_dates(module_name)
+    pipeline.run(module_name, parse_file, filter_function, 
+                 user_from_path = True, prefilter = True)
 
-    message_lines = int(rule_manager.get_property(None, module_name, 
+def parse_file(context, lines):
+    """
+    Generator parsing the -BEGIN/-END blocks of a valgrind log (see pipeline)
+    """
+
+    message_lines = int(rule_manager.get_property(None, context.module_name,
                                                   'message_lines'))
 
-    # Get the files to process, lines and mark lines
-    (files, total_lines, mark_lines) = \
-        rules_common.files_to_process(module_name)
-
-    # Loop over all the files
-    total_counter = 0
-    for file_annotation in files:
-        # Get the file name and (if it exists, the date of the last event)
-        filename = file_annotation[0]
-        last_event = datetime.datetime.min
-        if len(file_annotation[1]) != 0:
-            last_event = datetime.datetime.strptime(file_annotation[1][0], 
-                                                        '%Y-%m-%d %H:%M:%S')
-        new_last_event = last_event
-
-        # Get the user id from the path to the file name
-        user_id = filename.split('/')[-2]
-        anon_user_id = anonymize.find_or_encode_string(user_id)
-
-        data_in = codecs.open(filename, 'r', 'utf-8', errors = 'replace')
-
-        line_number = 0
-        messages = []
-        begin_fields = []
-        for line in data_in:
-            line_number += 1
-            total_counter += 1
-            
-            if total_counter % mark_lines == 0:
-                print >> sys.stderr, '+',
-                sys.stderr.flush()
-
-            # Skip the empty lines
-            if line == '\n':
-                continue
+    dtime = None
+    messages = []
+    begin_fields = []
+    for line in lines:
+        # Skip the empty lines
+        if line == '\n':
+            continue
 
-            # See if the user id appears in the command, if so, anonymize
-            if re.search(user_id, line):
-                line = re.sub(user_id, anon_user_id, line)
-
-            # Chop the command line
-            fields = line[:-1].split()
-
-            # Beginning of log. Catch command invocation and dates
-            if re.match('^\-BEGIN .+$', line):
-                begin_fields = line.split()
-                try:
-                    dtime = \
-                        datetime.datetime.strptime(' '.join(begin_fields[1:3]),
-                                                   '%Y-%m-%d %H:%M:%S')
-                    
-                except ValueError, e:
-                    print >> sys.stderr, 'WARNING: In file', filename
-                    print >> sys.stderr, 'Ignoring:', line
-
-                command = ' '.join(begin_fields[6:])
-                messages = []
-                continue
+        # See if the user id appears in the command, if so, anonymize
+        line = context.scrub(line)
 
-            # If not the end of an event, concatenate the line and keep looping
-            if not re.match('^\-END [0-9]+$', line):
-                if len(messages) < message_lines and \
-                        (line.find('Conditional jump') != -1 or \
-                         line.find('Source and destination overlap') != -1 or \
-                         line.find('points to uninitialised byte') != -1 or \
-                         line.find('Invalid write') != -1 or \
-                         line.find('definitely lost') != -1 or \
-                         line.find('in use at exit') != -1):
-                    messages.append(line[:-1])
-                continue
-                
-            # At this point we have the complete information about the event
-            
-            if dtime <= last_event:
-                # Event is older than what has been recorded in the
-                # detect_new_files. skip
-                continue
+        # Beginning of log. Catch command invocation and dates
+        if re.match('^\-BEGIN .+$', line):
+            begin_fields = line.split()
 
-            # If out of time window, ignore
-            if dtime < from_date or dtime > until_date:
+            # Blocks rejected by the filter are ignored as those without date
+            if not context.accept(begin_fields):
+                dtime = None
                 continue
 
-            # If there is a filter function and returns None, skip this event
-            if filter_function != None and filter_function(begin_fields) == None:
-                continue
+            try:
+                dtime = timestamps.parse_iso(' '.join(begin_fields[1:3]))
+            except ValueError, e:
+                print >> sys.stderr, 'WARNING: In file', context.filename
+                print >> sys.stderr, 'Ignoring:', line
+                dtime = None
+
+            command = ' '.join(begin_fields[6:])
+            messages = []
+            continue
+
+        # If not the end of an event, concatenate the line and keep looping
+        if not re.match('^\-END [0-9]+$', line):
+            if len(messages) < message_lines and \
+                    (line.find('Conditional jump') != -1 or \
+                     line.find('Source and destination overlap') != -1 or \
+                     line.find('points to uninitialised byte') != -1 or \
+                     line.find('Invalid write') != -1 or \
+                     line.find('definitely lost') != -1 or \
+                     line.find('in use at exit') != -1):
+                messages.append(line[:-1])
+            continue
+                
+        # At this point we have the complete information about the event
 
-            # Record the event with the highest datetime.
-            if dtime > new_last_event:
-                new_last_event = dtime
+        # Blocks with an incorrect date are ignored
+        if dtime == None:
+            continue
 
-            event = ('valgrind', dtime, anon_user_id,
-                     [('program', 'valgrind'),
-                      ('command', command),
-                      ('messages',  '"' + '|||'.join(messages) + '"')])
+        event = event_record.Event('valgrind', dtime, context.user_id,
+                                   [('program', 'valgrind'),
+                                    ('command', command),
+                                    ('messages',  
+                                     '"' + '|||'.join(messages) + '"')])
 
-            try:
-                event_output.out(event)
-            except Exception, e:
-                print 'Exception while processing', filename, ':', line_number
-                print str(e)
-                sys.exit(1)
-            
-        data_in.close()
-        detect_new_files.update(None, module_name + '//' + filename, 
-                                [new_last_event])
-
-    print >> sys.stderr
+        yield (dtime, begin_fields, event)